@@ -0,0 +1,427 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import re
+import time
+import warnings
+
+import numpy as np
+
+from hist_loader import read_arrays
+from hist_store import open_store
+from stage_timer import stage, tracing
+from rebinning import DEFAULT_WIDTH, rebin, stack_hists
+from sharding import SHARD_DIR, parse_shard, shard_items, shard_path, shard_seed, write_manifest
+
+# -----------------
+# Fit settings, same as the RooFit fits in rooFit_plot_Wrmass_BW.py
+# -----------------
+MODELS = ("gauss", "bw")
+WINDOW = {"gauss": 1.5, "bw": 2.0}   # narrow range: mean -/+ 1.5 sigma, mean -/+ 2 Gamma
+ITERATIONS = 3
+WIDTH_RANGE = (10., 1000.)           # RooRealVar("sigma"/"width", ..., 10., 1000.)
+
+TABLE_COLUMNS = ["label", "wr", "n", "model", "mean", "mean_err", "width", "width_err",
+                 "chi2_ndf", "ndf", "converged"]
+
+# Poisson toys
+TOY_CHUNK = 10000                             # toy histograms per batched fit, bounds the memory
+TOY_PARAMS = ("mean", "width", "resolution")  # resolution = width / mean
+TOY_COLUMNS = ["label", "wr", "n", "model", "param", "nominal", "fit_err", "toy_mean", "bias", "spread",
+               "fit_err_over_spread", "toys"]
+
+
+def mass_point(filename):
+    # (WR, N) masses from a WRAnalyzer_signal_WR<wr>_N<n>.root name, None if absent
+    wr = re.search(r"_WR(\d+)", filename)
+    n = re.search(r"_N(\d+)", filename)
+    return (int(wr.group(1)) if wr else None, int(n.group(1)) if n else None)
+
+
+# -----------------
+# Models, evaluated for all histograms at once: p has shape (nhists, 2) = (mean, width)
+# -----------------
+def shape_and_jacobian(model, x, p):
+    mu, w = p[:, 0, None], p[:, 1, None]
+    if model == "gauss":
+        z = (x - mu) / w
+        shape = np.exp(-0.5 * z**2)
+        jac = np.stack([shape * z / w, shape * z**2 / w], axis=-1)
+    elif model == "bw":
+        # non-relativistic Breit-Wigner (RooBreitWigner), up to a constant
+        d = (x - mu)**2 + (0.5 * w)**2
+        shape = 1.0 / d
+        jac = np.stack([2 * (x - mu) / d**2, -0.5 * w / d**2], axis=-1)
+    else:
+        raise ValueError(f"Unknown fit model {model}")
+    return shape, jac
+
+
+def expected_and_jacobian(model, x, widths, p, mask, total):
+    # Like a (non-extended) RooFit fit: the pdf is normalised to the data inside the fit range
+    shape, jac = shape_and_jacobian(model, x, p)
+    g = np.where(mask, shape * widths, 0.0)
+    dg = np.where(mask[..., None], jac * widths[:, None], 0.0)
+    norm = np.maximum(g.sum(axis=1), 1e-300)[:, None]
+    dnorm = dg.sum(axis=1)[:, None, :]
+    f = total[:, None] * g / norm
+    df = total[:, None, None] * (dg - g[..., None] * dnorm / norm[..., None]) / norm[..., None]
+    return f, df
+
+
+def _weights_and_cost(y, var, f, mask, method, scale):
+    if method == "chi2":
+        w = np.where(mask & (var > 0), 1.0 / np.where(var > 0, var, 1.0), 0.0)
+        cost = np.sum(w * (y - f)**2, axis=-1)
+    else:
+        # binned (multinomial) likelihood on effective counts, Fisher scoring weights
+        fc = np.maximum(f, 1e-300)
+        w = np.where(mask, scale[:, None] / fc, 0.0)
+        ylog = np.where(mask & (y > 0), y * np.log(np.where(y > 0, y, 1.0) / fc), 0.0)
+        cost = 2 * scale * np.sum(ylog, axis=-1)
+    return w, cost
+
+
+def _lm(evaluate, y, p0, lo, hi, max_iter=200, tol=1e-9):
+    # Batched Levenberg-Marquardt: every histogram has its own damping and stops on its own.
+    # evaluate(p) gives the (f, jac, w, cost) of every histogram at parameters p
+    nhists, npar = p0.shape
+    p = p0.copy()
+    f, jac, w, cost = evaluate(p)
+    lam = np.full(nhists, 1e-3)
+    active = np.ones(nhists, dtype=bool)
+    converged = np.zeros(nhists, dtype=bool)
+
+    for _ in range(max_iter):
+        jw = jac * w[..., None]
+        hess = np.einsum("nbi,nbj->nij", jw, jac)
+        grad = np.einsum("nbi,nb->ni", jw, y - f)
+        damped = hess + lam[:, None, None] * hess * np.eye(npar)
+        step = np.einsum("nij,nj->ni", np.linalg.pinv(damped), grad)
+        step = np.where(active[:, None] & np.isfinite(step), step, 0.0)
+
+        p_new = np.clip(p + step, lo, hi)
+        f_new, jac_new, w_new, cost_new = evaluate(p_new)
+
+        better = active & (cost_new <= cost)
+        small = ((np.abs(cost - cost_new) <= tol * (1.0 + np.abs(cost)))
+                 | np.all(np.abs(p_new - p) <= 1e-6 * (np.abs(p) + 1e-6), axis=1))
+        stuck = lam >= 1e10
+        done = active & ((better & small) | stuck)
+        converged |= done & ~stuck
+
+        p[better], f[better], jac[better] = p_new[better], f_new[better], jac_new[better]
+        w[better], cost[better] = w_new[better], cost_new[better]
+        lam = np.where(better, lam * 0.3, np.minimum(lam * 10.0, 1e10))
+        active &= ~done
+        if not active.any():
+            break
+
+    # Curvature at the minimum, for the parameter errors
+    hess = np.einsum("nbi,nbj->nij", jac * w[..., None], jac)
+    return p, hess, cost, converged
+
+
+def _lm_fit(model, x, widths, y, var, mask, p0, lo, hi, method, scale, max_iter=200, tol=1e-9):
+    total = np.where(mask, y, 0.0).sum(axis=1)
+
+    def evaluate(p):
+        f, jac = expected_and_jacobian(model, x, widths, p, mask, total)
+        return (f, jac) + _weights_and_cost(y, var, f, mask, method, scale)
+
+    p, hess, _, converged = _lm(evaluate, y, p0, lo, hi, max_iter, tol)
+    cov = np.linalg.pinv(hess)
+    errors = np.sqrt(np.abs(np.diagonal(cov, axis1=1, axis2=2)))
+    return p, errors, converged
+
+
+def batch_fit(values, sumw2, edges, model="gauss", method="nll", iterations=ITERATIONS,
+              window=None, start=None):
+    """Fit `model` to every row of a (nhists, nbins) stack with the RooFit narrowing recipe.
+
+    As in iterative_gaussian_fit()/iterative_breitwigner_fit(): fit the full
+    range starting from the histogram mean and RMS, derive the narrow window
+    (mean -/+ window*width) and refit inside it. The `iterations` full-range
+    refits there all restart from the same minimum, so one fit stands in for
+    them. `method` is "nll" (binned likelihood, as RooFit's fitTo) or "chi2"
+    (Neyman, sumw2 errors). `start` optionally gives (nhists, 2) starting (mean, width).
+    Returns a dict of (nhists,) arrays.
+    """
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    sumw2 = np.atleast_2d(np.asarray(values if sumw2 is None else sumw2, dtype=float))
+    edges = np.asarray(edges, dtype=float)
+    window = WINDOW[model] if window is None else window
+    x = 0.5 * (edges[1:] + edges[:-1])
+    widths = np.diff(edges)
+    xmin, xmax = edges[0], edges[-1]
+    nhists = len(values)
+
+    # Effective number of entries per unit weight, for the likelihood errors
+    total = values.sum(axis=1)
+    total_w2 = sumw2.sum(axis=1)
+    scale = np.where(total_w2 > 0, total / np.where(total_w2 > 0, total_w2, 1.0), 1.0)
+
+    # Start values: h.GetMean(), h.GetRMS() as in the RooFit version
+    safe_total = np.where(total > 0, total, 1.0)
+    mean0 = (values * x).sum(axis=1) / safe_total
+    rms0 = np.sqrt(np.maximum((values * x**2).sum(axis=1) / safe_total - mean0**2, 0.0))
+    if start is not None:
+        mean0, rms0 = np.asarray(start, dtype=float).T
+    lo = np.array([xmin, WIDTH_RANGE[0]])
+    hi = np.array([xmax, WIDTH_RANGE[1]])
+    p = np.clip(np.stack([mean0, rms0], axis=1), lo, hi)
+
+    full = np.ones_like(values, dtype=bool)
+    if iterations > 0:
+        p, _, _ = _lm_fit(model, x, widths, values, sumw2, full, p, lo, hi, method, scale)
+
+    low = np.maximum(xmin, p[:, 0] - window * p[:, 1])
+    high = np.minimum(xmax, p[:, 0] + window * p[:, 1])
+    narrow = (x >= low[:, None]) & (x <= high[:, None])
+    p, errors, converged = _lm_fit(model, x, widths, values, sumw2, narrow, p, lo, hi, method, scale)
+
+    # chi2/ndf inside the narrow window, bins with sumw2 > 0
+    f, _ = expected_and_jacobian(model, x, widths, p, narrow, np.where(narrow, values, 0.0).sum(axis=1))
+    used = narrow & (sumw2 > 0)
+    chi2 = np.sum(np.where(used, (values - f)**2 / np.where(sumw2 > 0, sumw2, 1.0), 0.0), axis=1)
+    ndf = used.sum(axis=1) - 3   # mean, width and the normalisation
+    chi2_ndf = np.where(ndf > 0, chi2 / np.maximum(ndf, 1), np.nan)
+
+    return {"mean": p[:, 0], "mean_err": errors[:, 0], "width": p[:, 1], "width_err": errors[:, 1],
+            "chi2_ndf": chi2_ndf, "ndf": ndf, "converged": converged & (ndf > 0),
+            "low": low, "high": high}
+
+
+# -----------------
+# Gaussian with a free amplitude and unit weights, the least-squares fit of
+# v1plot_wr_mass.fit_peak() (scipy curve_fit) for a whole stack at once
+# -----------------
+def _amplitude_gauss(x, p):
+    amp, mu, sigma = p[:, 0, None], p[:, 1, None], p[:, 2, None]
+    z = (x - mu) / sigma
+    shape = np.exp(-0.5 * z**2)
+    f = amp * shape
+    return f, np.stack([shape, f * z / sigma, f * z**2 / sigma], axis=-1)
+
+
+def _lsq_fit(x, y, mask, p0):
+    # Unweighted least squares over the masked bins; cov scaled by the residual variance as curve_fit does
+    w = mask.astype(float)
+
+    def evaluate(p):
+        f, jac = _amplitude_gauss(x, p)
+        return f, jac, w, np.sum(w * (y - f)**2, axis=1)
+
+    p, hess, cost, converged = _lm(evaluate, y, p0, -np.inf, np.inf)
+    dof = mask.sum(axis=1) - p.shape[1]
+    cov = np.linalg.pinv(hess) * (cost / np.maximum(dof, 1))[:, None, None]
+    return p, cov, converged & (dof > 0) & np.all(np.isfinite(p), axis=1)
+
+
+def peak_fit(values, x, window=2.0, sigma0=200.):
+    """fit_peak() of every row of a (nhists, nbins) stack: amplitude, mean and sigma of A*exp(-z^2/2).
+
+    A full-range fit from (max, position of the max, sigma0), then a refit of
+    the bins within mean -/+ window*|sigma| starting from its result. Returns
+    a dict of (nhists, 3) "popt", (nhists, 3, 3) "pcov" and (nhists,) "converged".
+    """
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    x = np.asarray(x, dtype=float)
+    p0 = np.stack([values.max(axis=1), x[np.argmax(values, axis=1)], np.full(len(values), sigma0)], axis=1)
+    full = np.ones_like(values, dtype=bool)
+    p, _, first = _lsq_fit(x, values, full, p0)
+
+    mu, sigma = p[:, 1, None], np.abs(p[:, 2, None])
+    narrow = (x > mu - window * sigma) & (x < mu + window * sigma)
+    p, cov, converged = _lsq_fit(x, values, narrow, p)
+    return {"popt": p, "pcov": cov, "converged": first & converged}
+
+
+def fit_table(labels, values, sumw2, edges, models=MODELS, method="nll", iterations=ITERATIONS):
+    # One row per (histogram, model), columns as in TABLE_COLUMNS
+    rows = []
+    for model in models:
+        res = batch_fit(values, sumw2, edges, model, method, iterations)
+        for i, label in enumerate(labels):
+            wr, n = mass_point(label)
+            rows.append({"label": label, "wr": wr, "n": n, "model": model,
+                         **{k: res[k][i].item() for k in TABLE_COLUMNS[4:]}})
+    return rows
+
+
+def write_table(rows, path, columns=TABLE_COLUMNS):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+# -----------------
+# Poisson toys: every histogram fluctuated `ntoys` times, all toys refitted in one batch
+# -----------------
+def poisson_toys(values, sumw2):
+    # (n_eff, scale) of scale * Poisson(n_eff) toys: the content and variance of every bin on average
+    filled = (values > 0) & (sumw2 > 0)
+    n_eff = np.where(filled, values**2 / np.where(filled, sumw2, 1.0), 0.0)
+    scale = np.where(filled, sumw2 / np.where(filled, values, 1.0), 0.0)
+    return n_eff, scale
+
+
+def toy_study(values, sumw2, edges, model="gauss", ntoys=1000, rng=None, method="nll"):
+    """Bias and spread of the fitted parameters over `ntoys` Poisson toys of every histogram in a stack.
+
+    Weighted bins are fluctuated as scale * Poisson(n_eff), with n_eff =
+    values^2 / sumw2 effective entries and scale = sumw2 / values, so a toy bin
+    has the content and variance of the original on average. The toys of all
+    histograms go through batch_fit() together (TOY_CHUNK at a time) and are
+    compared to the fit of the original histogram, which is their truth. Toys
+    whose fit did not converge are left out. Returns {param: {column: (nhists,)
+    array}} for the TOY_PARAMS and the TOY_COLUMNS from "nominal" on.
+    """
+    values = np.atleast_2d(np.asarray(values, dtype=float))
+    sumw2 = np.atleast_2d(np.asarray(values if sumw2 is None else sumw2, dtype=float))
+    rng = np.random.default_rng(rng)
+    nhists = len(values)
+    nominal = batch_fit(values, sumw2, edges, model, method)
+
+    n_eff, scale = poisson_toys(values, sumw2)
+    fitted = np.full((nhists * ntoys, 2), np.nan)
+    for lo in range(0, nhists * ntoys, TOY_CHUNK):
+        rows = np.arange(lo, min(lo + TOY_CHUNK, nhists * ntoys)) // ntoys   # histogram of each toy
+        counts = rng.poisson(n_eff[rows])
+        res = batch_fit(scale[rows] * counts, scale[rows]**2 * counts, edges, model, method)
+        fitted[lo:lo + len(rows)] = np.where(res["converged"][:, None],
+                                             np.stack([res["mean"], res["width"]], axis=1), np.nan)
+    fitted = fitted.reshape(nhists, ntoys, 2)
+
+    return toy_summary(nominal["mean"], nominal["mean_err"], nominal["width"], nominal["width_err"], fitted)
+
+
+def toy_summary(mean, mean_err, width, width_err, fitted):
+    # {param: {column: (nhists,) array}} from the nominal fits and the (nhists, ntoys, 2) toy (mean, width)
+    res_err = (width / mean) * np.hypot(width_err / width, mean_err / mean)
+    params = {"mean": (mean, mean_err, fitted[..., 0]),
+              "width": (width, width_err, fitted[..., 1]),
+              "resolution": (width / mean, res_err, fitted[..., 1] / fitted[..., 0])}
+    summary = {}
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", RuntimeWarning)   # histograms without any converged toy give NaN
+        for param, (value, err, toys) in params.items():
+            toy_mean = np.nanmean(toys, axis=1)
+            spread = np.nanstd(toys, axis=1, ddof=1)
+            summary[param] = {"nominal": value, "fit_err": err, "toy_mean": toy_mean, "bias": toy_mean - value,
+                              "spread": spread, "fit_err_over_spread": err / spread,
+                              "toys": np.isfinite(toys).sum(axis=1)}
+    return summary
+
+
+def toy_table(labels, values, sumw2, edges, ntoys=1000, rng=None, models=MODELS, method="nll"):
+    # One row per (histogram, model, parameter), columns as in TOY_COLUMNS
+    rng = np.random.default_rng(rng)
+    rows = []
+    for model in models:
+        rows += toy_rows(labels, model, toy_study(values, sumw2, edges, model, ntoys, rng, method))
+    return rows
+
+
+def toy_rows(labels, model, summary):
+    rows = []
+    for i, label in enumerate(labels):
+        wr, n = mass_point(label)
+        for param in TOY_PARAMS:
+            rows.append({"label": label, "wr": wr, "n": n, "model": model, "param": param,
+                         **{k: np.asarray(summary[param][k])[i].item() for k in TOY_COLUMNS[5:]}})
+    return rows
+
+
+def print_toy_table(rows, ntoys):
+    names = {("gauss", "width"): "sigma", ("bw", "width"): "Gamma", ("gauss", "resolution"): "sigma/mu",
+             ("bw", "resolution"): "Gamma/mu"}
+    for row in rows:
+        name = names.get((row["model"], row["param"]), "mu")
+        digits = 4 if row["param"] == "resolution" else 1
+        print(f"{row['label']}: {row['model']:5s} {name:8s} = {row['nominal']:.{digits}f} +- {row['fit_err']:.{digits}f}"
+              f" (fit), toys: bias {row['bias']:+.{digits}f}, spread {row['spread']:.{digits}f}"
+              f" ({row['toys']}/{ntoys} converged)")
+
+
+# -----------------
+# Main
+# -----------------
+def main():
+    parser = argparse.ArgumentParser(description="Batched Gaussian / Breit-Wigner fits of m_lljj for many signal points")
+    parser.add_argument("files", nargs="+", help="Input ROOT files")
+    parser.add_argument("--histdir", default="wr_ee_resolved_sr")
+    parser.add_argument("--histname", default="mass_fourobject_wr_ee_resolved_sr")
+    parser.add_argument("--rebin-width", type=float, default=DEFAULT_WIDTH)
+    parser.add_argument("--method", choices=["nll", "chi2"], default="nll",
+                        help="binned likelihood (default, as RooFit) or Neyman chi2")
+    parser.add_argument("--output", default="wr_mass_fits.csv")
+    parser.add_argument("--toys", type=int, default=0, metavar="N",
+                        help="also fit N Poisson toys of every histogram and report bias and spread of the parameters")
+    parser.add_argument("--toy-output", default="wr_mass_toys.csv", help="--toys result table (default wr_mass_toys.csv)")
+    parser.add_argument("--seed", type=int, default=1, help="--toys random seed (default 1)")
+    parser.add_argument("--store", help="read histograms from this memory-mapped store (hist_store.py) instead of the ROOT files")
+    parser.add_argument("--trace", metavar="OUT.json",
+                        help="write a Chrome trace of the open/get/rebin/fit/draw/SaveAs stages and print the hot spots")
+    parser.add_argument("--shard", type=parse_shard, metavar="i/N",
+                        help="fit only piece i of N (0-based) of the files, for job arrays; the tables get a "
+                             ".shard-i-of-N suffix, merge and check them with sharding.py")
+    parser.add_argument("--shard-dir", default=SHARD_DIR, help=f"where --shard writes its manifest (default {SHARD_DIR})")
+    args = parser.parse_args()
+    with tracing(args.trace):
+        key = (args.histdir, args.histname)
+        files = shard_items(args.files, args.shard)
+        labels, hists, missing = [], [], []
+        for filename in files:
+            try:
+                h = (open_store(args.store).read if args.store else read_arrays)(filename, [key])[key]
+            except RuntimeError as err:
+                print(err)
+                missing.append(filename)
+                continue
+            if h is None:
+                print(f"Histogram {args.histdir}/{args.histname} not found in {filename}")
+                missing.append(filename)
+                continue
+            labels.append(filename)
+            hists.append(h)
+
+        # Stack histograms with the same binning, rebin each stack in one call and fit it
+        t0 = time.perf_counter()
+        groups = {}
+        for label, h in zip(labels, hists):
+            groups.setdefault(tuple(h.edges), []).append((label, h))
+        rows, toy_rows = [], []
+        rng = np.random.default_rng(shard_seed(args.seed, args.shard))
+        for members in groups.values():
+            values, sumw2, edges = stack_hists([h for _, h in members])
+            values, sumw2, edges = rebin(values, sumw2, edges, args.rebin_width)
+            with stage("fit", hists=len(members)):
+                rows += fit_table([label for label, _ in members], values, sumw2, edges, method=args.method)
+            if args.toys > 0:
+                with stage("fit", hists=len(members), toys=args.toys):
+                    toy_rows += toy_table([label for label, _ in members], values, sumw2, edges, args.toys, rng,
+                                          method=args.method)
+        elapsed = time.perf_counter() - t0
+
+        for row in rows:
+            print(f"{row['label']}: {row['model']:5s} mean = {row['mean']:.1f} +- {row['mean_err']:.1f}, "
+                  f"width = {row['width']:.1f} +- {row['width_err']:.1f}, chi2/ndf = {row['chi2_ndf']:.2f}")
+        tables = {args.output: shard_path(args.output, args.shard)}
+        write_table(rows, tables[args.output])
+        if args.toys > 0:
+            print_toy_table(toy_rows, args.toys)
+            tables[args.toy_output] = shard_path(args.toy_output, args.shard)
+            write_table(toy_rows, tables[args.toy_output], TOY_COLUMNS)
+            print(f"Saved {tables[args.toy_output]}")
+        print(f"Fitted {len(labels)} histograms x {len(MODELS)} models"
+              + (f" and {args.toys} toys of each" if args.toys > 0 else "")
+              + f" in {elapsed:.2f} s, saved {tables[args.output]}")
+        if args.shard:
+            write_manifest("batch-fit", args.shard, args.files, files, missing, tables, shard_dir=args.shard_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+import argparse
+import fnmatch
+import glob
+import importlib
+import importlib.util
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+STAGES = ["open", "get", "rebin", "fit", "draw", "saveas"]
+DEFAULT_BASELINE = "benchmark_baseline.json"
+RESULT_MARKER = "BENCHMARK_RESULT "
+
+ENTRY_POINTS = {
+    "diffkinem": "diffKinem_CRvsSR_rooFit_plot",
+    "signal-overlay": "v1_signal_diffkinem",
+    "fit": "rooFit_plot_Wrmass_BW",
+    "v1plot": "v1plot_wr_mass",
+    "batch-fit": "batch_fit",
+}
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATA = os.path.join(HERE, "data", "inputfiles")
+JSONS = os.path.join(HERE, "data", "jsons")
+
+
+# -----------------
+# Benchmark cases: name -> (entry point, its arguments, needs PyROOT)
+# -----------------
+def bundled_cases():
+    dy = os.path.join(DATA, "WRAnalyzer_DYJets.root")
+    signal_wr2000 = [os.path.join(DATA, f"WRAnalyzer_signal_WR2000_N{n}.root") for n in (400, 800, 1900)]
+    signal_all = sorted(glob.glob(os.path.join(DATA, "WRAnalyzer_signal_WR*_N*.root")))
+    hists, hists_signal = os.path.join(JSONS, "hists.json"), os.path.join(JSONS, "hists_signal.json")
+    return {
+        "diffkinem-root": ("diffkinem", [dy, hists], True),
+        "diffkinem-uproot": ("diffkinem", ["--backend", "uproot", dy, hists], False),
+        "overlay-root": ("signal-overlay", signal_wr2000 + [hists_signal], True),
+        "overlay-uproot": ("signal-overlay", ["--backend", "uproot"] + signal_wr2000 + [hists_signal], False),
+        "fit-root": ("fit", ["--no-cache", os.path.join(DATA, "WRAnalyzer_signal_WR3200_N800.root")], True),
+        "v1plot": ("v1plot", ["--no-cache", "--output", "overlay.pdf"] + signal_all, False),
+        "batch-fit": ("batch-fit", signal_all, False),
+    }
+
+
+def synthetic_cases(directory):
+    files = sorted(glob.glob(os.path.join(directory, "WRAnalyzer_signal_WR*_N*.root")))
+    if not files:
+        raise RuntimeError(f"No synthetic files in {directory}, create them with --generate {directory}")
+    config = os.path.join(directory, "synthetic_signal.json")
+    return {
+        "synthetic-diffkinem-uproot": ("diffkinem", ["--backend", "uproot", files[0], os.path.join(JSONS, "hists.json")], False),
+        "synthetic-overlay-uproot": ("signal-overlay", ["--backend", "uproot"] + files[:4] + [config], False),
+        "synthetic-overlay-root": ("signal-overlay", files[:4] + [config], True),
+        "synthetic-batch-fit": ("batch-fit", files, False),
+        "synthetic-fit-scan": ("fit", ["--no-cache", "--scan", directory], True),
+    }
+
+
+# -----------------
+# Synthetic analyzer files: finer binning, more histograms, a grid of mass points
+# -----------------
+def _write_th1(f, path, values, sumw2, edges, entries):
+    from uproot.writing.identify import to_TAxis, to_TH1x
+
+    x = 0.5 * (edges[1:] + edges[:-1])
+    axis = to_TAxis("xaxis", "", len(values), edges[0], edges[-1], edges)
+    pad = lambda a: np.concatenate([[0.], a, [0.]])   # under/overflow
+    f[path] = to_TH1x(path.rpartition("/")[2], "", pad(values), entries, values.sum(), sumw2.sum(),
+                      (values * x).sum(), (values * x**2).sum(), pad(sumw2), axis)
+
+
+def generate_synthetic(directory, template, wr_masses, n_fractions, fine=2, copies=2, events=20000, seed=1):
+    """Write WRAnalyzer_signal_WR<wr>_N<n>.root files shaped like `template`.
+
+    Every histogram gets `fine` times as many bins and `copies` variants
+    (name, name_v1, ...). m_lljj is a Gaussian peak at M_WR with a low-mass
+    tail, everything else keeps the template shape; contents are weighted
+    multinomial draws of `events` events, so sumw2 is meaningful.
+    """
+    import uproot
+    from hist_loader import read_arrays
+    from hist_index import load_index
+
+    rng = np.random.default_rng(seed)
+    index = load_index(template)
+    keys = [(d, name) for d, hists in index.items() for name in hists]
+    hists = read_arrays(template, keys)
+    os.makedirs(directory, exist_ok=True)
+
+    written = []
+    for wr in wr_masses:
+        for frac in n_fractions:
+            n = int(round(wr * frac / 100.)) * 100
+            filename = os.path.join(directory, f"WRAnalyzer_signal_WR{wr}_N{n}.root")
+            with uproot.recreate(filename) as f:
+                for (hdir_str, histname), h in hists.items():
+                    nbins = len(h.values)
+                    edges = np.interp(np.arange(nbins * fine + 1) / fine, np.arange(nbins + 1), h.edges)
+                    x = 0.5 * (edges[1:] + edges[:-1])
+                    if histname.startswith("mass_fourobject"):
+                        core = np.exp(-0.5 * ((x - wr) / (0.05 * wr))**2)
+                        tail = np.where(x < wr, np.exp((x - wr) / (0.3 * wr)), 0.)
+                        shape = 0.85 * core / max(core.sum(), 1e-300) + 0.15 * tail / max(tail.sum(), 1e-300)
+                    else:
+                        shape = np.repeat(np.clip(h.values, 0., None), fine)
+                    if shape.sum() <= 0:
+                        shape = np.ones_like(x)
+                    weight = max(h.values.sum(), 1e-6) / events
+                    for copy in range(copies):
+                        counts = rng.multinomial(events, shape / shape.sum()).astype(float)
+                        name = histname if copy == 0 else f"{histname}_v{copy}"
+                        _write_th1(f, f"{hdir_str}/{name}", counts * weight, counts * weight**2, edges, events)
+            written.append(filename)
+            print(f"Wrote {filename}")
+
+    # Overlay config for the synthetic files: the signal config plus its copies
+    with open(os.path.join(JSONS, "hists_signal.json")) as f:
+        signal_configs = json.load(f)
+    configs = [dict(cfg, histname=cfg["histname"] if copy == 0 else f"{cfg['histname']}_v{copy}")
+               for copy in range(copies) for cfg in signal_configs]
+    with open(os.path.join(directory, "synthetic_signal.json"), "w") as f:
+        json.dump(configs, f, indent=1)
+    return written
+
+
+# -----------------
+# Running one case: in a child process, so that peak RSS and stage totals are its own
+# -----------------
+def run_child(entry, argv):
+    from stage_timer import stage_totals
+
+    module = importlib.import_module(ENTRY_POINTS[entry])
+    t0 = time.perf_counter()
+    if hasattr(module, "cli"):
+        status = module.cli(argv)
+    else:
+        sys.argv = [module.__file__] + argv
+        try:
+            status = module.main()
+        except SystemExit as exc:
+            status = exc.code
+    wall = time.perf_counter() - t0
+    stages = {name: total["seconds"] for name, total in stage_totals().items()}
+    result = {"status": status or 0, "wall": wall, "stages": stages,
+              "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.}
+    print(RESULT_MARKER + json.dumps(result))
+
+
+def run_case(name, entry, argv, workdir, verbose=False):
+    cmd = [sys.executable, os.path.abspath(__file__), "--child", entry, json.dumps(argv)]
+    proc = subprocess.run(cmd, cwd=workdir, capture_output=True, text=True)
+    if verbose:
+        sys.stdout.write(proc.stdout)
+    lines = [line for line in proc.stdout.splitlines() if line.startswith(RESULT_MARKER)]
+    if proc.returncode != 0 or not lines:
+        tail = "\n".join((proc.stdout + proc.stderr).splitlines()[-20:])
+        raise RuntimeError(f"Benchmark {name} failed (exit code {proc.returncode}):\n{tail}")
+    return json.loads(lines[-1][len(RESULT_MARKER):])
+
+
+def run_cases(cases, repeat=1, verbose=False):
+    # Best (lowest wall time) of `repeat` runs per case, each in a fresh scratch directory
+    have_root = importlib.util.find_spec("ROOT") is not None
+    results = {}
+    for name, (entry, argv, needs_root) in cases.items():
+        if needs_root and not have_root:
+            print(f"{name}: skipped, PyROOT not available")
+            continue
+        runs = []
+        for _ in range(repeat):
+            workdir = tempfile.mkdtemp(prefix="wr_bench_")
+            try:
+                runs.append(run_case(name, entry, argv, workdir, verbose))
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+        best = min(runs, key=lambda r: r["wall"])
+        best["max_rss_mb"] = max(r["max_rss_mb"] for r in runs)
+        results[name] = best
+        print(f"{name}: {best['wall']:.2f} s, peak RSS {best['max_rss_mb']:.0f} MB")
+    return results
+
+
+# -----------------
+# Reporting and baseline comparison
+# -----------------
+def print_table(results):
+    header = f"{'case':30s} {'wall':>7s} " + " ".join(f"{s:>7s}" for s in STAGES + ["other"]) + f" {'RSS MB':>7s}"
+    print(header)
+    print("-" * len(header))
+    for name, r in results.items():
+        stages = [r["stages"].get(s, 0.) for s in STAGES]
+        other = r["wall"] - sum(r["stages"].values())
+        print(f"{name:30s} {r['wall']:7.2f} " + " ".join(f"{t:7.3f}" for t in stages + [other])
+              + f" {r['max_rss_mb']:7.0f}")
+
+
+def compare(results, baseline, threshold=0.25, rss_threshold=0.25, min_seconds=0.05):
+    """Regressions of `results` against `baseline` as a list of messages.
+
+    Wall time and every stage may grow by `threshold` (relative) and RSS by
+    `rss_threshold`; time differences below `min_seconds` are noise.
+    """
+    regressions = []
+    for name, r in results.items():
+        old = baseline["cases"].get(name)
+        if old is None:
+            continue
+        timings = [("wall", r["wall"], old["wall"])]
+        timings += [(s, r["stages"].get(s, 0.), old["stages"].get(s, 0.)) for s in STAGES]
+        for label, new_t, old_t in timings:
+            if new_t - old_t > max(min_seconds, threshold * old_t):
+                change = f"+{100 * (new_t / old_t - 1):.0f}%" if old_t > 0 else "new"
+                regressions.append(f"{name} {label}: {new_t:.3f} s vs {old_t:.3f} s ({change})")
+        if r["max_rss_mb"] > old["max_rss_mb"] * (1 + rss_threshold):
+            regressions.append(f"{name} peak RSS: {r['max_rss_mb']:.0f} MB vs {old['max_rss_mb']:.0f} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the plotting and fitting entry points stage by stage")
+    parser.add_argument("--cases", default="*", help="glob of case names to run (default all)")
+    parser.add_argument("--synthetic", metavar="DIR", help="also run the synthetic cases on the files in DIR")
+    parser.add_argument("--generate", metavar="DIR", help="write synthetic analyzer files to DIR and exit")
+    parser.add_argument("--template", default=os.path.join(DATA, "WRAnalyzer_signal_WR2000_N800.root"),
+                        help="analyzer file the synthetic files are shaped like")
+    parser.add_argument("--wr-masses", type=int, nargs="+", default=list(range(1000, 7000, 1000)))
+    parser.add_argument("--n-fractions", type=float, nargs="+", default=[0.25, 0.5, 0.75])
+    parser.add_argument("--fine", type=int, default=2, help="synthetic bins per template bin (default 2)")
+    parser.add_argument("--copies", type=int, default=2, help="variants of every template histogram (default 2)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per case, the fastest counts (default 1)")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help=f"baseline file (default {DEFAULT_BASELINE})")
+    parser.add_argument("--save-baseline", action="store_true", help="store these results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed relative slowdown (default 0.25)")
+    parser.add_argument("--rss-threshold", type=float, default=0.25, help="allowed relative RSS growth (default 0.25)")
+    parser.add_argument("--min-seconds", type=float, default=0.05, help="ignore time differences below this (default 0.05)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="show the output of the benchmarked scripts")
+    parser.add_argument("--child", nargs=2, metavar=("ENTRY", "ARGV"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child[0], json.loads(args.child[1]))
+        return 0
+    if args.generate:
+        generate_synthetic(args.generate, args.template, args.wr_masses, args.n_fractions, args.fine, args.copies)
+        return 0
+
+    cases = bundled_cases()
+    if args.synthetic:
+        cases.update(synthetic_cases(os.path.abspath(args.synthetic)))
+    cases = {name: case for name, case in cases.items() if fnmatch.fnmatch(name, args.cases)}
+    results = run_cases(cases, args.repeat, args.verbose)
+    print()
+    print_table(results)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump({"machine": platform.node(), "python": platform.python_version(),
+                       "date": time.strftime("%Y-%m-%d %H:%M"), "cases": results}, f, indent=1)
+        print(f"\nSaved baseline {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"\nNo baseline {args.baseline} to compare with (create it with --save-baseline)")
+        return 0
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    regressions = compare(results, baseline, args.threshold, args.rss_threshold, args.min_seconds)
+    print(f"\nCompared with {args.baseline} ({baseline.get('machine')}, {baseline.get('date')})")
+    for message in regressions:
+        print(f"REGRESSION {message}")
+    if not regressions:
+        print("No regressions")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+
+import argparse
+import hashlib
+import json
+import os
+import re
+import sys
+
+from config_plan import load_configs
+from hist_index import check_configs, report_problems
+from hist_loader import config_keys
+from parallel_render import run_tasks
+from sharding import SHARD_DIR, parse_shard, shard_items, write_manifest
+from stage_timer import tracing
+
+DEFAULT_MANIFEST = "build_manifest.json"
+STATE_FILE = ".build_state.json"
+
+# Every module a target's output depends on (reading, configs, rebinning, fitting, drawing);
+# the dispatch and timing layers (parallel_render, sharding, stage_timer) do not change an output
+READ_SOURCES = ["hist_loader.py", "hist_store.py", "hist_index.py", "rebinning.py"]
+SCRIPT_SOURCES = {
+    "diffkinem": ["diffKinem_CRvsSR_rooFit_plot.py", "config_plan.py", "plot_books.py", "output_fingerprint.py"]
+                 + READ_SOURCES,
+    "signal-overlay": ["v1_signal_diffkinem.py", "config_plan.py", "plot_books.py", "output_fingerprint.py"]
+                      + READ_SOURCES,
+    "fit": ["rooFit_plot_Wrmass_BW.py", "fit_cache.py", "batch_fit.py", "event_fit.py"] + READ_SOURCES,
+}
+UPROOT_SOURCES = ["mpl_plots.py"]
+FIT_HIST = {"hdir_str": "wr_ee_resolved_sr", "histname": "mass_fourobject_wr_ee_resolved_sr"}   # as rooFit_plot_Wrmass_BW.py
+
+
+# -----------------
+# Fingerprints
+# -----------------
+def sha256_file(path):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def sha256_json(obj):
+    return hashlib.sha256(json.dumps(obj, sort_keys=True).encode()).hexdigest()
+
+
+class Fingerprints:
+    # File content hashes, only recomputed when size or mtime changed since the last build
+    def __init__(self, known):
+        self.known = known
+        self.seen = {}
+
+    def __call__(self, path):
+        if path not in self.seen:
+            if not os.path.exists(path):
+                raise RuntimeError(f"Could not find build input {path}")
+            st = os.stat(path)
+            entry = self.known.get(path)
+            if not entry or entry["size"] != st.st_size or entry["mtime_ns"] != st.st_mtime_ns:
+                entry = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": sha256_file(path)}
+            self.seen[path] = entry
+        return self.seen[path]["sha256"]
+
+
+# -----------------
+# Manifest -> build units (one render call each) with their outputs and dependencies
+# -----------------
+def fit_mass_str(filename):
+    # as fit_and_plot() in rooFit_plot_Wrmass_BW.py
+    match = re.search(r"_WR(\d+)_", filename)
+    return match.group(1) if match else "Unknown"
+
+
+def unit_outputs(script, cfg=None, filename=None):
+    # Output file names, exactly as the scripts write them
+    if script == "diffkinem":
+        return [f"SRvsCR_{cfg['op_str']}_{cfg['histname']}_norm.png"]
+    if script == "signal-overlay":
+        index = cfg.get("index")
+        outname = f"plot_{index}" if index is not None else f"overlay_{cfg['histname']}_diffWR"
+        return [outname + ".png", outname + ".pdf"]
+    if script == "fit":
+        mass_str = fit_mass_str(filename)
+        return [f"wr_mass_gauss_WR{mass_str}.png", f"wr_mass_bw_WR{mass_str}.png"]
+    raise ValueError(f"Unknown build script {script}, expected one of: {', '.join(SCRIPT_SOURCES)}")
+
+
+def plan(manifest, fingerprint, backend="root"):
+    """Expand the manifest into build units.
+
+    Each unit is a dict with a label, the render arguments, its outputs
+    (relative to the project directory) and its dependencies: the content hash
+    of every input file, of the config entry and of the script sources.
+    """
+    units = []
+    owners = {}
+    for n, step in enumerate(manifest["steps"]):
+        script, outdir = step["script"], step.get("outdir", ".")
+        sources = SCRIPT_SOURCES[script] + (UPROOT_SOURCES if backend == "uproot" and script != "fit" else [])
+        script_hash = sha256_json([fingerprint(src) for src in sources])
+
+        if script == "fit":
+            entries = [(filename, None, [filename]) for filename in step["inputs"]]
+            keys = None
+        else:
+            fingerprint(step["config"])
+            hist_configs = load_configs(step["config"], step.get("channels"), step.get("regions"))
+            keys = config_keys(hist_configs)
+            if script == "diffkinem":
+                entries = [(filename, cfg, [filename]) for filename in step["inputs"] for cfg in hist_configs]
+            else:
+                entries = [(None, cfg, step["inputs"]) for cfg in hist_configs]
+
+        for filename, cfg, inputs in entries:
+            outputs = [os.path.normpath(os.path.join(outdir, name)) for name in unit_outputs(script, cfg, filename)]
+            label = f"step {n} {script} {outputs[0]}"
+            for out in outputs:
+                if out in owners:
+                    raise RuntimeError(f"{out} is built by both '{owners[out]}' and '{label}'; give one step its own outdir")
+                owners[out] = label
+            deps = {"script": script_hash,
+                    "entry": sha256_json(cfg),
+                    "inputs": {path: fingerprint(path) for path in inputs},
+                    "backend": backend}
+            args = (os.path.abspath(filename) if filename else [os.path.abspath(p) for p in inputs], cfg, keys)
+            units.append({"label": label, "script": script, "outdir": outdir, "args": args,
+                          "outputs": outputs, "deps": deps})
+    return units
+
+
+def stale_reason(unit, targets):
+    # Why a unit has to be rebuilt, or None if all its outputs are up to date
+    for out in unit["outputs"]:
+        if not os.path.exists(out):
+            return f"missing {out}"
+        old = targets.get(out)
+        if old is None:
+            return "no build record"
+        new = unit["deps"]
+        changed = [path for path, sha in new["inputs"].items() if old["inputs"].get(path) != sha]
+        if changed or old["inputs"].keys() != new["inputs"].keys():
+            return "input changed: " + ", ".join(changed or sorted(old["inputs"].keys() ^ new["inputs"].keys()))
+        if old["entry"] != new["entry"]:
+            return "config entry changed"
+        if old["script"] != new["script"]:
+            return "script changed"
+        if old["backend"] != new["backend"]:
+            return "backend changed"
+    return None
+
+
+# -----------------
+# Rendering, one unit per task
+# -----------------
+def build_unit(script, outdir, args, backend="root", force=False):
+    if script == "diffkinem":
+        import diffKinem_CRvsSR_rooFit_plot as module
+    elif script == "signal-overlay":
+        import v1_signal_diffkinem as module
+    else:
+        import rooFit_plot_Wrmass_BW as module
+        from fit_cache import DEFAULT_DIR, FitCache
+        cache = FitCache(os.path.abspath(DEFAULT_DIR))
+
+    # Scripts write to the working directory; inputs are absolute paths
+    cwd = os.getcwd()
+    os.makedirs(outdir, exist_ok=True)
+    os.chdir(outdir)
+    try:
+        inputs, cfg, keys = args
+        if script == "fit":
+            module.fit_and_plot(inputs, cache=cache)
+        else:
+            module.render_config(inputs, cfg, keys, backend, force=force)
+    finally:
+        os.chdir(cwd)
+
+
+def load_state(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"files": {}, "targets": {}}
+
+
+def save_state(state, path):
+    tmp = path + f".{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(state, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
+
+
+def write_shard(args, all_units, units, failures, built, fingerprint):
+    write_manifest("build", args.shard, [u["label"] for u in all_units], [u["label"] for u in units], failures,
+                   extra={"build_state": {"state_file": os.path.abspath(STATE_FILE), "files": fingerprint.seen,
+                                          "targets": built}},
+                   shard_dir=args.shard_dir)
+
+
+# -----------------
+# Main
+# -----------------
+def main():
+    parser = argparse.ArgumentParser(description="Rebuild only the plots whose inputs, config entry or script changed")
+    parser.add_argument("--manifest", default=DEFAULT_MANIFEST, help=f"build manifest (default {DEFAULT_MANIFEST})")
+    parser.add_argument("-n", "--dry-run", action="store_true", help="list what would be rebuilt and why, draw nothing")
+    parser.add_argument("--force", action="store_true", help="rebuild every target")
+    parser.add_argument("--jobs", type=int, default=1, help="number of worker processes (default 1)")
+    parser.add_argument("--trace", metavar="OUT.json",
+                        help="write a Chrome trace of the open/get/rebin/fit/draw/SaveAs stages and print the hot spots")
+    parser.add_argument("--backend", choices=["root", "uproot"], default="root",
+                        help="draw fit-free plots with PyROOT (default) or uproot + matplotlib; fits always use RooFit")
+    parser.add_argument("--shard", type=parse_shard, metavar="i/N",
+                        help="build only piece i of N (0-based) of the planned render calls, for job arrays; the "
+                             "state is kept in the shard manifest until sharding.py merges it")
+    parser.add_argument("--shard-dir", default=SHARD_DIR, help=f"where --shard writes its manifest (default {SHARD_DIR})")
+    args = parser.parse_args()
+
+    with open(args.manifest, "r") as f:
+        manifest = json.load(f)
+    state = load_state(STATE_FILE)
+    fingerprint = Fingerprints(state["files"])
+    all_units = plan(manifest, fingerprint, args.backend)
+    # The split is over the whole plan, up-to-date units included, so it is the same in every job
+    units = shard_items(all_units, args.shard)
+
+    todo = []
+    for unit in units:
+        reason = "forced" if args.force else stale_reason(unit, state["targets"])
+        if reason:
+            todo.append(unit)
+            if args.dry_run:
+                print(f"{' '.join(unit['outputs'])}: {reason}")
+    n_targets = sum(len(u["outputs"]) for u in units)
+    n_todo = sum(len(u["outputs"]) for u in todo)
+    print(f"{n_todo}/{n_targets} targets out of date ({len(todo)}/{len(units)} render calls)")
+    if args.dry_run:
+        return 0
+    if not todo:
+        if args.shard:
+            write_shard(args, all_units, units, [], {}, fingerprint)
+        return 0
+
+    backend = {"fit": "root"}
+    # Check what is about to be drawn against the histogram indexes first
+    problems = []
+    for u in todo:
+        inputs, cfg, _ = u["args"]
+        problems += check_configs(inputs if isinstance(inputs, list) else [inputs], [cfg or FIT_HIST])
+    if report_problems(problems):
+        return 1
+
+    tasks = [(u["label"], (u["script"], u["outdir"], u["args"], backend.get(u["script"], args.backend), args.force))
+             for u in todo]
+    with tracing(args.trace):
+        failures = set(run_tasks(build_unit, tasks, args.jobs))
+
+    # Record only what was really built, failed targets stay out of date
+    built = {out: unit["deps"] for unit in todo
+             if unit["label"] not in failures and all(os.path.exists(out) for out in unit["outputs"])
+             for out in unit["outputs"]}
+    if args.shard:
+        # Shards running at the same time must not rewrite the state file, the merge does it once
+        write_shard(args, all_units, units, sorted(failures), built, fingerprint)
+    else:
+        state["files"].update(fingerprint.seen)
+        state["targets"].update(built)
+        save_state(state, STATE_FILE)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+
+from hist_loader import config_keys, group_keys
+
+# -----------------
+# Templated configs: channel x region x variable, expanded into the JSON list format
+# -----------------
+# {
+#   "channels": {"ee": {"lepton": "e"}, "mumu": {"lepton": "#mu"}},   (or a plain list of names)
+#   "regions": {"dy_cr": {"op_str": "DyJets", "hdir_str": "wr_{channel}_resolved_sr",
+#                         "hdir_cr_str": "wr_{channel}_resolved_dy_cr"}, ...},
+#   "variables": [{"name": "mass_fourobject", "xaxis_title": "m_{{channel}jj} [GeV]"}, ...]
+# }
+# {channel} and every per-channel value ({lepton}) are replaced in the directories
+# and titles; histograms are named <variable>_<directory>. Regions without
+# hdir_cr_str give single-directory entries (signal overlays). Other keys of a
+# variable (rebin_width, rebin_edges, index) are copied into its entries.
+TEMPLATE_KEYS = ("channels", "regions", "variables")
+
+
+def _fill(text, values):
+    # str.format would trip over the TLatex braces
+    for name, value in values.items():
+        text = text.replace("{" + name + "}", value)
+    return text
+
+
+def expand_template(template, channels=None, regions=None):
+    """Config entries for every channel x region x variable of a template, in that order.
+
+    `channels` and `regions` optionally select by name.
+    """
+    missing = [key for key in TEMPLATE_KEYS if key not in template]
+    if missing:
+        raise RuntimeError(f"Config template without {', '.join(missing)}")
+    all_channels = template["channels"]
+    if isinstance(all_channels, list):
+        all_channels = {name: {} for name in all_channels}
+    for asked, known, what in ((channels, all_channels, "channel"), (regions, template["regions"], "region")):
+        unknown = [name for name in asked or [] if name not in known]
+        if unknown:
+            raise RuntimeError(f"Unknown {what} {', '.join(unknown)} in the config template, "
+                               f"expected one of: {', '.join(known)}")
+
+    entries = []
+    for channel, channel_values in all_channels.items():
+        if channels and channel not in channels:
+            continue
+        values = {"channel": channel, **channel_values}
+        for region, spec in template["regions"].items():
+            if regions and region not in regions:
+                continue
+            hdir = _fill(spec["hdir_str"], values)
+            hdir_cr = _fill(spec["hdir_cr_str"], values) if "hdir_cr_str" in spec else None
+            for var in template["variables"]:
+                entry = {"histname": f"{var['name']}_{hdir}"}
+                if hdir_cr:
+                    entry["histname1"] = f"{var['name']}_{hdir_cr}"
+                entry["hdir_str"] = hdir
+                if hdir_cr:
+                    entry["hdir_cr_str"] = hdir_cr
+                entry["op_str"] = spec["op_str"]
+                entry["xaxis_title"] = _fill(var["xaxis_title"], values)
+                entry.update({k: v for k, v in var.items() if k not in ("name", "xaxis_title")})
+                entries.append(entry)
+    return entries
+
+
+def load_configs(path, channels=None, regions=None):
+    # A JSON list of config entries as before, or a template expanded into one
+    with open(path, "r") as f:
+        configs = json.load(f)
+    if isinstance(configs, list):
+        if channels or regions:
+            raise RuntimeError(f"{path} is a plain list of config entries, channels and regions select from templates only")
+        return configs
+    try:
+        return expand_template(configs, channels, regions)
+    except (KeyError, TypeError) as err:
+        raise RuntimeError(f"Malformed config template {path}: {err!r}")
+
+
+# -----------------
+# Execution plan: the entries to render and the histograms to read, grouped by directory
+# -----------------
+def build_plan(files, hist_configs):
+    """What a run of `hist_configs` over `files` renders and reads.
+
+    "reads" maps every directory to the distinct histograms wanted from it;
+    each input file is read in one pass per directory (in file order, see
+    hist_loader.read_histograms()) instead of one lookup per config entry.
+    """
+    keys = config_keys(hist_configs)
+    return {"files": list(files), "entries": hist_configs, "reads": group_keys(keys), "lookups": len(keys)}
+
+
+def plan_keys(plan):
+    # The plan's reads as (hdir_str, histname) keys, directory by directory
+    return [(hdir_str, histname) for hdir_str, names in plan["reads"].items() for histname in names]
+
+
+def explain(plan, source=""):
+    entries, reads = plan["entries"], plan["reads"]
+    n_hists = sum(len(names) for names in reads.values())
+    print(f"Plan{' for ' + source if source else ''}: {len(entries)} config entries, {len(plan['files'])} input files")
+    print(f"Reads per file: {plan['lookups']} lookups by the entries -> {n_hists} distinct histograms "
+          f"in {len(reads)} directories, one pass each")
+    for hdir_str, names in reads.items():
+        print(f"  {hdir_str}: {len(names)} histograms")
+    for f in plan["files"]:
+        print(f"  input {f}")
+    print("Entries:")
+    for i, cfg in enumerate(entries):
+        cr = f" vs {cfg['hdir_cr_str']}/{cfg['histname1']}" if "hdir_cr_str" in cfg else ""
+        print(f"  [{i}] {cfg['op_str']:8s} {cfg['hdir_str']}/{cfg['histname']}{cr}  \"{cfg['xaxis_title']}\"")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Expand a (templated) histogram config into the JSON list format")
+    parser.add_argument("config", help="config template or JSON list")
+    parser.add_argument("--channels", nargs="+", help="only these channels of a template")
+    parser.add_argument("--regions", nargs="+", help="only these regions of a template")
+    parser.add_argument("--output", help="write the expanded list here instead of printing the plan")
+    args = parser.parse_args()
+
+    configs = load_configs(args.config, args.channels, args.regions)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(configs, f, indent=2)
+        print(f"Wrote {len(configs)} entries to {args.output}")
+    else:
+        explain(build_plan([], configs), args.config)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,78 +1,163 @@
-import ROOT
-import sys, re, json
-
-ROOT.gROOT.SetBatch(True)  
-ROOT.gStyle.SetOptStat(0)
-
-
-def fit_and_plot(filename, histname, histname1, hdir_str, hdir_cr_str, op_str, xaxis_title):
+import sys, re, argparse
+from hist_loader import config_keys, read_histograms, cached_histograms, root_batch, as_arrays, arrays_to_th1, new_canvas
+from rebinning import DEFAULT_WIDTH, rebin_hist
+from parallel_render import add_render_options, render_options, render_tasks
+from stage_timer import stage, timed, tracing
+from hist_index import check_configs, report_problems
+from config_plan import load_configs, build_plan, plan_keys, explain
+from plot_books import PlotBook, book_path
+from output_fingerprint import plot_fingerprint, is_current, record
+from sharding import SHARD_DIR
+import hist_loader, rebinning
+
+# The drawing code behind each plot: this script and the helpers that rebin and convert for it
+DRAW_SOURCES = [__file__, hist_loader.__file__, rebinning.__file__]
+
+
+@timed("draw")
+def fit_and_plot(filename, histname, histname1, hdir_str, hdir_cr_str, op_str, xaxis_title,
+                 rebin_width=DEFAULT_WIDTH, rebin_edges=None, loaded=None, book=None, force=False):
     # Extract WR mass from filename
     match = re.search(r"_WR(\d+)_", filename)
     mass_str = match.group(1) if match else "Unknown"
 
-    # Open ROOT file
-    f = ROOT.TFile.Open(filename)
+    ROOT = root_batch()
 
-    hdir = f.Get(hdir_str)  #"wr_ee_resolved_sr")
-    h_sr = hdir.Get(histname)
-    hdir_cr = f.Get(hdir_cr_str)
-    h_cr = hdir_cr.Get(histname1) 
+    # Histograms preloaded by main(), or open the file just for this config
+    if loaded is None:
+        loaded = read_histograms(filename, [(hdir_str, histname), (hdir_cr_str, histname1)])
+    h_sr = loaded.get((hdir_str, histname))
+    h_cr = loaded.get((hdir_cr_str, histname1))
 
     if not h_sr or not h_cr:
         raise RuntimeError(f"Histograms {histname} and {histname1} not found in {filename}")
 
-    # Rebin to ~100 GeV
-    bin_width = h_sr.GetBinWidth(1)
-    rebin_factor = max(1, int(100/bin_width))
-    h_sr.Rebin(rebin_factor)
-    h_cr.Rebin(rebin_factor)
+    # Rebin to ~100 GeV, or to the config's own width / edge list
+    # (into new arrays, the loaded ones stay untouched)
+    a_sr = rebin_hist(as_arrays(h_sr), rebin_width, rebin_edges)
+    a_cr = rebin_hist(as_arrays(h_cr), rebin_width, rebin_edges)
+
+    # Everything on the canvas besides the histograms; with the rebinned
+    # contents it makes the fingerprint of the output
+    style = {"canvas": [800, 600], "logy": True, "colors": ["kRed", "kBlue"], "marker": [8, 1.2],
+             "xaxis_title": xaxis_title, "yaxis_title": "Normalized", "yrange": [1e-8, 1],
+             "legend": [0.55, 0.65, 0.85, 0.85, 0.04], "legend_text": [op_str, "SR", "CR"]}
+    outname = f"SRvsCR_{op_str}_{histname}_norm.png"
+    fp = plot_fingerprint([a_sr, a_cr], style, DRAW_SOURCES)
+    if book is None and not force and is_current([outname], fp):
+        print(f"Unchanged {outname}, not redrawn")
+        return
+
+    h_sr = arrays_to_th1(f"{histname}_rebin", a_sr)
+    h_cr = arrays_to_th1(f"{histname1}_rebin", a_cr)
 
     # Draw
-    c = ROOT.TCanvas("c_bw", "", 800, 600)
-    ROOT.gPad.SetLogy()
-
-    for h, col, label in [(h_sr, ROOT.kRed, "SR"),
-                          (h_cr, ROOT.kBlue, "CR")]:
-        h.SetLineColor(col)
-        h.SetMarkerColor(col)
-        h.SetMarkerStyle(8)
-        h.SetMarkerSize(1.2)
+    c = new_canvas("c_bw", "", *style["canvas"])
+    if style["logy"]:
+        ROOT.gPad.SetLogy()
+
+    for h, col in zip([h_sr, h_cr], style["colors"]):
+        h.SetLineColor(getattr(ROOT, col))
+        h.SetMarkerColor(getattr(ROOT, col))
+        h.SetMarkerStyle(style["marker"][0])
+        h.SetMarkerSize(style["marker"][1])
         h.GetXaxis().SetTitle(xaxis_title)
-        h.GetYaxis().SetTitle("Normalized")
-        h.GetYaxis().SetRangeUser(1e-8, 1)
+        h.GetYaxis().SetTitle(style["yaxis_title"])
+        h.GetYaxis().SetRangeUser(*style["yrange"])
 
     h_sr.Draw("ep")
     h_cr.Draw("ep same")
 
-    leg = ROOT.TLegend(0.55, 0.65, 0.85, 0.85)
-    leg.SetTextSize(0.04)
+    header, sr_text, cr_text = style["legend_text"]
+    leg = ROOT.TLegend(*style["legend"][:4])
+    leg.SetTextSize(style["legend"][4])
     leg.SetBorderSize(0)
     leg.SetFillStyle(0)
-    leg.SetHeader(op_str)
-    leg.AddEntry(h_sr, "SR","ep")
-    leg.AddEntry(h_cr, "CR","ep")
+    leg.SetHeader(header)
+    leg.AddEntry(h_sr, sr_text, "ep")
+    leg.AddEntry(h_cr, cr_text, "ep")
     leg.Draw()
 
-    outname = f"SRvsCR_{op_str}_{histname}_norm.png"
-    c.SaveAs(outname)
+    if book is not None:
+        # a page of the sample/channel book instead of its own file
+        book.add(c, book_path("SRvsCR", op_str, hdir_str), outname)
+        return
+    with stage("saveas", file=outname):
+        c.SaveAs(outname)
+    record([outname], fp)
     print(f"Saved {outname}")
 
 
-def main(files, config_file="hists.json"):
-    with open(config_file, "r") as f:
-        hist_configs = json.load(f)
-
-    for filename in files:
-        for cfg in hist_configs:
-            fit_and_plot(filename, **cfg)
+def render_config(filename, cfg, keys, backend="root", store=None, book=None, force=False):
+    # One task of the (file, config) matrix; inputs are read once per process
+    loaded = cached_histograms(filename, keys, backend, store)
+    if backend == "uproot":
+        import mpl_plots
+        mpl_plots.sr_vs_cr(filename, loaded=loaded, book=book, force=force, **cfg)
+    else:
+        fit_and_plot(filename, loaded=loaded, book=book, force=force, **cfg)
+
+
+def _task_book(task):
+    cfg = task[1][1]
+    return book_path("SRvsCR", cfg["op_str"], cfg["hdir_str"])
+
+
+def main(files, config_file="hists.json", jobs=1, backend="root", store=None, book=False, thumbnails=False,
+         force=False, stream=False, max_rss=None, channels=None, regions=None, explain_only=False,
+         shape_stats=None, ratio_panels=0, shard=None, shard_dir=SHARD_DIR):
+    try:
+        hist_configs = load_configs(config_file, channels, regions)
+    except RuntimeError as err:
+        print(err)
+        return [config_file]
+    plan = build_plan(files, hist_configs)
+    if explain_only:
+        explain(plan, config_file)
+        return []
+
+    # Every file and histogram checked against the indexes before any canvas is opened
+    if report_problems(check_configs(files, hist_configs, store)):
+        return [config_file]
+
+    keys = plan_keys(plan)   # every file read once per process, directory by directory
+    if shape_stats:
+        # Numbers instead of plots: all entries in one pass, through uproot
+        import shape_compare
+        shape_compare.compare_shapes(files, hist_configs, keys, store, shape_stats, ratio_panels)
+        return []
+    plot_book = PlotBook(thumbnails) if book else None
+    # Streaming reads only each unit's own histograms and keeps nothing between units
+    tasks = [(f"{filename} [{i}] {cfg['histname']}", (filename, cfg, config_keys([cfg]) if stream else keys,
+                                                      backend, store, plot_book, force))
+             for filename in files for i, cfg in enumerate(hist_configs)]
+    return render_tasks(render_config, tasks, jobs, plot_book, _task_book, stream, max_rss,
+                        shard=shard, shard_dir=shard_dir, name="diffkinem")
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Overlay SR and CR distributions for each config entry")
+    parser.add_argument("inputs", nargs="+", help="<rootfiles...> <config.json or config template>")
+    add_render_options(parser)
+    parser.add_argument("--shape-stats", nargs="?", const="shape_stats.csv", metavar="OUT.csv",
+                        help="instead of plots, compare the normalised SR and CR shapes of every entry (chi2/ndf, KS, "
+                             "SR/CR ratio) and write a ranked table (default shape_stats.csv)")
+    parser.add_argument("--ratio-panels", type=int, default=0, metavar="N",
+                        help="with --shape-stats, draw ratio panels of the N least compatible entries into shape_ratios.pdf")
+    args = parser.parse_args(argv)
+    if args.shard and args.shape_stats:
+        parser.error("--shape-stats compares all entries in one pass and is not sharded")
+
+    if len(args.inputs) < 2:
+        print("Usage: python3 diffKinem_CRvsSR_rooFit_plot.py [--jobs N] [--backend root|uproot] <rootfiles...> <config.json>")
+        return 1
+
+    *rootfiles, config_file = args.inputs
+    with tracing(args.trace):
+        failures = main(rootfiles, config_file, **render_options(parser, args),
+                        shape_stats=args.shape_stats, ratio_panels=args.ratio_panels)
+    return 1 if failures else 0
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: python3 diffKinem_CRvsSR_rooFit_plot.py <rootfiles...> <config.json>")
-        sys.exit(1)
-
-    *rootfiles, config_file = sys.argv[1:]
-    main(rootfiles, config_file)
-
-
+    sys.exit(cli())
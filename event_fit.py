@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+
+import argparse
+import math
+import os
+import time
+
+import numpy as np
+
+from hist_loader import HistArrays
+from stage_timer import stage
+
+# -----------------
+# Event-level inputs: one entry per selected event with its m_lljj and weight
+# -----------------
+TREE = "Events"
+MASS_BRANCH = "mass_fourobject"
+WEIGHT_BRANCH = "weight"
+STEP_SIZE = "50 MB"           # uproot chunk size: memory is bounded by this, not by the file
+MASS_RANGE = (0., 8000.)      # axis of the m_lljj histograms
+FINE_WIDTH = 2.               # GeV, bins of the finely binned likelihood
+
+# Fit settings, as in rooFit_plot_Wrmass_BW.py / batch_fit.py
+WINDOW = {"gauss": 1.5, "bw": 2.0}
+WIDTH_RANGE = (10., 1000.)
+MAX_PASSES = 60               # one pass over the tree per minimizer step
+TOL = 1e-6                    # stop when the -log L change is below this
+
+
+def iterate_events(filename, tree=TREE, branch=MASS_BRANCH, weight=WEIGHT_BRANCH, step_size=STEP_SIZE):
+    # (mass, weight) float64 arrays, one chunk at a time; unit weights without a weight branch
+    import uproot
+
+    try:
+        f = uproot.open(filename)
+    except (OSError, ValueError) as err:
+        raise RuntimeError(f"Could not open {filename}: {err}")
+    with f:
+        if tree not in f:
+            raise RuntimeError(f"Tree {tree} not found in {filename}")
+        t = f[tree]
+        if branch not in t:
+            raise RuntimeError(f"Branch {branch} not found in {filename}:{tree}")
+        branches = [branch] + ([weight] if weight and weight in t else [])
+        for chunk in t.iterate(branches, step_size=step_size, library="np"):
+            x = np.asarray(chunk[branch], dtype=float)
+            w = np.asarray(chunk[weight], dtype=float) if len(branches) > 1 else np.ones_like(x)
+            yield x, w
+
+
+def fine_histogram(filename, bin_width=FINE_WIDTH, mass_range=MASS_RANGE, **tree_args):
+    """One pass over the tree: finely binned m_lljj (HistArrays) and the event counts.
+
+    Memory is one chunk plus the histogram, whatever the size of the file.
+    """
+    edges = np.arange(mass_range[0], mass_range[1] + 0.5 * bin_width, bin_width)
+    values = np.zeros(len(edges) - 1)
+    sumw2 = np.zeros(len(edges) - 1)
+    events = 0
+    with stage("get", file=filename, mode="events"):
+        for x, w in iterate_events(filename, **tree_args):
+            values += np.histogram(x, edges, weights=w)[0]
+            sumw2 += np.histogram(x, edges, weights=w * w)[0]
+            events += len(x)
+    return HistArrays(values, sumw2, edges), events
+
+
+# -----------------
+# Unbinned likelihood, truncated to the fit window [a, b]
+# -----------------
+def _log_norm(model, mean, width, a, b):
+    # log of the pdf's integral over [a, b] (shapes as in batch_fit.shape_and_jacobian, normalised)
+    if model == "gauss":
+        s = math.sqrt(2.) * width
+        norm = 0.5 * (math.erf((b - mean) / s) - math.erf((a - mean) / s))
+    else:
+        half = 0.5 * width
+        norm = (math.atan((b - mean) / half) - math.atan((a - mean) / half)) / math.pi
+    return math.log(max(norm, 1e-300))
+
+
+def _log_pdf_and_grad(model, x, mean, width):
+    # Per-event log density (before truncation) and its derivatives in (mean, width)
+    if model == "gauss":
+        z = (x - mean) / width
+        logf = -0.5 * z**2 - math.log(width) - 0.5 * math.log(2 * math.pi)
+        grad = np.stack([z / width, (z**2 - 1.) / width], axis=-1)
+    else:
+        # Breit-Wigner with full width `width` (RooBreitWigner)
+        half = 0.5 * width
+        d = (x - mean)**2 + half**2
+        logf = np.log(half / math.pi) - np.log(d)
+        grad = np.stack([2 * (x - mean) / d, 1. / width - half / d], axis=-1)
+    return logf, grad
+
+
+def unbinned_pass(filename, model, p, a, b, **tree_args):
+    """-log L and its derivative sums at p = (mean, width), from one pass over the events in [a, b].
+
+    Returns (nll, grad, info, info_w2, sum_w): grad is d(log L)/dp, `info` the
+    sum of w g g^T (BHHH approximation of the information) and `info_w2` the
+    sum of w^2 g g^T, for the sandwich errors of a weighted fit.
+    """
+    mean, width = p
+    lognorm = _log_norm(model, mean, width, a, b)
+    # derivatives of the scalar log-normalisation by central differences
+    eps = 1e-6 * np.maximum(np.abs(p), 1.)
+    dlognorm = np.array([(_log_norm(model, *(p + e), a, b) - _log_norm(model, *(p - e), a, b)) / (2 * e[i])
+                         for i, e in enumerate(np.diag(eps))])
+    nll, sum_w = 0., 0.
+    grad, info, info_w2 = np.zeros(2), np.zeros((2, 2)), np.zeros((2, 2))
+    for x, w in iterate_events(filename, **tree_args):
+        keep = (x >= a) & (x <= b)
+        x, w = x[keep], w[keep]
+        logf, g = _log_pdf_and_grad(model, x, mean, width)
+        g = g - dlognorm
+        nll -= np.sum(w * (logf - lognorm))
+        sum_w += w.sum()
+        grad += g.T @ w
+        info += (g * w[:, None]).T @ g
+        info_w2 += (g * (w * w)[:, None]).T @ g
+    return nll, grad, info, info_w2, sum_w
+
+
+def unbinned_fit(filename, model, start, fit_range, max_passes=MAX_PASSES, tol=TOL, **tree_args):
+    """Unbinned maximum-likelihood fit of `model` to the events inside `fit_range`.
+
+    Damped scoring steps (Levenberg-Marquardt on the BHHH information), one
+    streamed pass per step, so memory is bounded by the chunk size. Errors
+    are the sandwich estimate, valid for weighted events too.
+    """
+    a, b = fit_range
+    lo = np.array([a, WIDTH_RANGE[0]])
+    hi = np.array([b, WIDTH_RANGE[1]])
+    p = np.clip(np.asarray(start, dtype=float), lo, hi)
+    nll, grad, info, info_w2, sum_w = unbinned_pass(filename, model, p, a, b, **tree_args)
+    if sum_w <= 0:
+        raise RuntimeError(f"No events in [{a:g}, {b:g}] in {filename}")
+    lam, passes, converged = 1e-3, 1, False
+    while passes < max_passes:
+        step = np.linalg.solve(info + lam * np.diag(np.diag(info)) + 1e-12 * np.eye(2), grad)
+        p_new = np.clip(p + step, lo, hi)
+        res = unbinned_pass(filename, model, p_new, a, b, **tree_args)
+        passes += 1
+        if res[0] <= nll:
+            small = abs(nll - res[0]) <= tol * (1. + abs(nll))
+            p, (nll, grad, info, info_w2, sum_w) = p_new, res
+            lam *= 0.3
+            if small:
+                converged = True
+                break
+        else:
+            lam *= 10.
+            if lam > 1e10:
+                break
+    cov = np.linalg.pinv(info) @ info_w2 @ np.linalg.pinv(info)
+    err = np.sqrt(np.abs(np.diag(cov)))
+    return {"mean": p[0], "mean_err": err[0], "width": p[1], "width_err": err[1],
+            "nll": nll, "passes": passes, "status": 0 if converged else 1, "low": a, "high": b}
+
+
+def narrowing_fit(filename, model, hist, **tree_args):
+    """The RooFit narrowing recipe, unbinned: full-range fit from the mean and RMS,
+    then a refit inside mean -/+ WINDOW[model] * width.
+
+    `hist` is the fine histogram of the same events; it only provides the range
+    and the start values.
+    """
+    x = 0.5 * (hist.edges[1:] + hist.edges[:-1])
+    total = max(hist.values.sum(), 1e-300)
+    mean0 = np.sum(hist.values * x) / total
+    rms0 = math.sqrt(max(np.sum(hist.values * x**2) / total - mean0**2, 0.))
+    full = (hist.edges[0], hist.edges[-1])
+    with stage("fit", model=model, range="full", mode="unbinned"):
+        res = unbinned_fit(filename, model, (mean0, rms0), full, **tree_args)
+    window = (max(full[0], res["mean"] - WINDOW[model] * res["width"]),
+              min(full[1], res["mean"] + WINDOW[model] * res["width"]))
+    passes = res["passes"]
+    with stage("fit", model=model, range="narrow", mode="unbinned"):
+        res = unbinned_fit(filename, model, (res["mean"], res["width"]), window, **tree_args)
+    res["passes"] += passes
+    return res
+
+
+# -----------------
+# Synthetic ntuples
+# -----------------
+def generate_ntuples(directory, wr_masses, n_fractions, events=1_000_000, chunk=1_000_000, seed=1):
+    """Write WRAnalyzer_signal_WR<wr>_N<n>.root files with an event tree of m_lljj and weights.
+
+    m_lljj is a Gaussian peak at M_WR (5% resolution) with a low-mass tail,
+    weights are positive and spread around one. Events are written `chunk` at
+    a time, so files larger than memory can be made.
+    """
+    import uproot
+
+    rng = np.random.default_rng(seed)
+    os.makedirs(directory, exist_ok=True)
+    written = []
+    for wr in wr_masses:
+        for frac in n_fractions:
+            n = int(round(wr * frac / 100.)) * 100
+            filename = os.path.join(directory, f"WRAnalyzer_signal_WR{wr}_N{n}.root")
+            with uproot.recreate(filename) as f:
+                f.mktree(TREE, {MASS_BRANCH: np.float32, WEIGHT_BRANCH: np.float32})
+                left = events
+                while left > 0:
+                    size = min(chunk, left)
+                    tail = rng.random(size) < 0.15
+                    mass = np.where(tail, wr - rng.exponential(0.3 * wr, size), rng.normal(wr, 0.05 * wr, size))
+                    weight = rng.gamma(20., 1. / 20., size)
+                    f[TREE].extend({MASS_BRANCH: np.clip(mass, 0., None).astype(np.float32),
+                                    WEIGHT_BRANCH: weight.astype(np.float32)})
+                    left -= size
+            written.append(filename)
+            print(f"Wrote {filename} ({events} events)")
+    return written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write synthetic event-level signal ntuples for the event fits "
+                                                 "of rooFit_plot_Wrmass_BW.py --events")
+    parser.add_argument("directory", help="output directory")
+    parser.add_argument("--wr-masses", type=int, nargs="+", default=[2000], help="WR masses in GeV")
+    parser.add_argument("--n-fractions", type=float, nargs="+", default=[0.4], help="N mass as a fraction of WR")
+    parser.add_argument("--events", type=int, default=1_000_000, help="events per file (default 1000000)")
+    parser.add_argument("--chunk", type=int, default=1_000_000, help="events written at a time (default 1000000)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    files = generate_ntuples(args.directory, args.wr_masses, args.n_fractions, args.events, args.chunk, args.seed)
+    print(f"Wrote {len(files)} files in {time.perf_counter() - t0:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
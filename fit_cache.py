@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+DEFAULT_DIR = ".fit_cache"
+DEFAULT_MAX_BYTES = 100 * 1024 * 1024
+RESCAN_EVERY = 100   # puts between directory scans, for what other processes wrote
+
+
+class FitCache:
+    """On-disk cache of fit results, addressed by what the fit actually saw.
+
+    The key hashes the (rebinned) bin contents, errors and edges, the model
+    name, the narrowing settings and the fitter version, so any change to the input or to
+    the fit procedure is a miss. Entries are small JSON files; once the
+    directory grows past `max_bytes` the least recently used ones are removed.
+    Several processes may share a directory (--jobs, shards): an entry that
+    another process removes in between is a miss, not an error.
+    """
+
+    def __init__(self, path=DEFAULT_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._size = None   # running estimate of the directory size, None until the first scan
+        self._puts = 0
+        os.makedirs(path, exist_ok=True)
+
+    @staticmethod
+    def key(values, errors, edges, model, settings, version):
+        # the edges too: the same contents under another binning or axis range are another fit
+        sha = hashlib.sha256()
+        for arr in (values, errors, edges):
+            sha.update(np.ascontiguousarray(arr, dtype="<f8").tobytes())
+            sha.update(b"|")
+        sha.update(json.dumps({"model": model, "settings": settings, "version": version},
+                              sort_keys=True).encode())
+        return sha.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + ".json")
+
+    def get(self, key):
+        try:
+            with open(self._file(key)) as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            return None
+        try:
+            os.utime(self._file(key))   # mark as recently used
+        except OSError:
+            pass                        # evicted by another process meanwhile, the result is still good
+        return result
+
+    def put(self, key, result):
+        tmp = self._file(key) + f".{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(result, f)
+        size = os.path.getsize(tmp)
+        os.replace(tmp, self._file(key))
+        # Scan the directory only when it is probably over the limit, or now and then
+        self._puts += 1
+        if self._size is None or self._puts % RESCAN_EVERY == 0:
+            self.evict()
+        else:
+            self._size += size
+            if self._size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith(".json"):
+                try:
+                    st = os.stat(os.path.join(self.path, name))
+                except OSError:
+                    continue   # removed by another process
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+        self._size = total
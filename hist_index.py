@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+from hist_loader import HistArrays
+from rebinning import DEFAULT_WIDTH, group_starts
+
+INDEX_VERSION = 1
+INDEX_SUFFIX = ".index.json"   # sidecar next to each input file
+
+
+def _info(h, entries):
+    # Compact summary of one 1-D histogram; edges are only stored for variable binning
+    widths = np.diff(h.edges)
+    uniform = bool(np.allclose(widths, widths[0]))
+    info = {"nbins": len(widths), "low": float(h.edges[0]), "high": float(h.edges[-1]),
+            "bin_width": float(widths[0]) if uniform else None,
+            "entries": float(entries), "integral": float(np.sum(h.values))}
+    if not uniform:
+        info["edges"] = np.asarray(h.edges, dtype=float).tolist()
+    return info
+
+
+def hist_edges(info):
+    if "edges" in info:
+        return np.array(info["edges"])
+    return np.linspace(info["low"], info["high"], info["nbins"] + 1)
+
+
+def _scan(filename):
+    # uproot for either backend: one histogram at a time, nothing kept; PyROOT's ReadObj() held them all in memory
+    import uproot
+
+    dirs = {}
+    try:
+        f = uproot.open(filename)
+    except (OSError, ValueError) as err:
+        raise RuntimeError(f"Could not open {filename}: {err}")
+    with f:
+        for path, classname in f.classnames(recursive=True, cycle=False).items():
+            if not classname.startswith("TH1"):
+                continue
+            h = f[path]
+            hdir, _, name = path.rpartition("/")
+            arrays = HistArrays(h.values(), h.variances(), h.axes[0].edges())
+            dirs.setdefault(hdir, {})[name] = _info(arrays, h.member("fEntries"))
+    return dirs
+
+
+def load_index(filename):
+    """{directory: {histname: info}} for all 1-D histograms in `filename`.
+
+    Read from the `<file>.index.json` sidecar when its recorded size and
+    mtime still match the file, otherwise the file is scanned once (with
+    uproot, whichever backend draws) and the sidecar rewritten. A read-only input area only
+    costs the rescan.
+    """
+    try:
+        st = os.stat(filename)
+    except OSError:
+        raise RuntimeError(f"Could not open {filename}")
+    sidecar = filename + INDEX_SUFFIX
+    try:
+        with open(sidecar) as f:
+            index = json.load(f)
+        if (index["version"], index["size"], index["mtime_ns"]) == (INDEX_VERSION, st.st_size, st.st_mtime_ns):
+            return index["dirs"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    dirs = _scan(filename)
+    index = {"version": INDEX_VERSION, "size": st.st_size, "mtime_ns": st.st_mtime_ns, "dirs": dirs}
+    try:
+        tmp = sidecar + f".{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp, sidecar)
+    except OSError:
+        pass
+    return dirs
+
+
+def store_index(filename, store):
+    # load_index() from a histogram store's own index, for runs that read the store instead of the files
+    from hist_store import open_store
+
+    hs = open_store(store)
+    dirs = {}
+    for entry in hs.file_entries(filename):
+        dirs.setdefault(entry["dir"], {})[entry["name"]] = _info(hs.arrays(entry), float("nan"))
+    return dirs
+
+
+def check_configs(files, hist_configs, store=None):
+    """Everything that would fail when drawing `hist_configs` for `files`, found from the indexes alone.
+
+    Checks that every file opens, every (directory, histogram) pair exists and
+    any rebin_edges fall on existing bin edges. With a histogram `store` the
+    checks use the store's index, which is what will be read. Returns a list
+    of messages, empty when the configs are good to go.
+    """
+    problems = []
+    for filename in files:
+        try:
+            dirs = store_index(filename, store) if store else load_index(filename)
+        except RuntimeError as err:
+            problems.append(str(err))
+            continue
+        for i, cfg in enumerate(hist_configs):
+            for dir_key, name_key in (("hdir_str", "histname"), ("hdir_cr_str", "histname1")):
+                if dir_key not in cfg:
+                    continue
+                hdir_str, histname = cfg[dir_key], cfg[name_key]
+                info = dirs.get(hdir_str, {}).get(histname)
+                if info is None:
+                    problems.append(f"{filename}: [{i}] histogram {hdir_str}/{histname} not found")
+                    continue
+                try:
+                    group_starts(hist_edges(info), cfg.get("rebin_width", DEFAULT_WIDTH), cfg.get("rebin_edges"))
+                except ValueError as err:
+                    problems.append(f"{filename}: [{i}] {hdir_str}/{histname}: {err}")
+    return problems
+
+
+def report_problems(problems):
+    # Print check_configs() messages; True if there were any
+    for problem in problems:
+        print(problem)
+    if problems:
+        print(f"Config check failed ({len(problems)} problems), nothing drawn")
+    return bool(problems)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or refresh the histogram index sidecars of input files")
+    parser.add_argument("files", nargs="+", help="Input ROOT files")
+    parser.add_argument("--list", action="store_true", help="print every histogram with its binning, entries and integral")
+    args = parser.parse_args()
+
+    for filename in args.files:
+        dirs = load_index(filename)
+        print(f"{filename}: {len(dirs)} directories, {sum(len(h) for h in dirs.values())} histograms")
+        if args.list:
+            for hdir_str, hists in sorted(dirs.items()):
+                for histname, info in sorted(hists.items()):
+                    width = f"{info['bin_width']:g}" if info["bin_width"] is not None else "variable"
+                    print(f"  {hdir_str}/{histname}: {info['nbins']} bins [{info['low']:g}, {info['high']:g}], "
+                          f"width {width}, entries {info['entries']:g}, integral {info['integral']:g}")
+
+
+if __name__ == "__main__":
+    main()
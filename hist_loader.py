@@ -0,0 +1,193 @@
+import itertools
+import sys
+from collections import namedtuple
+
+import numpy as np
+
+from stage_timer import stage
+
+# Plain NumPy view of a TH1: bin contents, sum of squared weights, bin edges
+HistArrays = namedtuple("HistArrays", ["values", "sumw2", "edges"])
+
+
+def root_batch():
+    # Import PyROOT on first use only, so the uproot backend never pays for it
+    import ROOT
+    ROOT.gROOT.SetBatch(True)
+    ROOT.gStyle.SetOptStat(0)
+    ROOT.TH1.AddDirectory(False)   # new histograms belong to whoever made them, not to gDirectory
+    return ROOT
+
+
+# -----------------
+# Object lifecycle: ROOT names are global, so every canvas and RooFit object
+# gets a fresh one; canvases are closed again after each plot in streaming mode
+# -----------------
+_names = itertools.count()
+_canvases = []
+
+
+def unique_name(prefix):
+    return f"{prefix}_{next(_names)}"
+
+
+def new_canvas(name, title="", width=800, height=600):
+    # TCanvas with a unique name, closed by release_root_objects()
+    ROOT = root_batch()
+    c = ROOT.TCanvas(unique_name(name), title, width, height)
+    _canvases.append(c.GetName())
+    return c
+
+
+def release_root_objects():
+    # Close the canvases made by new_canvas(); the histograms, legends and
+    # frames drawn on them go with their last Python reference
+    ROOT = sys.modules.get("ROOT")   # never imported with the uproot backend
+    if ROOT is not None:
+        canvases = ROOT.gROOT.GetListOfCanvases()
+        for name in _canvases:
+            c = canvases.FindObject(name)
+            if c:
+                c.Close()
+    _canvases.clear()
+
+
+def config_keys(hist_configs):
+    # All (directory, histogram) pairs a list of JSON config entries asks for
+    keys = []
+    for cfg in hist_configs:
+        keys.append((cfg["hdir_str"], cfg["histname"]))
+        if "hdir_cr_str" in cfg:
+            keys.append((cfg["hdir_cr_str"], cfg["histname1"]))
+    return keys
+
+
+def group_keys(keys):
+    # {hdir_str: [histname, ...]}, duplicates dropped, in first-seen order: one pass per directory
+    groups = {}
+    for hdir_str, histname in keys:
+        names = groups.setdefault(hdir_str, [])
+        if histname not in names:
+            names.append(histname)
+    return groups
+
+
+def open_root_file(filename):
+    ROOT = root_batch()
+    with stage("open", file=filename):
+        f = ROOT.TFile.Open(filename)
+    if not f or f.IsZombie():
+        raise RuntimeError(f"Could not open {filename}")
+    return f
+
+
+def read_histograms(filename, keys):
+    """Open `filename` once and return {(hdir_str, histname): hist} for all keys.
+
+    Histograms are detached from the file (SetDirectory(0)) so they stay valid
+    after it is closed; missing directories or histograms map to None. Reads
+    go directory by directory, each in the order the histograms sit in the file.
+    """
+    hists = {}
+    f = open_root_file(filename)
+    try:
+        with stage("get", file=filename, keys=len(keys)):
+            for hdir_str, names in group_keys(keys).items():
+                hists.update(dict.fromkeys((hdir_str, histname) for histname in names))
+                hdir = f.Get(hdir_str)
+                found = {histname: hdir.GetKey(histname) for histname in names} if hdir else {}
+                for histname in sorted((n for n, key in found.items() if key), key=lambda n: found[n].GetSeekKey()):
+                    h = hdir.Get(histname)
+                    if h:
+                        h.SetDirectory(0)   # detach from file
+                    hists[(hdir_str, histname)] = h if h else None
+    finally:
+        f.Close()
+    return hists
+
+
+def th1_to_arrays(h):
+    # TH1 -> HistArrays (visible bins only)
+    n = h.GetNbinsX()
+    values = np.array([h.GetBinContent(i) for i in range(1, n + 1)])
+    if h.GetSumw2N() > 0:
+        sumw2 = np.array([h.GetBinError(i)**2 for i in range(1, n + 1)])
+    else:
+        sumw2 = values.copy()
+    edges = np.array([h.GetXaxis().GetBinLowEdge(i) for i in range(1, n + 2)])
+    return HistArrays(values, sumw2, edges)
+
+
+def as_arrays(h):
+    # HistArrays from either a TH1 or HistArrays already (uproot or the histogram store)
+    return h if isinstance(h, HistArrays) else th1_to_arrays(h)
+
+
+def arrays_to_th1(name, h, title=""):
+    # HistArrays -> detached TH1D, possibly with variable-width bins
+    ROOT = root_batch()
+    edges = np.asarray(h.edges, dtype="float64")
+    th1 = ROOT.TH1D(name, title, len(edges) - 1, edges)
+    th1.SetDirectory(0)
+    th1.Sumw2()
+    for i, (value, sumw2) in enumerate(zip(h.values, h.sumw2), start=1):
+        th1.SetBinContent(i, value)
+        th1.SetBinError(i, sumw2**0.5)
+    return th1
+
+
+def read_arrays(filename, keys):
+    """uproot counterpart of read_histograms(): {(hdir_str, histname): HistArrays}.
+
+    No PyROOT involved; missing directories or histograms map to None.
+    """
+    import uproot
+
+    hists = {}
+    try:
+        with stage("open", file=filename):
+            f = uproot.open(filename)
+    except (OSError, ValueError) as err:
+        raise RuntimeError(f"Could not open {filename}: {err}")
+    with f, stage("get", file=filename, keys=len(keys)):
+        # directory by directory, in file order
+        for hdir_str, names in group_keys(keys).items():
+            hists.update(dict.fromkeys((hdir_str, histname) for histname in names))
+            hdir = f[hdir_str] if hdir_str in f else None
+            present = [histname for histname in names if hdir is not None and histname in hdir]
+            for histname in sorted(present, key=lambda n: hdir.key(n).fSeekKey):
+                h = hdir[histname]
+                hists[(hdir_str, histname)] = HistArrays(h.values(), h.variances(), h.axes[0].edges())
+    return hists
+
+
+_read_cache = {}
+
+
+def cached_histograms(filename, keys, backend="root", store=None):
+    # read_histograms()/read_arrays() memoized per process, so a pool worker
+    # opens each input file at most once no matter how many configs it renders.
+    # Keys the file's histogram index does not list are None without a lookup.
+    # With a histogram `store` (hist_store.py) nothing is decoded at all:
+    # HistArrays views into the mapped store, for either backend.
+    from hist_index import load_index   # hist_index imports this module
+
+    cache_key = (backend, filename, tuple(keys), store)
+    if cache_key in _read_cache:
+        return _read_cache[cache_key]
+    if store is not None:
+        from hist_store import open_store
+        _read_cache[cache_key] = open_store(store).read(filename, keys)
+    else:
+        index = load_index(filename)
+        present = [(hdir_str, histname) for hdir_str, histname in keys if histname in index.get(hdir_str, {})]
+        reader = read_arrays if backend == "uproot" else read_histograms
+        hists = dict.fromkeys(keys)
+        hists.update(reader(filename, present))
+        _read_cache[cache_key] = hists
+    return _read_cache[cache_key]
+
+
+def clear_cache():
+    # Forget everything cached_histograms() has read (inputs may have changed)
+    _read_cache.clear()
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import os
+import re
+import time
+
+import numpy as np
+
+from hist_loader import HistArrays
+from stage_timer import stage
+
+STORE_VERSION = 1
+DEFAULT_STORE = "hists.store"
+INDEX_FILE = "index.json"
+DATA_FILE = "data.f8"   # raw little-endian float64: values, sumw2, edges of every histogram back to back
+
+
+# -----------------
+# Metadata from file and directory names
+# -----------------
+def file_metadata(filename):
+    # WRAnalyzer_signal_WR2000_N400.root -> sample "signal", wr 2000, n 400
+    stem = re.sub(r"^WRAnalyzer_", "", os.path.basename(filename))
+    stem = re.sub(r"\.root$", "", stem)
+    wr = re.search(r"_WR(\d+)", stem)
+    n = re.search(r"_N(\d+)", stem)
+    return {"sample": stem.split("_")[0],
+            "wr": int(wr.group(1)) if wr else None,
+            "n": int(n.group(1)) if n else None}
+
+
+def dir_metadata(hdir_str):
+    # wr_ee_resolved_dy_cr -> channel "ee", region "resolved_dy_cr"
+    match = re.match(r"wr_(ee|mumu|emu)_(.+)", hdir_str)
+    if match:
+        return {"channel": match.group(1), "region": match.group(2)}
+    return {"channel": None, "region": re.sub(r"^wr_", "", hdir_str)}
+
+
+# -----------------
+# Converter
+# -----------------
+def build_store(files, path=DEFAULT_STORE):
+    """Decode every 1-D histogram of `files` once and write them to an uncompressed store at `path`.
+
+    The index lists, per histogram, its source file, directory, name, the
+    metadata parsed from those names and where its arrays start in the data
+    file; source size and mtime are kept to detect stale entries.
+    """
+    import uproot
+
+    os.makedirs(path, exist_ok=True)
+    data_path = os.path.join(path, DATA_FILE)
+    index = {"version": STORE_VERSION, "files": {}, "hists": []}
+    offset = 0
+    with open(data_path + ".tmp", "wb") as out:
+        for filename in files:
+            source = os.path.realpath(filename)
+            st = os.stat(source)
+            index["files"][source] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, **file_metadata(filename)}
+            try:
+                f = uproot.open(source)
+            except (OSError, ValueError) as err:
+                raise RuntimeError(f"Could not open {filename}: {err}")
+            with f:
+                for key, classname in f.classnames(recursive=True, cycle=False).items():
+                    if not classname.startswith("TH1"):
+                        continue
+                    h = f[key]
+                    hdir_str, _, histname = key.rpartition("/")
+                    values = h.values()
+                    for arr in (values, h.variances(), h.axes[0].edges()):
+                        np.ascontiguousarray(arr, dtype="<f8").tofile(out)
+                    index["hists"].append({"file": source, "dir": hdir_str, "name": histname,
+                                           **dir_metadata(hdir_str), "nbins": len(values), "offset": offset})
+                    offset += 3 * len(values) + 1
+    # data first, index last: a reader never sees an index pointing past the data
+    os.replace(data_path + ".tmp", data_path)
+    with open(os.path.join(path, INDEX_FILE + ".tmp"), "w") as f:
+        json.dump(index, f)
+    os.replace(os.path.join(path, INDEX_FILE + ".tmp"), os.path.join(path, INDEX_FILE))
+    return index
+
+
+# -----------------
+# Reader
+# -----------------
+class HistStore:
+    """Read-only, memory-mapped view of a store written by build_store().
+
+    Histograms come back as HistArrays whose arrays are slices of the mapped
+    data file, so nothing is decompressed or copied until it is used.
+    """
+
+    def __init__(self, path=DEFAULT_STORE):
+        try:
+            with open(os.path.join(path, INDEX_FILE)) as f:
+                index = json.load(f)
+        except (OSError, ValueError) as err:
+            raise RuntimeError(f"Could not open histogram store {path}: {err}")
+        if index.get("version") != STORE_VERSION:
+            raise RuntimeError(f"Histogram store {path} has version {index.get('version')}, rebuild it")
+        self.path = path
+        self.files = index["files"]
+        self.entries = index["hists"]
+        self.lookup = {(h["file"], h["dir"], h["name"]): h for h in self.entries}
+        data_path = os.path.join(path, DATA_FILE)
+        if os.path.getsize(data_path) > 0:
+            self.data = np.memmap(data_path, dtype="<f8", mode="r")
+        else:
+            self.data = np.empty(0)
+
+    def arrays(self, entry):
+        o, n = entry["offset"], entry["nbins"]
+        return HistArrays(self.data[o:o + n], self.data[o + n:o + 2*n], self.data[o + 2*n:o + 3*n + 1])
+
+    def source(self, filename):
+        # Store key of an input file; it has to be in the store and unchanged since
+        source = os.path.realpath(filename)
+        meta = self.files.get(source)
+        if meta is None:
+            raise RuntimeError(f"{filename} is not in histogram store {self.path}")
+        try:
+            st = os.stat(source)
+        except OSError as err:
+            raise RuntimeError(f"Could not check {filename} against histogram store {self.path} ({err.strerror}), "
+                               f"rebuild it from where the file is now")
+        if (st.st_size, st.st_mtime_ns) != (meta["size"], meta["mtime_ns"]):
+            raise RuntimeError(f"{filename} changed since histogram store {self.path} was built, rebuild it")
+        return source
+
+    def file_entries(self, filename):
+        # Index entries of every histogram of one input file
+        source = self.source(filename)
+        return [entry for entry in self.entries if entry["file"] == source]
+
+    def read(self, filename, keys):
+        # Same result as read_arrays(): {(hdir_str, histname): HistArrays or None}
+        source = self.source(filename)
+        hists = {}
+        with stage("get", file=filename, keys=len(keys)):
+            for hdir_str, histname in keys:
+                entry = self.lookup.get((source, hdir_str, histname))
+                hists[(hdir_str, histname)] = self.arrays(entry) if entry else None
+        return hists
+
+    def select(self, **meta):
+        """All (entry, HistArrays) whose metadata match, e.g. select(sample="signal", channel="ee", name=...).
+
+        Keys are the index fields (file, dir, name, channel, region) and the
+        file metadata (sample, wr, n).
+        """
+        out = []
+        for entry in self.entries:
+            fields = {**self.files[entry["file"]], **entry}
+            if all(fields.get(k) == v for k, v in meta.items()):
+                out.append((entry, self.arrays(entry)))
+        return out
+
+
+_stores = {}
+
+
+def open_store(path=DEFAULT_STORE):
+    # One mapping per store and process, reopened when the store is rebuilt
+    try:
+        version = os.stat(os.path.join(path, INDEX_FILE)).st_mtime_ns
+    except OSError:
+        version = None
+    if _stores.get(path, (None, None))[0] != version or version is None:
+        with stage("open", file=path):
+            _stores[path] = (version, HistStore(path))
+    return _stores[path][1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert analyzer ROOT files into one memory-mapped histogram store")
+    parser.add_argument("files", nargs="+", help="Input ROOT files")
+    parser.add_argument("--output", default=DEFAULT_STORE, help=f"store directory (default {DEFAULT_STORE})")
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    index = build_store(args.files, args.output)
+    size = os.path.getsize(os.path.join(args.output, DATA_FILE))
+    print(f"Stored {len(index['hists'])} histograms from {len(index['files'])} files in {args.output} "
+          f"({size / 1e6:.1f} MB, {time.perf_counter() - t0:.2f} s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,154 @@
+import re
+
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")   # batch mode, like ROOT.gROOT.SetBatch(True)
+import matplotlib.pyplot as plt
+
+from hist_loader import read_arrays
+from plot_books import book_path
+from output_fingerprint import plot_fingerprint, is_current, record
+from rebinning import DEFAULT_WIDTH, rebin_hist
+from stage_timer import stage, timed
+import hist_loader, rebinning
+
+# The drawing code behind each plot: this module and the helpers that read and rebin for it
+DRAW_SOURCES = [__file__, hist_loader.__file__, rebinning.__file__]
+
+# Same colours as the ROOT scripts
+ROOT_COLORS = {"kBlue": "#0000ff", "kRed": "#ff0000", "kGreen+2": "#00a000", "kMagenta": "#ff00ff"}
+
+
+def root_latex(title):
+    # "p_{T}^{lead l} [GeV]" -> "$p_{T}^{lead\ l}$ [GeV]"
+    match = re.match(r"(.*?)(\s*\[[^\]]*\])?$", title)
+    text, unit = match.group(1), match.group(2) or ""
+    if not re.search(r"[#_^]", text):
+        return title
+    return "$" + text.replace("#", "\\").replace(" ", r"\ ") + "$" + unit
+
+
+def _new_canvas():
+    fig, ax = plt.subplots(figsize=(8, 6), dpi=100)   # TCanvas(..., 800, 600)
+    ax.set_yscale("log")
+    return fig, ax
+
+
+@timed("draw")
+def sr_vs_cr(filename, histname, histname1, hdir_str, hdir_cr_str, op_str, xaxis_title,
+             rebin_width=DEFAULT_WIDTH, rebin_edges=None, loaded=None, book=None, force=False):
+    # matplotlib version of diffKinem_CRvsSR_rooFit_plot.fit_and_plot()
+    if loaded is None:
+        loaded = read_arrays(filename, [(hdir_str, histname), (hdir_cr_str, histname1)])
+    h_sr = loaded.get((hdir_str, histname))
+    h_cr = loaded.get((hdir_cr_str, histname1))
+
+    if h_sr is None or h_cr is None:
+        raise RuntimeError(f"Histograms {histname} and {histname1} not found in {filename}")
+
+    # Rebin to ~100 GeV (or the config's width / edges)
+    rebinned = [rebin_hist(h, rebin_width, rebin_edges) for h in (h_sr, h_cr)]
+
+    # Fingerprint: rebinned contents plus everything else on the canvas
+    style = {"colors": ["kRed", "kBlue"], "xaxis_title": xaxis_title, "yaxis_title": "Normalized",
+             "yrange": [1e-8, 1], "legend_text": [op_str, "SR", "CR"]}
+    outname = f"SRvsCR_{op_str}_{histname}_norm.png"
+    fp = plot_fingerprint(rebinned, style, DRAW_SOURCES)
+    if book is None and not force and is_current([outname], fp):
+        print(f"Unchanged {outname}, not redrawn")
+        return
+
+    fig, ax = _new_canvas()
+    for (values, sumw2, edges), col, label in zip(rebinned, style["colors"], style["legend_text"][1:]):
+        col = ROOT_COLORS[col]
+        centers = 0.5 * (edges[1:] + edges[:-1])
+        ax.errorbar(centers, values, xerr=0.5 * np.diff(edges), yerr=np.sqrt(sumw2),
+                    fmt="o", ms=6, color=col, label=label)
+
+    ax.set_xlim(edges[0], edges[-1])
+    ax.set_ylim(*style["yrange"])
+    ax.set_xlabel(root_latex(xaxis_title))
+    ax.set_ylabel(style["yaxis_title"])
+    ax.legend(title=op_str, frameon=False, fontsize=14, title_fontsize=14,
+              loc="upper right", bbox_to_anchor=(0.85, 0.85), bbox_transform=fig.transFigure)
+
+    if book is not None:
+        book.add(fig, book_path("SRvsCR", op_str, hdir_str), outname)
+        plt.close(fig)
+        return
+    with stage("saveas", file=outname):
+        fig.savefig(outname)
+    record([outname], fp)
+    plt.close(fig)
+    print(f"Saved {outname}")
+
+
+@timed("draw")
+def signal_overlay(files, histname, hdir_str, op_str, xaxis_title, index=None,
+                   rebin_width=DEFAULT_WIDTH, rebin_edges=None, loaded=None, book=None, force=False):
+    # matplotlib version of v1_signal_diffkinem.overlay_histograms()
+    colors = [ROOT_COLORS["kBlue"], ROOT_COLORS["kRed"], ROOT_COLORS["kGreen+2"], ROOT_COLORS["kMagenta"]]
+
+    # Rebinned arrays and legend text of every file that has the histogram
+    curves = []
+    for i, f in enumerate(files):
+        match = re.search(r"_WR(\d+)_", f)
+        mass_str = match.group(1) if match else f
+        match = re.search(r"_N(\d+)\.root", f)
+        Nmass_str = match.group(1) if match else f
+
+        if loaded is not None and f in loaded:
+            file_hists = loaded[f]
+        else:
+            try:
+                file_hists = read_arrays(f, [(hdir_str, histname)])
+            except RuntimeError as err:
+                print(err)
+                continue
+
+        h = file_hists.get((hdir_str, histname))
+        if h is None:
+            print(f"Histogram {hdir_str}/{histname} not found in {f}")
+            continue
+
+        # Rebin to ~100 GeV (or the config's width / edges)
+        curves.append((colors[i % len(colors)], rebin_hist(h, rebin_width, rebin_edges),
+                       f"(W,N)=({mass_str},{Nmass_str})"))
+
+    if not curves:
+        print("No histograms drawn.")
+        return
+
+    # Fingerprint: rebinned contents plus everything else on the canvas
+    style = {"colors": [col for col, _, _ in curves], "legend_text": [text for _, _, text in curves],
+             "xaxis_title": xaxis_title, "yaxis_title": "Normalized",
+             "labels": ["CMS Work in Progress", r"$\sqrt{s}$ = 13 TeV, Lumi = 54 fb$^{-1}$"]}
+    outname = f"plot_{index}" if index is not None else f"overlay_{histname}_diffWR"
+    fp = plot_fingerprint([arrays for _, arrays, _ in curves], style, DRAW_SOURCES)
+    if book is None and not force and is_current([outname + ".png", outname + ".pdf"], fp):
+        print(f"Unchanged {outname}, not redrawn")
+        return
+
+    fig, ax = _new_canvas()
+    for col, (values, _, edges), text in curves:
+        if values.sum() > 0:
+            values = values / values.sum()
+        ax.stairs(values, edges, color=col, lw=2, label=text)
+    edges = curves[0][1].edges
+    ax.set_xlim(edges[0], edges[-1])   # axis range of the first histogram
+
+    ax.set_xlabel(root_latex(xaxis_title), fontsize=14)
+    ax.set_ylabel(style["yaxis_title"], fontsize=14)
+    ax.legend(frameon=False, loc="upper right", bbox_to_anchor=(0.9, 0.88), bbox_transform=fig.transFigure)
+    fig.text(0.11, 0.92, style["labels"][0], fontsize=14)
+    fig.text(0.6, 0.92, style["labels"][1], fontsize=14)
+
+    if book is not None:
+        book.add(fig, book_path("overlay", op_str, hdir_str), outname)
+        plt.close(fig)
+        return
+    with stage("saveas", file=outname):
+        fig.savefig(outname + ".png")
+        fig.savefig(outname + ".pdf")
+    record([outname + ".png", outname + ".pdf"], fp)
+    plt.close(fig)
@@ -0,0 +1,54 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+SIDECAR_SUFFIX = ".fp.json"   # next to the first output of a plot
+_source_hashes = {}
+
+
+def _source_hash(path):
+    # Drawing code is hashed once per process
+    if path not in _source_hashes:
+        with open(path, "rb") as f:
+            _source_hashes[path] = hashlib.sha256(f.read()).hexdigest()
+    return _source_hashes[path]
+
+
+def plot_fingerprint(hists, style, sources):
+    """Content hash of one plot as it would be drawn.
+
+    `hists` are the HistArrays after rebinning, `style` a JSON-able dict of
+    everything else that ends up on the canvas (colors, markers, axis titles
+    and ranges, legend text) and `sources` the files of the drawing code.
+    """
+    sha = hashlib.sha256()
+    sha.update(json.dumps(style, sort_keys=True).encode())
+    for path in sources:
+        sha.update(_source_hash(path).encode())
+    for h in hists:
+        for arr in h:
+            arr = np.ascontiguousarray(arr, dtype="<f8")
+            sha.update(str(arr.shape).encode())
+            sha.update(arr.tobytes())
+    return sha.hexdigest()
+
+
+def is_current(outputs, fp):
+    # True if every output exists and was written from the same fingerprint
+    try:
+        with open(outputs[0] + SIDECAR_SUFFIX) as f:
+            sidecar = json.load(f)
+    except (OSError, ValueError):
+        return False
+    return (sidecar.get("fingerprint") == fp and sidecar.get("outputs") == list(outputs)
+            and all(os.path.exists(out) for out in outputs))
+
+
+def record(outputs, fp):
+    sidecar = outputs[0] + SIDECAR_SUFFIX
+    tmp = sidecar + f".{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump({"fingerprint": fp, "outputs": list(outputs)}, f)
+    os.replace(tmp, sidecar)
@@ -0,0 +1,332 @@
+import ctypes
+import functools
+import gc
+import multiprocessing as mp
+import time
+import traceback
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from hist_loader import clear_cache, release_root_objects
+from sharding import SHARD_DIR, parse_shard, shard_items, write_manifest
+from stage_timer import rss_mb, stage
+
+
+def _run_one(render, args):
+    try:
+        return render(*args), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+_started = None   # in pool workers: where each task announces itself before it runs
+
+
+def _init_worker(started):
+    global _started
+    _started = started
+
+
+def _run_announced(render, args, index):
+    # SimpleQueue.put writes straight to the pipe, so the announcement survives a crash right after it
+    _started.put(index)
+    return _run_one(render, args)
+
+
+def _pool(jobs, started=None):
+    return ProcessPoolExecutor(max_workers=jobs, mp_context=mp.get_context("spawn"),
+                               initializer=_init_worker if started is not None else None,
+                               initargs=(started,) if started is not None else ())
+
+
+def _run_alone(render, args):
+    # One task in a fresh single-worker pool: a crash now is this task's own
+    with _pool(1) as pool:
+        try:
+            return pool.submit(_run_one, render, args).result()
+        except BrokenProcessPool as exc:
+            return None, f"worker process died while running this task: {exc!r}"
+        except Exception as exc:
+            return None, f"worker process failed: {exc!r}"
+
+
+def _run_pool(render, tasks, jobs):
+    """Outcome (result, err) of every task, by index, from a pool of `jobs` spawned workers.
+
+    A worker that dies (e.g. a ROOT segfault) breaks the whole pool. The tasks
+    that were running then are rerun one by one in a pool of their own, which
+    pins the crash on the task that causes it, and the tasks that had not
+    started go to a new pool.
+    """
+    outcomes = {}
+    pending = list(range(len(tasks)))
+    ctx = mp.get_context("spawn")
+    while pending:
+        started = ctx.SimpleQueue()
+        broken = False
+        with _pool(jobs, started) as pool:
+            futures = [(i, pool.submit(_run_announced, render, tasks[i][1], i)) for i in pending]
+            for i, fut in futures:
+                try:
+                    outcomes[i] = fut.result()
+                except BrokenProcessPool:
+                    broken = True
+                except Exception as exc:
+                    outcomes[i] = None, f"worker process failed: {exc!r}"
+        if not broken:
+            break
+        running = set()
+        while not started.empty():
+            running.add(started.get())
+        suspects = [i for i in pending if i in running and i not in outcomes] or \
+                   [i for i in pending if i not in outcomes][:1]
+        print(f"A worker process died, rerunning {len(suspects)} task(s) that were running one at a time")
+        for i in suspects:
+            outcomes[i] = _run_alone(render, tasks[i][1])
+        pending = [i for i in pending if i not in outcomes]
+    return outcomes
+
+
+def run_tasks(render, tasks, jobs=1, results=None):
+    """Run render(*args) for every (label, args) task, in `jobs` processes if jobs > 1.
+
+    Workers are started with "spawn", so each one imports the calling script
+    afresh and gets its own batch-mode ROOT. A failing task is reported under
+    its label and does not stop the others, a crashing worker process neither
+    (see _run_pool()). Returns the list of failed labels; if a `results` dict
+    is given, what render() returned is stored under the label of every task
+    that succeeded.
+    """
+    failures = []
+    if jobs <= 1:
+        outcomes = (_run_one(render, args) for _, args in tasks)
+    else:
+        pool_outcomes = _run_pool(render, tasks, jobs)
+        # Reported in submission order so the report is deterministic
+        outcomes = (pool_outcomes[i] for i in range(len(tasks)))
+    for (label, _), (result, err) in zip(tasks, outcomes):
+        if err:
+            print(f"FAILED {label}\n{err}")
+            failures.append(label)
+        elif results is not None:
+            results[label] = result
+
+    print(f"{len(tasks) - len(failures)}/{len(tasks)} configs done, {len(failures)} failed")
+    return failures
+
+
+# -----------------
+# Streaming: one task at a time in this process, with flat memory
+# -----------------
+def _trim_heap():
+    # Hand freed heap pages back to the system (glibc only)
+    try:
+        ctypes.CDLL("libc.so.6").malloc_trim(0)
+    except (OSError, AttributeError):
+        pass
+
+
+class MemoryCeilingExceeded(RuntimeError):
+    pass
+
+
+class MemoryCeiling:
+    """Cleanup after every streamed unit, and a limit on the resident memory left behind.
+
+    after() closes the unit's canvases, drops the histogram read cache and
+    collects garbage, then measures the RSS. Above `max_rss` MB the free heap
+    is returned to the system first; if that does not help, MemoryCeilingExceeded.
+    """
+
+    def __init__(self, max_rss=None):
+        self.max_rss = max_rss
+        self.rss = []
+
+    def after(self, label):
+        release_root_objects()
+        clear_cache()
+        gc.collect()
+        rss = rss_mb()
+        if self.max_rss and rss > self.max_rss:
+            _trim_heap()
+            rss = rss_mb()
+            if rss > self.max_rss:
+                raise MemoryCeilingExceeded(f"Resident memory {rss:.0f} MB above the {self.max_rss:.0f} MB ceiling after {label}")
+        self.rss.append(rss)
+        return rss
+
+    def report(self):
+        if not self.rss:
+            return
+        ceiling = f", ceiling {self.max_rss:.0f} MB" if self.max_rss else ""
+        print(f"Resident memory after {len(self.rss)} units: {self.rss[0]:.0f} MB after the first, "
+              f"{self.rss[-1]:.0f} MB after the last, peak {max(self.rss):.0f} MB{ceiling}")
+
+
+def stream_tasks(render, tasks, max_rss=None):
+    """run_tasks() for very long runs: every task in this process, one after the other.
+
+    Nothing a task created outlives it (see MemoryCeiling.after()). Once the
+    memory ceiling is exceeded the run stops; the tasks not run count as failed.
+    """
+    ceiling = MemoryCeiling(max_rss)
+    failures = []
+    for n, (label, args) in enumerate(tasks):
+        _, err = _run_one(render, args)
+        if err:
+            print(f"FAILED {label}\n{err}")
+            failures.append(label)
+        try:
+            ceiling.after(label)
+        except MemoryCeilingExceeded as err:
+            print(f"{err}, stopping")
+            failures += [label for label, _ in tasks[n + 1:]]
+            break
+    ceiling.report()
+    print(f"{len(tasks) - len(failures)}/{len(tasks)} configs done, {len(failures)} failed")
+    return failures
+
+
+# -----------------
+# Prefetching: the next tasks' inputs read in threads while this thread renders
+# -----------------
+def _timed_load(load, args):
+    t0 = time.perf_counter()
+    loaded = load(*args)
+    return loaded, time.perf_counter() - t0
+
+
+def prefetch_tasks(render, tasks, load, depth=2, threads=2):
+    """run_tasks() with overlapped reading: render(*args, loaded=load(*args)) for every task, in order.
+
+    Rendering stays in this thread (ROOT); a pool of `threads` threads runs
+    load() for up to `depth` tasks ahead, so at most depth tasks' inputs wait
+    in memory. load() should spend its time where the GIL is released (file
+    I/O, uproot decompression). The time this thread waits for a load is the
+    reading that was not hidden behind rendering ("wait" stages in the trace).
+    """
+    failures = []
+    read = waited = 0.
+    t_start = time.perf_counter()
+    remaining = iter(tasks)
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=threads, thread_name_prefix="prefetch") as pool:
+        def refill():
+            for label, args in remaining:
+                pending.append((label, args, pool.submit(_timed_load, load, args)))
+                if len(pending) >= depth:
+                    return
+
+        refill()
+        while pending:
+            label, args, fut = pending.popleft()
+            t0 = time.perf_counter()
+            with stage("wait", task=label):
+                try:
+                    (loaded, elapsed), err = fut.result(), None
+                    read += elapsed
+                except Exception:
+                    err = traceback.format_exc()
+            waited += time.perf_counter() - t0
+            refill()   # the freed slot goes to the next task before this one is drawn
+            if not err:
+                _, err = _run_one(functools.partial(render, loaded=loaded), args)
+            if err:
+                print(f"FAILED {label}\n{err}")
+                failures.append(label)
+
+    hidden = max(0., 1. - waited / read) if read > 0 else 0.
+    print(f"Prefetch ({threads} threads, {depth} ahead): reading took {read:.2f} s, rendering waited {waited:.2f} s "
+          f"for it, {100 * hidden:.0f}% of the reading hidden; wall time {time.perf_counter() - t_start:.2f} s")
+    print(f"{len(tasks) - len(failures)}/{len(tasks)} configs done, {len(failures)} failed")
+    return failures
+
+
+# -----------------
+# Shared by the config-driven plotters: the common CLI options and the task dispatch
+# -----------------
+def add_render_options(parser, prefetch=False):
+    # Options of every config-driven plotter; `prefetch` adds --prefetch/--prefetch-threads
+    parser.add_argument("--jobs", type=int, default=1, help="number of worker processes (default 1)")
+    parser.add_argument("--backend", choices=["root", "uproot"], default="root",
+                        help="read/draw with PyROOT (default) or with uproot + matplotlib, without importing ROOT")
+    parser.add_argument("--store", help="read histograms from this memory-mapped store (hist_store.py) instead of the ROOT files")
+    parser.add_argument("--trace", metavar="OUT.json",
+                        help="write a Chrome trace of the open/get/rebin/fit/draw/SaveAs stages and print the hot spots")
+    parser.add_argument("--force", action="store_true",
+                        help="redraw every plot, even when its output fingerprint says nothing changed")
+    parser.add_argument("--stream", action="store_true",
+                        help="render one unit at a time in this process and release everything it created")
+    parser.add_argument("--max-rss", type=float, metavar="MB",
+                        help="with --stream, stop when the resident memory after a unit stays above MB (implies --stream)")
+    if prefetch:
+        parser.add_argument("--prefetch", type=int, default=0, metavar="N",
+                            help="read the next N configs' histograms in background threads (uproot) while drawing")
+        parser.add_argument("--prefetch-threads", type=int, default=2, help="--prefetch reader threads (default 2)")
+    parser.add_argument("--channels", nargs="+", help="with a config template, only these channels")
+    parser.add_argument("--regions", nargs="+", help="with a config template, only these regions")
+    parser.add_argument("--explain", action="store_true",
+                        help="print the plan (entries and the histograms read per directory) and exit without drawing")
+    parser.add_argument("--book", action="store_true",
+                        help="write one multi-page PDF per sample and channel instead of a file per plot (renders in one process)")
+    parser.add_argument("--thumbnails", action="store_true", help="with --book, also write low-resolution PNG thumbnail sheets")
+    add_shard_options(parser)
+
+
+def add_shard_options(parser):
+    # --shard/--shard-dir alone, for a plotter without the other render options
+    parser.add_argument("--shard", type=parse_shard, metavar="i/N",
+                        help="render only piece i of N (0-based) of the units, for job arrays; "
+                             "merge and check the pieces with sharding.py")
+    parser.add_argument("--shard-dir", default=SHARD_DIR, help=f"where --shard writes its manifest (default {SHARD_DIR})")
+
+
+def render_options(parser, args):
+    # main() keyword arguments from the options of add_render_options()
+    prefetch = getattr(args, "prefetch", 0)
+    stream = args.stream or args.max_rss is not None
+    if prefetch and stream:
+        parser.error("--prefetch and --stream are separate modes, give one of them")
+    options = {"jobs": args.jobs, "backend": args.backend, "store": args.store, "book": args.book,
+               "thumbnails": args.thumbnails, "force": args.force, "stream": stream, "max_rss": args.max_rss,
+               "channels": args.channels, "regions": args.regions, "explain_only": args.explain,
+               "shard": args.shard, "shard_dir": args.shard_dir}
+    if hasattr(args, "prefetch"):
+        options.update(prefetch=args.prefetch, prefetch_threads=args.prefetch_threads)
+    return options
+
+
+def render_tasks(render, tasks, jobs=1, plot_book=None, book_key=None, stream=False, max_rss=None,
+                 prefetch=0, prefetch_threads=2, load=None, shard=None, shard_dir=SHARD_DIR, name="render"):
+    """Run the (label, args) tasks of a plotter the way its options ask for. Returns the failed labels.
+
+    Without a book, streaming or prefetching the tasks go to run_tasks() with
+    `jobs` processes. Otherwise everything is drawn from this process, a
+    book's pages together (`book_key` of a task), and the book is closed at
+    the end. With a `shard` (i, N) only that piece of the tasks is run, whole
+    books at a time, and a manifest for sharding.py is written as `name`.
+    """
+    all_labels = [label for label, _ in tasks]
+    if shard is not None:
+        tasks = shard_items(tasks, shard, key=book_key if plot_book is not None else None)
+    try:
+        if plot_book is None and not stream and not prefetch:
+            failures = run_tasks(render, tasks, jobs)
+        else:
+            if jobs > 1:
+                print("--book, --stream and --prefetch render in one process, --jobs ignored")
+            if plot_book is not None:
+                tasks = sorted(tasks, key=book_key)
+            if stream:
+                failures = stream_tasks(render, tasks, max_rss)
+            elif prefetch:
+                failures = prefetch_tasks(render, tasks, load, prefetch, prefetch_threads)
+            else:
+                failures = run_tasks(render, tasks)
+    finally:
+        if plot_book is not None:
+            plot_book.close()
+    if shard is not None:
+        write_manifest(name, shard, all_labels, [label for label, _ in tasks], failures, shard_dir=shard_dir)
+    return failures
@@ -0,0 +1,119 @@
+import io
+import os
+
+import numpy as np
+
+from hist_store import dir_metadata
+from stage_timer import stage
+
+THUMB_COLS = 4
+THUMB_ROWS = 4            # thumbnails per sheet: THUMB_COLS x THUMB_ROWS
+THUMB_SIZE = (300, 225)   # pixels per thumbnail (ROOT canvases)
+THUMB_DPI = 30            # matplotlib figures (8x6 in -> 240x180 px)
+
+
+def book_path(prefix, op_str, hdir_str):
+    # One book per sample and channel: SRvsCR_DyJets_ee.pdf, overlay_Signal_mumu.pdf
+    meta = dir_metadata(hdir_str)
+    return f"{prefix}_{op_str}_{meta['channel'] or meta['region']}.pdf"
+
+
+class PlotBook:
+    """Multi-page PDFs instead of one file per plot.
+
+    add() appends a ROOT canvas or matplotlib figure as a page of the book at
+    `path`. ROOT can only write one multi-page PDF at a time, so the pages of
+    a book have to come in one go: a book is closed when the next one starts
+    and cannot be reopened. With thumbnails, every 16 pages also go on a
+    low-resolution PNG sheet <book>_thumbs_<k>.png.
+    """
+
+    def __init__(self, thumbnails=False):
+        self.thumbnails = thumbnails
+        self.current = None   # [path, kind, pages, writer, sheet]
+        self.done = {}        # path -> number of pages
+
+    def add(self, canvas, path, title=""):
+        if self.current is None or self.current[0] != path:
+            if path in self.done:
+                raise RuntimeError(f"Book {path} is already closed, its pages have to be drawn together")
+            self.close()
+            self.current = [path, "mpl" if hasattr(canvas, "savefig") else "root", 0, None, None]
+        with stage("saveas", file=path, page=self.current[2] + 1):
+            if self.current[1] == "mpl":
+                self._add_mpl(canvas, title)
+            else:
+                self._add_root(canvas, title)
+        self.current[2] += 1
+
+    def _add_root(self, c, title):
+        path, _, page, _, sheet = self.current
+        if page == 0:
+            c.Print(path + "[")
+        c.Print(path, "Title:" + title)
+        if self.thumbnails:
+            n = page % (THUMB_COLS * THUMB_ROWS)
+            if n == 0:
+                self._flush_sheet()
+                import ROOT
+                sheet = ROOT.TCanvas(f"thumbs_{len(self.done)}", "", THUMB_COLS * THUMB_SIZE[0], THUMB_ROWS * THUMB_SIZE[1])
+                sheet.Divide(THUMB_COLS, THUMB_ROWS)
+                self.current[4] = sheet
+            sheet = self.current[4]
+            sheet.cd(n + 1)
+            c.DrawClonePad()   # copy of the page in the sheet's pad, independent of `c`
+
+    def _add_mpl(self, fig, title):
+        if self.current[3] is None:
+            from matplotlib.backends.backend_pdf import PdfPages
+            self.current[3] = PdfPages(self.current[0])
+        self.current[3].savefig(fig)
+        if self.thumbnails:
+            import matplotlib.pyplot as plt
+            if self.current[2] % (THUMB_COLS * THUMB_ROWS) == 0:
+                self._flush_sheet()
+                self.current[4] = []
+            buf = io.BytesIO()
+            fig.savefig(buf, format="png", dpi=THUMB_DPI)
+            buf.seek(0)
+            self.current[4].append(plt.imread(buf))
+
+    def _flush_sheet(self):
+        # Write the current, possibly partly filled, thumbnail sheet
+        path, kind, page, _, sheet = self.current
+        if sheet is None:
+            return
+        k = (page - 1) // (THUMB_COLS * THUMB_ROWS) + 1
+        outname = f"{os.path.splitext(path)[0]}_thumbs_{k}.png"
+        if kind == "root":
+            sheet.SaveAs(outname)
+            sheet.Close()
+        else:
+            import matplotlib.pyplot as plt
+            h = max(img.shape[0] for img in sheet)
+            w = max(img.shape[1] for img in sheet)
+            out = np.ones((THUMB_ROWS * h, THUMB_COLS * w, 4))
+            for i, img in enumerate(sheet):
+                r, col = divmod(i, THUMB_COLS)
+                out[r*h:r*h + img.shape[0], col*w:col*w + img.shape[1], :img.shape[2]] = img
+            used = -(-len(sheet) // THUMB_COLS) * h   # drop empty rows
+            plt.imsave(outname, out[:used])
+        self.current[4] = None
+        print(f"Saved {outname}")
+
+    def close(self):
+        # Finish the open book; call once after the last page
+        if self.current is None:
+            return
+        path, kind, pages, writer, _ = self.current
+        with stage("saveas", file=path):
+            if self.thumbnails:
+                self._flush_sheet()
+            if kind == "root":
+                import ROOT
+                ROOT.TCanvas("c_book_close", "", 10, 10).Print(path + "]")
+            else:
+                writer.close()
+        self.done[path] = pages
+        self.current = None
+        print(f"Saved {path} ({pages} pages)")
@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+import argparse
+import contextlib
+import importlib
+import io
+import json
+import os
+import socket
+import sys
+import time
+import traceback
+
+DEFAULT_SOCKET = os.environ.get("WR_PLOT_SOCKET", f"/tmp/wr_plot_server_{os.getuid()}.sock")
+
+# Job name -> script module; the job arguments are the script's own command line
+JOBS = {
+    "diffkinem": "diffKinem_CRvsSR_rooFit_plot",
+    "signal-overlay": "v1_signal_diffkinem",
+    "fit": "rooFit_plot_Wrmass_BW",
+}
+
+
+# -----------------
+# One JSON object per line in each direction
+# -----------------
+def send_message(conn, obj):
+    conn.sendall((json.dumps(obj) + "\n").encode())
+
+
+def recv_message(conn):
+    data = b""
+    while not data.endswith(b"\n"):
+        chunk = conn.recv(65536)
+        if not chunk:
+            break
+        data += chunk
+    return json.loads(data) if data else None
+
+
+# -----------------
+# Server
+# -----------------
+def warm_up(ROOT):
+    # Pay for cling and the RooFit/graphics libraries once, at startup
+    x = ROOT.RooRealVar("x_warmup", "", 0., 1.)
+    m = ROOT.RooRealVar("m_warmup", "", 0.5, 0., 1.)
+    w = ROOT.RooRealVar("w_warmup", "", 0.1, 0.01, 1.)
+    pdfs = [ROOT.RooGaussian("gauss_warmup", "", x, m, w), ROOT.RooBreitWigner("bw_warmup", "", x, m, w)]
+    c = ROOT.TCanvas("c_warmup", "", 10, 10)
+    frame = x.frame()
+    for pdf in pdfs:
+        pdf.plotOn(frame)
+    c.Close()
+
+
+def run_job(modules, ROOT, request):
+    from hist_loader import clear_cache
+
+    job, args = request.get("job"), request.get("args", [])
+    if job not in modules:
+        return {"status": 2, "output": f"Unknown job {job}, expected one of: {', '.join(JOBS)}\n"}
+
+    out = io.StringIO()
+    old_cwd = os.getcwd()
+    t0 = time.perf_counter()
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(out):
+        try:
+            os.chdir(request.get("cwd", old_cwd))   # relative paths and outputs as seen by the client
+            status = modules[job].cli(args)
+        except SystemExit as exc:   # argparse errors and --help
+            status = exc.code if isinstance(exc.code, int) else 1
+        except Exception:
+            traceback.print_exc()
+            status = 1
+        finally:
+            os.chdir(old_cwd)
+            # Inputs may change between jobs; canvases are per job. ROOT itself,
+            # its libraries, styles and the imported scripts stay loaded.
+            clear_cache()
+            for c in list(ROOT.gROOT.GetListOfCanvases()):
+                c.Close()
+    return {"status": status, "output": out.getvalue(), "seconds": time.perf_counter() - t0}
+
+
+def claim_socket(path):
+    # False if a server answers on `path`; a socket file nobody listens on is left over and removed
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except FileNotFoundError:
+        return True
+    except ConnectionRefusedError:
+        os.remove(path)
+        return True
+    finally:
+        probe.close()
+    return False
+
+
+def serve(path):
+    from hist_loader import root_batch
+
+    # Before the ROOT startup, so a second server gives up at once
+    if not claim_socket(path):
+        print(f"Plot server already running on {path}; stop it with: python3 plot_server.py stop")
+        return 1
+    t0 = time.perf_counter()
+    ROOT = root_batch()
+    modules = {job: importlib.import_module(name) for job, name in JOBS.items()}
+    warm_up(ROOT)
+
+    srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    srv.bind(path)
+    os.chmod(path, 0o600)
+    srv.listen()
+    print(f"Plot server ready on {path} (startup {time.perf_counter() - t0:.1f} s)")
+
+    try:
+        while True:
+            conn, _ = srv.accept()
+            with conn:
+                request = recv_message(conn)
+                if request is None:
+                    continue
+                if request.get("job") == "stop":
+                    send_message(conn, {"status": 0, "output": "Plot server stopped\n"})
+                    break
+                reply = run_job(modules, ROOT, request)
+                print(f"{request.get('job')} {' '.join(request.get('args', []))}: "
+                      f"status {reply['status']}, {reply.get('seconds', 0):.2f} s")
+                send_message(conn, reply)
+    finally:
+        srv.close()
+        os.remove(path)
+    return 0
+
+
+# -----------------
+# Client
+# -----------------
+def submit(job, args, path=DEFAULT_SOCKET):
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(path)
+    except (FileNotFoundError, ConnectionRefusedError):
+        print(f"No plot server on {path}; start one with: python3 plot_server.py serve")
+        return 1
+    with conn:
+        send_message(conn, {"job": job, "args": args, "cwd": os.getcwd()})
+        reply = recv_message(conn)
+    if reply is None:
+        print("Plot server closed the connection")
+        return 1
+    sys.stdout.write(reply["output"])
+    return reply["status"]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Keep ROOT warm in a resident plot server and send it jobs",
+        epilog="jobs: serve | stop | diffkinem <rootfiles...> <config.json> | "
+               "signal-overlay <rootfiles...> <config.json> | fit <rootfiles...> "
+               "(plus the options of the corresponding script)")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help=f"Unix socket path (default {DEFAULT_SOCKET})")
+    parser.add_argument("job", choices=["serve", "stop", *JOBS])
+    parser.add_argument("args", nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+
+    if args.job == "serve":
+        return serve(args.socket)
+    return submit(args.job, args.args, args.socket)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+import numpy as np
+
+from hist_loader import HistArrays
+from stage_timer import timed
+
+DEFAULT_WIDTH = 100.   # "rebin to ~100 GeV", the default of every script
+
+
+def group_starts(edges, target_width=DEFAULT_WIDTH, new_edges=None):
+    """Indices of the old bins that start each new bin, plus the index where the last one stops.
+
+    With `new_edges` (an explicit, possibly variable-width list from the JSON)
+    every new edge has to fall on an old one. Otherwise bins are merged into
+    groups of int(target_width/bin_width), as TH1::Rebin does; a remainder that
+    does not fill a whole group becomes a narrower last bin instead of being
+    dropped. Non-uniform input binning is cut at the first old edge past every
+    multiple of `target_width`.
+    """
+    edges = np.asarray(edges, dtype=float)
+    nbins = len(edges) - 1
+    widths = np.diff(edges)
+
+    if new_edges is not None:
+        new_edges = np.asarray(new_edges, dtype=float)
+        idx = np.searchsorted(edges, new_edges)
+        idx = np.clip(idx, 0, nbins)
+        # snap to the closer neighbour, then insist it really is an old edge
+        lower = np.clip(idx - 1, 0, nbins)
+        idx = np.where(np.abs(edges[lower] - new_edges) < np.abs(edges[idx] - new_edges), lower, idx)
+        tol = 1e-6 * widths.min()
+        bad = np.abs(edges[idx] - new_edges) > tol
+        if bad.any():
+            raise ValueError(f"Rebin edges {new_edges[bad].tolist()} do not match any existing bin edge")
+        if np.any(np.diff(idx) <= 0):
+            raise ValueError("Rebin edges must be strictly increasing")
+        return idx[:-1], idx[-1]
+
+    if np.allclose(widths, widths[0]):
+        factor = max(1, int(target_width/widths[0]))
+        return np.arange(0, nbins, factor), nbins
+
+    targets = edges[0] + target_width * np.arange(1, int(np.ceil((edges[-1] - edges[0]) / target_width)))
+    cuts = np.unique(np.searchsorted(edges, targets - 1e-9 * target_width))
+    cuts = cuts[(cuts > 0) & (cuts < nbins)]
+    return np.concatenate([[0], cuts]), nbins
+
+
+@timed("rebin")
+def rebin(values, sumw2, edges, target_width=DEFAULT_WIDTH, new_edges=None):
+    """Rebin one histogram or a stack of them (bins on the last axis) in one call.
+
+    `values` and `sumw2` may be 1-D or N-D arrays sharing `edges`; sumw2 is
+    summed like the contents, so errors stay sqrt(sum w^2). Content outside
+    explicit `new_edges` is dropped. Returns (values, sumw2, edges).
+    """
+    values = np.asarray(values, dtype=float)
+    sumw2 = values if sumw2 is None else np.asarray(sumw2, dtype=float)
+    edges = np.asarray(edges, dtype=float)
+
+    starts, stop = group_starts(edges, target_width, new_edges)
+    out_edges = np.append(edges[starts], edges[stop])
+    out_values = np.add.reduceat(values[..., :stop], starts, axis=-1)
+    out_sumw2 = np.add.reduceat(sumw2[..., :stop], starts, axis=-1)
+    return out_values, out_sumw2, out_edges
+
+
+def rebin_hist(h, target_width=DEFAULT_WIDTH, new_edges=None):
+    # HistArrays in, HistArrays out
+    return HistArrays(*rebin(h.values, h.sumw2, h.edges, target_width, new_edges))
+
+
+def stack_hists(hists):
+    """Stack HistArrays with identical binning into 2-D (nhists, nbins) arrays.
+
+    Returns (values, sumw2, edges), ready for a single rebin() call.
+    """
+    edges = hists[0].edges
+    for h in hists[1:]:
+        if len(h.edges) != len(edges) or not np.allclose(h.edges, edges):
+            raise ValueError("Cannot stack histograms with different binning")
+    return (np.stack([h.values for h in hists]),
+            np.stack([h.sumw2 for h in hists]),
+            np.asarray(edges, dtype=float))
@@ -1,32 +1,166 @@
 import ROOT
-import sys, re
+import sys, re, os, glob, csv, math, argparse, time
+import numpy as np
+from hist_loader import read_histograms, th1_to_arrays, as_arrays, arrays_to_th1, new_canvas, unique_name
+from rebinning import DEFAULT_WIDTH, rebin_hist, stack_hists
+from fit_cache import FitCache
+from hist_index import check_configs, report_problems
+from hist_store import open_store
+from parallel_render import run_tasks, MemoryCeiling, MemoryCeilingExceeded
+from batch_fit import MODELS, TOY_COLUMNS, mass_point, shape_and_jacobian, toy_table, print_toy_table, write_table
+import event_fit
+from stage_timer import stage, timed, tracing
+from sharding import SHARD_DIR, parse_shard, shard_items, shard_path, shard_seed, write_manifest
 
 # Comment out next line if you want interactive canvas pop-ups
 ROOT.gROOT.SetBatch(True)  
 ROOT.gStyle.SetOptStat(0)
 
-def iterative_gaussian_fit(h, mass_str, bin_width):
-    x = ROOT.RooRealVar("x", "m_{eejj} [GeV]", h.GetXaxis().GetXmin(), h.GetXaxis().GetXmax())
-    dh = ROOT.RooDataHist("dh_gauss", "dh_gauss", ROOT.RooArgList(x), h)
-
-    mean = ROOT.RooRealVar("mean", "mean", h.GetMean(), h.GetXaxis().GetXmin(), h.GetXaxis().GetXmax())
-    sigma = ROOT.RooRealVar("sigma", "sigma", h.GetRMS(), 10., 1000.)
-    gauss = ROOT.RooGaussian("gauss", "Gaussian PDF", x, mean, sigma)
-
-    # Iterative narrowing
-    for _ in range(3):
-        gauss.fitTo(dh, ROOT.RooFit.Save(), ROOT.RooFit.PrintLevel(-1))
-        mval, sval = mean.getVal(), sigma.getVal()
-        low, high = max(h.GetXaxis().GetXmin(), mval - 1.5*sval), min(h.GetXaxis().GetXmax(), mval + 1.5*sval)
-        x.setRange("narrow", low, high)
-
-    gauss.fitTo(dh, ROOT.RooFit.Save(), ROOT.RooFit.Range("narrow"), ROOT.RooFit.PrintLevel(-1))
+# The m_lljj histogram that is fitted
+HDIR = "wr_ee_resolved_sr"
+HISTNAME = "mass_fourobject_wr_ee_resolved_sr"
+
+# Narrowing settings of the two fits; bump FITTER_VERSION whenever the fit
+# procedure changes so that cached results are not reused
+NARROWING = {"gauss": {"window": 1.5, "iterations": 3},
+             "bw": {"window": 2.0, "iterations": 3}}
+FITTER_VERSION = 1
+
+# Adaptive narrowing: refit inside the window until mean and width move by
+# less than ADAPTIVE_TOL * width, at most ADAPTIVE_MAX_ITER narrow refits
+ADAPTIVE_TOL = 1e-3
+ADAPTIVE_MAX_ITER = 10
+
+# Scan mode: signal grid files and the per-(WR, N) result table
+SCAN_PATTERN = "WRAnalyzer_signal_WR*_N*.root"
+SCAN_COLUMNS = ["file", "wr", "n",
+                "gauss_mean", "gauss_mean_err", "gauss_sigma", "gauss_sigma_err",
+                "gauss_resolution", "gauss_resolution_err", "gauss_status",
+                "bw_mean", "bw_mean_err", "bw_width", "bw_width_err",
+                "bw_resolution", "bw_resolution_err", "bw_status", "status"]
+
+# Likelihood evaluation: (backend, cpus). Backend None keeps ROOT's default,
+# "legacy" or "cpu" (vectorized batch evaluation); cpus > 1 is RooFit's
+# multi-process likelihood (NumCPU), which needs the legacy backend
+FIT_BACKENDS = ["legacy", "cpu"]
+
+
+def fit_options(fit_eval=None):
+    # Extra fitTo() arguments for a (backend, cpus) choice
+    backend, cpus = fit_eval or (None, 1)
+    if cpus > 1:
+        if backend == "cpu":
+            raise ValueError("NumCPU needs the legacy evaluation backend")
+        backend = "legacy"
+    opts = []
+    if backend:
+        if hasattr(ROOT.RooFit, "EvalBackend"):
+            opts.append(ROOT.RooFit.EvalBackend(backend))
+        else:   # ROOT < 6.30
+            opts.append(ROOT.RooFit.BatchMode(backend == "cpu"))
+    if cpus > 1:
+        opts.append(ROOT.RooFit.NumCPU(cpus))
+    return opts
+
+
+def fit_cache_key(h, model, adaptive=False, tol=ADAPTIVE_TOL, start=None, fit_eval=None):
+    # An adaptive result depends on its warm start (the neighbouring point, i.e. on the
+    # files and shards of the run) and every result on the likelihood backend
+    harr = th1_to_arrays(h)
+    settings = dict(NARROWING[model], adaptive=adaptive, tol=tol if adaptive else None,
+                    start=list(start) if adaptive and start is not None else None,
+                    fit_eval=list(fit_eval) if fit_eval else None)
+    return FitCache.key(harr.values, harr.sumw2**0.5, harr.edges, f"roofit_{model}", settings, FITTER_VERSION)
+
+
+def run_narrowing(pdf, dh, x, mean, width, h, model, cache=None, adaptive=False, tol=ADAPTIVE_TOL, start=None,
+                  fit_eval=None):
+    # Fit pdf to dh with iterative narrowing and return {"fits": n, "fit_times": [...], "cached": bool,
+    # "status": status of the last fit, "mean_err": ..., "width_err": ...}
+    xmin, xmax = h.GetXaxis().GetXmin(), h.GetXaxis().GetXmax()
+    window = NARROWING[model]["window"]
+    fit_times = []
+    statuses = []
+    eval_opts = fit_options(fit_eval)
+
+    def fit(*opts):
+        t0 = time.perf_counter()
+        with stage("fit", model=model, range="narrow" if opts else "full"):
+            res = pdf.fitTo(dh, ROOT.RooFit.Save(), ROOT.RooFit.PrintLevel(-1), *eval_opts, *opts)
+        fit_times.append(time.perf_counter() - t0)
+        statuses.append(res.status())
+
+    def set_narrow():
+        mval, wval = mean.getVal(), width.getVal()
+        x.setRange("narrow", max(xmin, mval - window*wval), min(xmax, mval + window*wval))
+        return mval, wval
+
+    # Same histogram and settings fitted before: reuse the result
+    key = fit_cache_key(h, model, adaptive, tol, start, fit_eval) if cache else None
+    cached = cache.get(key) if cache else None
+    if cached:
+        mean.setVal(cached["mean"]); mean.setError(cached["mean_err"])
+        width.setVal(cached["width"]); width.setError(cached["width_err"])
+        set_narrow()
+        return {"fits": 0, "fit_times": [], "cached": True, "status": cached.get("status", 0),
+                "mean_err": cached["mean_err"], "width_err": cached["width_err"]}
+
+    if not adaptive:
+        # Iterative narrowing
+        for _ in range(NARROWING[model]["iterations"]):
+            fit()
+            set_narrow()
+        fit(ROOT.RooFit.Range("narrow"))
+    else:
+        # Warm start from the neighbouring mass point, or one full-range fit,
+        # then refit inside the narrowed window until it stops moving
+        if start is not None:
+            mean.setVal(min(max(start[0], mean.getMin()), mean.getMax()))
+            width.setVal(min(max(start[1], width.getMin()), width.getMax()))
+        else:
+            fit()
+        for _ in range(ADAPTIVE_MAX_ITER):
+            mval, wval = set_narrow()
+            fit(ROOT.RooFit.Range("narrow"))
+            if abs(mean.getVal() - mval) < tol*wval and abs(width.getVal() - wval) < tol*wval:
+                break
+        set_narrow()
+
+    status = statuses[-1] if statuses else 0
+    if cache:
+        cache.put(key, {"mean": mean.getVal(), "mean_err": mean.getError(),
+                        "width": width.getVal(), "width_err": width.getError(), "status": status})
+    return {"fits": len(fit_times), "fit_times": fit_times, "cached": False, "status": status,
+            "mean_err": mean.getError(), "width_err": width.getError()}
+
+
+def report_fit_cost(label, stats):
+    if stats["cached"]:
+        print(f"   {label}: cached result, no fits")
+    else:
+        per_fit = ", ".join(f"{t:.3f}" for t in stats["fit_times"])
+        print(f"   {label}: {stats['fits']} fits in {sum(stats['fit_times']):.3f} s ({per_fit} s)")
+
+
+def iterative_gaussian_fit(h, mass_str, bin_width, cache=None, adaptive=False, tol=ADAPTIVE_TOL, start=None, tag="",
+                           fit_eval=None):
+    # Fresh names on every call: RooFit objects and their frames are named globally
+    x = ROOT.RooRealVar(unique_name("x"), "m_{eejj} [GeV]", h.GetXaxis().GetXmin(), h.GetXaxis().GetXmax())
+    dh = ROOT.RooDataHist(unique_name("dh_gauss"), "dh_gauss", ROOT.RooArgList(x), h)
+
+    mean = ROOT.RooRealVar(unique_name("mean"), "mean", h.GetMean(), h.GetXaxis().GetXmin(), h.GetXaxis().GetXmax())
+    sigma = ROOT.RooRealVar(unique_name("sigma"), "sigma", h.GetRMS(), 10., 1000.)
+    gauss = ROOT.RooGaussian(unique_name("gauss"), "Gaussian PDF", x, mean, sigma)
+
+    stats = run_narrowing(gauss, dh, x, mean, sigma, h, "gauss", cache, adaptive, tol, start, fit_eval)
 
     # Plot
-    c = ROOT.TCanvas("c_gauss", "", 800, 600)
+    c = new_canvas("c_gauss", "", 800, 600)
     frame = x.frame()
     dh.plotOn(frame)
-    gauss.plotOn(frame, ROOT.RooFit.LineColor(ROOT.kBlue))
+    # The curve over the final window, normalised there, whether fitted now or taken from the cache
+    gauss.plotOn(frame, ROOT.RooFit.LineColor(ROOT.kBlue), ROOT.RooFit.Range("narrow"),
+                 ROOT.RooFit.NormRange("narrow"))
     frame.GetYaxis().SetTitle("Event yield / bin")
     frame.SetTitle("")
     frame.Draw()
@@ -39,38 +173,38 @@ def iterative_gaussian_fit(h, mass_str, bin_width):
     leg.AddEntry(0, f"#sigma = {sigma.getVal():.1f} GeV", "")
     leg.Draw()
 
-    outname = f"wr_mass_gauss_WR{mass_str}.png"
+    outname = f"wr_mass_gauss_WR{mass_str}{tag}.png"
     c.SetTitle("")
-    c.SaveAs(outname)
+    with stage("saveas", file=outname):
+        c.SaveAs(outname)
 
     print(f"â Saved {outname}")
     print(f"   Gaussian mean = {mean.getVal():.1f}, Ï = {sigma.getVal():.1f} (bin width {bin_width:.1f} GeV)")
 
-    return mean.getVal(), sigma.getVal()
+    report_fit_cost("Gaussian", stats)
 
+    return mean.getVal(), sigma.getVal(), stats
 
-def iterative_breitwigner_fit(h, mass_str, bin_width):
-    x = ROOT.RooRealVar("x", "m_{eejj} [GeV]", h.GetXaxis().GetXmin(), h.GetXaxis().GetXmax())
-    dh = ROOT.RooDataHist("dh_bw", "dh_bw", ROOT.RooArgList(x), h)
 
-    mean = ROOT.RooRealVar("mean", "mean", h.GetMean(), h.GetXaxis().GetXmin(), h.GetXaxis().GetXmax())
-    width = ROOT.RooRealVar("width", "width", h.GetRMS(), 10., 1000.)
-    bw = ROOT.RooBreitWigner("bw", "Breit-Wigner PDF", x, mean, width)
+def iterative_breitwigner_fit(h, mass_str, bin_width, cache=None, adaptive=False, tol=ADAPTIVE_TOL, start=None, tag="",
+                              fit_eval=None):
+    # Fresh names on every call: RooFit objects and their frames are named globally
+    x = ROOT.RooRealVar(unique_name("x"), "m_{eejj} [GeV]", h.GetXaxis().GetXmin(), h.GetXaxis().GetXmax())
+    dh = ROOT.RooDataHist(unique_name("dh_bw"), "dh_bw", ROOT.RooArgList(x), h)
 
-    # Iterative narrowing
-    for _ in range(3):
-        bw.fitTo(dh, ROOT.RooFit.Save(), ROOT.RooFit.PrintLevel(-1))
-        mval, wval = mean.getVal(), width.getVal()
-        low, high = max(h.GetXaxis().GetXmin(), mval - 2*wval), min(h.GetXaxis().GetXmax(), mval + 2*wval)
-        x.setRange("narrow", low, high)
+    mean = ROOT.RooRealVar(unique_name("mean"), "mean", h.GetMean(), h.GetXaxis().GetXmin(), h.GetXaxis().GetXmax())
+    width = ROOT.RooRealVar(unique_name("width"), "width", h.GetRMS(), 10., 1000.)
+    bw = ROOT.RooBreitWigner(unique_name("bw"), "Breit-Wigner PDF", x, mean, width)
 
-    bw.fitTo(dh, ROOT.RooFit.Save(), ROOT.RooFit.Range("narrow"), ROOT.RooFit.PrintLevel(-1))
+    stats = run_narrowing(bw, dh, x, mean, width, h, "bw", cache, adaptive, tol, start, fit_eval)
 
     # Plot
-    c = ROOT.TCanvas("c_bw", "", 800, 600)
+    c = new_canvas("c_bw", "", 800, 600)
     frame = x.frame()
     dh.plotOn(frame)
-    bw.plotOn(frame, ROOT.RooFit.LineColor(ROOT.kRed), ROOT.RooFit.LineStyle(2))
+    # The curve over the final window, normalised there, whether fitted now or taken from the cache
+    bw.plotOn(frame, ROOT.RooFit.LineColor(ROOT.kRed), ROOT.RooFit.LineStyle(2), ROOT.RooFit.Range("narrow"),
+              ROOT.RooFit.NormRange("narrow"))
     frame.GetYaxis().SetTitle("Event yield / bin")
     frame.SetTitle("")
     frame.Draw()
@@ -83,55 +217,539 @@ def iterative_breitwigner_fit(h, mass_str, bin_width):
     leg.AddEntry(0, f"#Gamma/2 = {width.getVal()/2:.1f} GeV", "")
     leg.Draw()
 
-    outname = f"wr_mass_bw_WR{mass_str}.png"
-    c.SaveAs(outname)
+    outname = f"wr_mass_bw_WR{mass_str}{tag}.png"
+    with stage("saveas", file=outname):
+        c.SaveAs(outname)
 
     print(f"â Saved {outname}")
     print(f"   Breit-Wigner mean = {mean.getVal():.1f}, Î = {width.getVal():.1f} (bin width {bin_width:.1f} GeV)")
 
-    return mean.getVal(), width.getVal()
+    report_fit_cost("Breit-Wigner", stats)
+
+    return mean.getVal(), width.getVal(), stats
 
 
-def fit_and_plot(filename, histname="mass_fourobject_wr_ee_resolved_sr"):
+def load_mass_histogram(filename, histname=HISTNAME, store=None):
+    # The m_lljj histogram as HistArrays: read detached, the file is closed
+    # again right away; or a view into the histogram store, if given
+    if store is not None:
+        h = open_store(store).read(filename, [(HDIR, histname)])[(HDIR, histname)]
+    else:
+        h = read_histograms(filename, [(HDIR, histname)])[(HDIR, histname)]
+    if not h:
+        raise RuntimeError(f"Histogram {histname} not found in {filename}")
+    return as_arrays(h)
+
+
+@timed("draw")
+def fit_and_plot(filename, histname=HISTNAME, rebin_width=DEFAULT_WIDTH, rebin_edges=None,
+                 cache=None, adaptive=False, tol=ADAPTIVE_TOL, start=None, store=None, tag="", fit_eval=None):
+    # start: optional {"gauss": (mean, width), "bw": (mean, width)} warm start for adaptive fits;
+    # tag: appended to the plot names; fit_eval: (backend, cpus) of the likelihood, see fit_options()
     # Extract WR mass from filename
     match = re.search(r"_WR(\d+)_", filename)
     mass_str = match.group(1) if match else "Unknown"
 
-    # Open ROOT file
-    f = ROOT.TFile.Open(filename)
-    hdir = f.Get("wr_ee_resolved_sr")
-    h = hdir.Get(histname)
-    if not h:
-        raise RuntimeError(f"Histogram {histname} not found in {filename}")
+    h = load_mass_histogram(filename, histname, store)
 
     # Rebin histogram to ~100 GeV
+    orig_width = h.edges[1] - h.edges[0]
+    h = arrays_to_th1(f"{histname}_rebin", rebin_hist(h, rebin_width, rebin_edges))
     bin_width = h.GetBinWidth(1)
-    rebin_factor = max(1, int(100/bin_width))
-    h.Rebin(rebin_factor)
-    bin_width = h.GetBinWidth(1)
+    rebin_factor = bin_width / orig_width
 
     print(f"\nð File: {filename}")
     print(f"   â Using histogram {histname}, WR mass {mass_str}")
-    print(f"   â Rebinning factor {rebin_factor}, new bin width {bin_width:.1f} GeV")
+    print(f"   â Rebinning factor {rebin_factor:g}, new bin width {bin_width:.1f} GeV")
 
     # Do both fits
-    g_mean, g_sigma = iterative_gaussian_fit(h, mass_str, bin_width)
-    bw_mean, bw_width = iterative_breitwigner_fit(h, mass_str, bin_width)
+    start = start or {}
+    g_mean, g_sigma, g_stats = iterative_gaussian_fit(h, mass_str, bin_width, cache, adaptive, tol, start.get("gauss"), tag,
+                                                      fit_eval)
+    bw_mean, bw_width, bw_stats = iterative_breitwigner_fit(h, mass_str, bin_width, cache, adaptive, tol, start.get("bw"), tag,
+                                                            fit_eval)
 
     print(f"--- Comparison for WR{mass_str} ---")
     print(f"   Gaussian Ï = {g_sigma:.1f}, Breit-Wigner Î = {bw_width:.1f}")
+    fit_time = sum(g_stats["fit_times"]) + sum(bw_stats["fit_times"])
+    print(f"   fitTo calls: Gaussian {g_stats['fits']}, Breit-Wigner {bw_stats['fits']}, {fit_time:.3f} s in total")
     print("---------------------------------\n")
 
-    return (g_mean, g_sigma, bw_mean, bw_width)
+    return {"gauss_mean": g_mean, "gauss_mean_err": g_stats["mean_err"],
+            "gauss_sigma": g_sigma, "gauss_sigma_err": g_stats["width_err"], "gauss_status": g_stats["status"],
+            "bw_mean": bw_mean, "bw_mean_err": bw_stats["mean_err"],
+            "bw_width": bw_width, "bw_width_err": bw_stats["width_err"], "bw_status": bw_stats["status"]}
+
+
+def wr_mass(filename):
+    match = re.search(r"_WR(\d+)_", filename)
+    return int(match.group(1)) if match else None
+
+
+def mass_order(filename):
+    # Points in WR mass, files without one last
+    return wr_mass(filename) is None, wr_mass(filename) or 0
+
+
+def main(files, use_cache=True, adaptive=False, tol=ADAPTIVE_TOL, store=None, stream=False, max_rss=None,
+         fit_eval=None, shard=None, shard_dir=SHARD_DIR):
+    if shard is None:
+        return fit_main(files, use_cache, adaptive, tol, store, stream, max_rss, fit_eval)
+    # Adaptive shards get a contiguous mass range, so the warm starts stay inside the shard.
+    # A shard that stops early counts all its points as failed.
+    selected = shard_items(sorted(files, key=mass_order) if adaptive else files, shard, contiguous=adaptive)
+    status = fit_main(selected, use_cache, adaptive, tol, store, stream, max_rss, fit_eval)
+    write_manifest("fit", shard, files, selected, selected if status else [], shard_dir=shard_dir)
+    return status
+
+
+def fit_main(files, use_cache=True, adaptive=False, tol=ADAPTIVE_TOL, store=None, stream=False, max_rss=None,
+             fit_eval=None):
+    # Check every input against its histogram index before the first fit
+    if report_problems(check_configs(files, [{"hdir_str": HDIR, "histname": HISTNAME}], store=store)):
+        return 1
+
+    cache = FitCache() if use_cache else None
+    # Streaming: release each point's canvases and check the memory it left behind
+    ceiling = MemoryCeiling(max_rss) if stream else None
+    try:
+        fit_files(files, cache, adaptive, tol, store, ceiling, fit_eval)
+    except MemoryCeilingExceeded as err:
+        print(f"{err}, stopping")
+        return 1
+    finally:
+        if ceiling is not None:
+            ceiling.report()
+    return 0
+
+
+def fit_files(files, cache, adaptive, tol, store, ceiling=None, fit_eval=None):
+    if not adaptive:
+        for filename in files:
+            fit_and_plot(filename, cache=cache, store=store, fit_eval=fit_eval)
+            if ceiling is not None:
+                ceiling.after(filename)
+        return
+
+    # Adaptive mode: walk the points in WR mass and warm-start each one from
+    # the previous fit, mean and width scaled by the mass ratio
+    previous = None
+    for filename in sorted(files, key=mass_order):
+        mass = wr_mass(filename)
+        start = None
+        if previous and mass and previous[0]:
+            scale = mass / previous[0]
+            start = {model: (m*scale, w*scale) for model, (m, w) in previous[1].items()}
+        res = fit_and_plot(filename, cache=cache, adaptive=True, tol=tol, start=start, store=store, fit_eval=fit_eval)
+        previous = (mass, {"gauss": (res["gauss_mean"], res["gauss_sigma"]), "bw": (res["bw_mean"], res["bw_width"])})
+        if ceiling is not None:
+            ceiling.after(filename)
+
+
+# -----------------
+# Event mode: m_lljj straight from the analyzer ntuples, streamed in chunks,
+# so the result does not depend on a rebin choice
+# -----------------
+def fit_histogram(h, model, fit_eval=None):
+    # Fit only, no plot: RooFit binned likelihood with the narrowing of the histogram fits
+    xmin, xmax = h.GetXaxis().GetXmin(), h.GetXaxis().GetXmax()
+    x = ROOT.RooRealVar(unique_name("x"), "m_{eejj} [GeV]", xmin, xmax)
+    dh = ROOT.RooDataHist(unique_name(f"dh_{model}"), f"dh_{model}", ROOT.RooArgList(x), h)
+    mean = ROOT.RooRealVar(unique_name("mean"), "mean", h.GetMean(), xmin, xmax)
+    width = ROOT.RooRealVar(unique_name("width"), "width", h.GetRMS(), 10., 1000.)
+    if model == "gauss":
+        pdf = ROOT.RooGaussian(unique_name("gauss"), "Gaussian PDF", x, mean, width)
+    else:
+        pdf = ROOT.RooBreitWigner(unique_name("bw"), "Breit-Wigner PDF", x, mean, width)
+    stats = run_narrowing(pdf, dh, x, mean, width, h, model, fit_eval=fit_eval)
+    return {"mean": mean.getVal(), "mean_err": stats["mean_err"], "width": width.getVal(),
+            "width_err": stats["width_err"], "status": stats["status"],
+            "low": x.getMin("narrow"), "high": x.getMax("narrow"), "fits": stats["fits"]}
+
+
+@timed("draw")
+def draw_event_fit(hist, fit, model, mass_str, label, tag=""):
+    # Events in ~100 GeV bins with the fitted shape, normalised to the events in the fit window
+    display = rebin_hist(hist, DEFAULT_WIDTH)
+    h = arrays_to_th1(unique_name("m_display"), display)
+    c = new_canvas(f"c_{model}_events", "", 800, 600)
+    h.SetMarkerStyle(20)
+    h.GetXaxis().SetTitle("m_{eejj} [GeV]")
+    h.GetYaxis().SetTitle("Event yield / bin")
+    h.Draw("ep")
+
+    p = np.array([[fit["mean"], fit["width"]]])
+    centers = 0.5 * (hist.edges[1:] + hist.edges[:-1])
+    inside = (centers >= fit["low"]) & (centers <= fit["high"])
+    fine = shape_and_jacobian(model, centers[inside], p)[0][0] * (hist.edges[1] - hist.edges[0])
+    norm = hist.values[inside].sum() * (display.edges[1] - display.edges[0]) / max(fine.sum(), 1e-300)
+    xs = np.linspace(fit["low"], fit["high"], 200)
+    ys = norm * shape_and_jacobian(model, xs, p)[0][0]
+    curve = ROOT.TGraph(len(xs), xs, ys)
+    curve.SetLineColor(ROOT.kBlue if model == "gauss" else ROOT.kRed)
+    curve.SetLineStyle(1 if model == "gauss" else 2)
+    curve.SetLineWidth(2)
+    curve.Draw("L same")
+
+    leg = ROOT.TLegend(0.55, 0.65, 0.85, 0.85)
+    leg.SetTextSize(0.04)
+    leg.SetBorderSize(0)
+    leg.SetFillStyle(0)
+    leg.AddEntry(0, f"M_WR = {mass_str} GeV", "")
+    if model == "gauss":
+        leg.AddEntry(0, f"#sigma = {fit['width']:.1f} GeV", "")
+    else:
+        leg.AddEntry(0, f"#Gamma/2 = {fit['width']/2:.1f} GeV", "")
+    leg.AddEntry(0, label, "")
+    leg.Draw()
 
+    outname = f"wr_mass_{model}_events_WR{mass_str}{tag}.png"
+    with stage("saveas", file=outname):
+        c.SaveAs(outname)
+    print(f"Saved {outname}")
 
-def main(files):
+
+def event_fit_and_plot(filename, likelihood="binned", fine_width=event_fit.FINE_WIDTH, tag="", fit_eval=None,
+                       **tree_args):
+    """Gaussian and Breit-Wigner fits of the event-level m_lljj of `filename`.
+
+    One streamed pass fills a `fine_width` GeV histogram; "binned" fits it with
+    RooFit, "unbinned" fits the events themselves (one more pass per minimizer
+    step). Either way memory is bounded by the chunk size, not the file size.
+    """
+    match = re.search(r"_WR(\d+)_", filename)
+    mass_str = match.group(1) if match else "Unknown"
+
+    hist, events = event_fit.fine_histogram(filename, fine_width, **tree_args)
+    print(f"\nFile: {filename}")
+    print(f"   {events} events, {hist.values.sum():.1f} weighted in range, {likelihood} likelihood")
+    if likelihood == "binned":
+        label = f"binned, {fine_width:g} GeV bins"
+        h = arrays_to_th1(unique_name("m_fine"), hist)
+    else:
+        label = "unbinned"
+
+    result = {}
+    for model, width in [("gauss", "sigma"), ("bw", "width")]:
+        if likelihood == "binned":
+            fit = fit_histogram(h, model, fit_eval)
+            cost = f"{fit['fits']} fits"
+        else:
+            fit = event_fit.narrowing_fit(filename, model, hist, **tree_args)
+            cost = f"{fit['passes']} passes over the events"
+        draw_event_fit(hist, fit, model, mass_str, label, tag)
+        print(f"   {model}: mean = {fit['mean']:.1f} +- {fit['mean_err']:.1f}, "
+              f"width = {fit['width']:.1f} +- {fit['width_err']:.1f} ({cost}, status {fit['status']})")
+        result.update({f"{model}_mean": fit["mean"], f"{model}_mean_err": fit["mean_err"],
+                       f"{model}_{width}": fit["width"], f"{model}_{width}_err": fit["width_err"],
+                       f"{model}_status": fit["status"]})
+    return result
+
+
+def main_events(files, likelihood="binned", fine_width=event_fit.FINE_WIDTH, fit_eval=None, shard=None,
+                shard_dir=SHARD_DIR, **tree_args):
+    selected = shard_items(files, shard)
+    failed = []
+    for filename in selected:
+        try:
+            event_fit_and_plot(filename, likelihood, fine_width, fit_eval=fit_eval, **tree_args)
+        except RuntimeError as err:
+            print(err)
+            failed.append(filename)
+    if shard is not None:
+        write_manifest("fit-events", shard, files, selected, failed, shard_dir=shard_dir)
+    return 1 if failed else 0
+
+
+# -----------------
+# Backend comparison: the same fits under every likelihood evaluation setup
+# -----------------
+def compare_backends(files, cpus=1, events=False, fine_width=event_fit.FINE_WIDTH, store=None, **tree_args):
+    """Fit every input with each (backend, cpus) setup, report wall time and parameter differences.
+
+    Nothing is cached or drawn. Differences are relative to the first setup
+    (legacy, one process), in units of its fit errors. With `events` the fine
+    event histogram is fitted, otherwise the usual ~100 GeV rebinned one.
+    """
+    setups = [("legacy", 1), ("cpu", 1)] + ([("legacy", cpus)] if cpus > 1 else [])
+    params = [("gauss", "mean"), ("gauss", "width"), ("bw", "mean"), ("bw", "width")]
+    worst = 0.
+    for filename in files:
+        if events:
+            hist, _ = event_fit.fine_histogram(filename, fine_width, **tree_args)
+        else:
+            hist = rebin_hist(load_mass_histogram(filename, store=store))
+        h = arrays_to_th1(unique_name("m_compare"), hist)
+        print(f"\n{filename} ({len(hist.values)} bins)")
+        print(f"  {'backend':8s} {'cpus':>4s} {'wall [s]':>9s} " + " ".join(f"{m + ' ' + k:>11s}" for m, k in params)
+              + f" {'max diff':>9s}")
+        reference = None
+        for setup in setups:
+            t0 = time.perf_counter()
+            fits = {model: fit_histogram(h, model, setup) for model in ("gauss", "bw")}
+            wall = time.perf_counter() - t0
+            if reference is None:
+                reference, diff = fits, "-"
+            else:
+                pulls = [abs(fits[m][k] - reference[m][k]) / max(reference[m][k + "_err"], 1e-12) for m, k in params]
+                worst = max(worst, max(pulls))
+                diff = f"{max(pulls):.2g} sig"
+            print(f"  {setup[0]:8s} {setup[1]:4d} {wall:9.3f} " + " ".join(f"{fits[m][k]:11.2f}" for m, k in params)
+                  + f" {diff:>9s}")
+    print(f"\nLargest parameter difference to legacy, 1 cpu: {worst:.2g} sigma")
+    return 0
+
+
+# -----------------
+# Scan mode: every signal point under a directory, fitted in a process pool
+# -----------------
+def find_signal_files(directory):
+    return sorted(glob.glob(os.path.join(directory, "**", SCAN_PATTERN), recursive=True))
+
+
+def scan_point(filename, use_cache=True, store=None, fit_eval=None):
+    # One grid point, run in a pool worker. Plot names get an _N<n> suffix,
+    # points sharing a WR mass would overwrite each other otherwise.
+    _, n = mass_point(filename)
+    cache = FitCache() if use_cache else None
+    return fit_and_plot(filename, cache=cache, store=store, tag=f"_N{n}" if n is not None else "", fit_eval=fit_eval)
+
+
+def resolution(width, width_err, mean, mean_err):
+    # width/mean with uncorrelated error propagation
+    if not mean:
+        return float("nan"), float("nan")
+    res = width / mean
+    return res, abs(res) * math.hypot(width_err / width if width else 0., mean_err / mean)
+
+
+def scan_rows(files, results):
+    # One table row per file; points whose fit raised are kept with status "failed"
+    rows = []
+    for filename in files:
+        wr, n = mass_point(filename)
+        row = {"file": filename, "wr": wr, "n": n}
+        res = results.get(filename)
+        if res is None:
+            row["status"] = "failed"
+        else:
+            row.update(res)
+            for model, width in [("gauss", "sigma"), ("bw", "width")]:
+                row[f"{model}_resolution"], row[f"{model}_resolution_err"] = resolution(
+                    res[f"{model}_{width}"], res[f"{model}_{width}_err"], res[f"{model}_mean"], res[f"{model}_mean_err"])
+            row["status"] = "ok" if res["gauss_status"] == 0 and res["bw_status"] == 0 else "not converged"
+        rows.append(row)
+    return rows
+
+
+def write_scan_table(rows, path):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=SCAN_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def read_scan_table(path):
+    # Rows of a written (or merged) scan table, numbers converted back
+    with open(path, newline="") as f:
+        rows = list(csv.DictReader(f))
+    for row in rows:
+        for key in SCAN_COLUMNS[1:-1]:
+            if row.get(key) in (None, ""):
+                row[key] = None
+            else:
+                row[key] = int(row[key]) if key in ("wr", "n") or key.endswith("_status") else float(row[key])
+    return rows
+
+
+@timed("draw")
+def draw_resolution_curves(rows):
+    # sigma/mu (solid) and Gamma/mu (dashed) vs M_WR, one curve per M_N, and vs M_N, one curve per M_WR
+    good = [r for r in rows if r["status"] != "failed" and r["wr"] is not None and r["n"] is not None]
+    if not good:
+        print("No fitted points, no resolution curves drawn")
+        return
+    colors = [ROOT.kBlue, ROOT.kRed, ROOT.kGreen+2, ROOT.kMagenta, ROOT.kOrange+7, ROOT.kCyan+2, ROOT.kViolet, ROOT.kGray+2]
+    # a point whose resolution is NaN (mean 0) must not set the axis range
+    finite = [v for r in good for v in (r["gauss_resolution"], r["bw_resolution"])
+              if v is not None and math.isfinite(v)]
+    if not finite:
+        print("No finite resolutions, no resolution curves drawn")
+        return
+    ymax = 1.3 * max(finite)
+
+    for xvar, group, xtitle, label, outname in [
+            ("wr", "n", "M_{W_{R}} [GeV]", "M_{N}", "wr_resolution_vs_mwr.png"),
+            ("n", "wr", "M_{N} [GeV]", "M_{W_{R}}", "wr_resolution_vs_mn.png")]:
+        xs = [r[xvar] for r in good]
+        pad = 0.05 * (max(xs) - min(xs)) or 100.
+        c = new_canvas(f"c_res_{xvar}", "", 800, 600)
+        frame = c.DrawFrame(min(xs) - pad, 0., max(xs) + pad, ymax)
+        frame.GetXaxis().SetTitle(xtitle)
+        frame.GetYaxis().SetTitle("Resolution (#sigma/#mu, #Gamma/#mu)")
+
+        leg = ROOT.TLegend(0.6, 0.6, 0.88, 0.88)
+        leg.SetTextSize(0.03)
+        leg.SetBorderSize(0)
+        leg.SetFillStyle(0)
+        leg.SetHeader("solid: #sigma/#mu, dashed: #Gamma/#mu")
+        graphs = []
+        for i, value in enumerate(sorted({r[group] for r in good})):
+            points = sorted((r for r in good if r[group] == value), key=lambda r: r[xvar])
+            for model, line_style, marker in [("gauss", 1, 20), ("bw", 2, 24)]:
+                g = ROOT.TGraphErrors(len(points))
+                for j, r in enumerate(points):
+                    g.SetPoint(j, r[xvar], r[f"{model}_resolution"])
+                    g.SetPointError(j, 0., r[f"{model}_resolution_err"])
+                g.SetLineColor(colors[i % len(colors)])
+                g.SetMarkerColor(colors[i % len(colors)])
+                g.SetLineStyle(line_style)
+                g.SetMarkerStyle(marker)
+                g.Draw("LP same")
+                graphs.append(g)
+            leg.AddEntry(graphs[-2], f"{label} = {value} GeV", "lp")
+        leg.Draw()
+        with stage("saveas", file=outname):
+            c.SaveAs(outname)
+        print(f"Saved {outname}")
+
+
+def scan(directory, jobs=1, use_cache=True, store=None, output="wr_mass_scan.csv", fit_eval=None, shard=None,
+         shard_dir=SHARD_DIR):
+    all_files = find_signal_files(directory)
+    if not all_files:
+        print(f"No {SCAN_PATTERN} files under {directory}")
+        return 1
+    files = shard_items(all_files, shard)
+    if report_problems(check_configs(files, [{"hdir_str": HDIR, "histname": HISTNAME}], store=store)):
+        return 1
+
+    t0 = time.perf_counter()
+    results = {}
+    failures = run_tasks(scan_point, [(f, (f, use_cache, store, fit_eval)) for f in files], jobs, results)
+    rows = scan_rows(files, results)
+    table = shard_path(output, shard)
+    write_scan_table(rows, table)
+    print(f"Fitted {len(files)} points in {time.perf_counter() - t0:.1f} s with {jobs} processes, saved {table}")
+    if shard is None:
+        draw_resolution_curves(rows)
+    else:
+        # The curves need every point: draw them from the merged table with --curves
+        write_manifest("fit-scan", shard, all_files, files, failures, {output: table}, shard_dir=shard_dir)
+    return 1 if failures else 0
+
+
+# -----------------
+# Toy mode: Poisson toys of every rebinned histogram, refitted in one batch (batch_fit.py, no RooFit)
+# -----------------
+def toy_errors(files, ntoys, seed=1, store=None, output="wr_mass_toys.csv", shard=None, shard_dir=SHARD_DIR):
+    """Bias and spread of mu, sigma, Gamma and sigma/mu (Gamma/mu) over `ntoys` Poisson toys per input.
+
+    The toys go through the batched NumPy version of the narrowing fits
+    (binned likelihood, as fitTo), all points and toys together, so the fit
+    errors can be checked against the toy spread without thousands of fitTo calls.
+    """
+    all_files, files = files, shard_items(files, shard)
+    groups = {}
     for filename in files:
-        fit_and_plot(filename)
+        h = rebin_hist(load_mass_histogram(filename, store=store))
+        groups.setdefault(tuple(h.edges), []).append((filename, h))
+
+    t0 = time.perf_counter()
+    rng = np.random.default_rng(shard_seed(seed, shard))
+    rows = []
+    for members in groups.values():
+        values, sumw2, edges = stack_hists([h for _, h in members])
+        with stage("fit", hists=len(members), toys=ntoys):
+            rows += toy_table([filename for filename, _ in members], values, sumw2, edges, ntoys, rng)
+    print_toy_table(rows, ntoys)
+    table = shard_path(output, shard)
+    write_table(rows, table, TOY_COLUMNS)
+    print(f"Fitted {ntoys} toys of {len(files)} histograms x {len(MODELS)} models in {time.perf_counter() - t0:.1f} s, "
+          f"saved {table}")
+    if shard is not None:
+        write_manifest("fit-toys", shard, all_files, files, [], {output: table}, shard_dir=shard_dir)
+    return 0
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Gaussian and Breit-Wigner fits of the m_lljj peak")
+    parser.add_argument("files", nargs="*", help="Input ROOT files")
+    parser.add_argument("--scan", metavar="DIR", help=f"fit every {SCAN_PATTERN} under DIR and write a resolution table and curves")
+    parser.add_argument("--jobs", type=int, default=1, help="worker processes for --scan (default 1)")
+    parser.add_argument("--output", default="wr_mass_scan.csv", help="--scan result table (default wr_mass_scan.csv)")
+    parser.add_argument("--no-cache", action="store_true", help="always refit, ignore and do not update the fit cache")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="refit inside the narrowed window until converged, warm-starting from the previous mass point")
+    parser.add_argument("--tol", type=float, default=ADAPTIVE_TOL,
+                        help=f"adaptive convergence tolerance, as a fraction of the width (default {ADAPTIVE_TOL})")
+    parser.add_argument("--store", help="read histograms from this memory-mapped store (hist_store.py) instead of the ROOT files")
+    parser.add_argument("--trace", metavar="OUT.json",
+                        help="write a Chrome trace of the open/get/rebin/fit/draw/SaveAs stages and print the hot spots")
+    parser.add_argument("--events", action="store_true",
+                        help="inputs are event-level ntuples: fit m_lljj from the tree, streamed in chunks, instead of a histogram")
+    parser.add_argument("--likelihood", choices=["binned", "unbinned"], default="binned",
+                        help=f"--events fit: RooFit on {event_fit.FINE_WIDTH:g} GeV bins (default) or unbinned on the events")
+    parser.add_argument("--fine-width", type=float, default=event_fit.FINE_WIDTH, help="--events histogram bin width in GeV")
+    parser.add_argument("--tree", default=event_fit.TREE, help=f"--events tree (default {event_fit.TREE})")
+    parser.add_argument("--branch", default=event_fit.MASS_BRANCH, help=f"--events m_lljj branch (default {event_fit.MASS_BRANCH})")
+    parser.add_argument("--weight", default=event_fit.WEIGHT_BRANCH,
+                        help=f"--events weight branch, unit weights if absent (default {event_fit.WEIGHT_BRANCH})")
+    parser.add_argument("--step-size", default=event_fit.STEP_SIZE, help=f"--events chunk size (default {event_fit.STEP_SIZE})")
+    parser.add_argument("--toys", type=int, default=0, metavar="N",
+                        help="fit N Poisson toys of every input (or --scan point) in one batch and report bias and spread")
+    parser.add_argument("--toy-output", default="wr_mass_toys.csv", help="--toys result table (default wr_mass_toys.csv)")
+    parser.add_argument("--seed", type=int, default=1, help="--toys random seed (default 1)")
+    parser.add_argument("--fit-backend", choices=FIT_BACKENDS,
+                        help="RooFit likelihood evaluation: legacy, or cpu (vectorized batch evaluation); default: ROOT's")
+    parser.add_argument("--fit-cpus", type=int, default=1,
+                        help="evaluate the likelihood in N processes (RooFit NumCPU, legacy backend)")
+    parser.add_argument("--compare-backends", action="store_true",
+                        help="fit the inputs with every backend (and --fit-cpus), report wall time and parameter differences")
+    parser.add_argument("--stream", action="store_true",
+                        help="release each point's canvases and RooFit objects before the next one and report the memory")
+    parser.add_argument("--max-rss", type=float, metavar="MB",
+                        help="stop when the resident memory after a point stays above MB (implies --stream)")
+    parser.add_argument("--curves", metavar="TABLE.csv",
+                        help="only draw the resolution curves from a --scan table (e.g. merged from shards) and exit")
+    parser.add_argument("--shard", type=parse_shard, metavar="i/N",
+                        help="fit only piece i of N (0-based) of the inputs or scan points, for job arrays; "
+                             "merge and check the pieces with sharding.py")
+    parser.add_argument("--shard-dir", default=SHARD_DIR, help=f"where --shard writes its manifest (default {SHARD_DIR})")
+    args = parser.parse_args(argv)
+    if args.curves:
+        draw_resolution_curves(read_scan_table(args.curves))
+        return 0
+    if not args.scan and not args.files:
+        parser.error("give input files or --scan DIR")
+    if args.scan and (args.adaptive or args.stream or args.max_rss is not None or args.tol != ADAPTIVE_TOL):
+        parser.error("--scan fits the points independently in a process pool; --adaptive, --tol, --stream and "
+                     "--max-rss apply to fitting a list of files")
+    if args.shard and args.compare_backends:
+        parser.error("--compare-backends times every setup on the same inputs and is not sharded")
+    if args.fit_cpus > 1 and args.fit_backend == "cpu":
+        parser.error("--fit-cpus needs --fit-backend legacy (NumCPU is a legacy-backend feature)")
+    fit_eval = (args.fit_backend, args.fit_cpus) if args.fit_backend or args.fit_cpus > 1 else None
+    tree_args = {"tree": args.tree, "branch": args.branch, "weight": args.weight, "step_size": args.step_size}
+    with tracing(args.trace):
+        if args.toys > 0:
+            return toy_errors(args.files or find_signal_files(args.scan), args.toys, args.seed, args.store,
+                              args.toy_output, args.shard, args.shard_dir)
+        if args.compare_backends:
+            return compare_backends(args.files, args.fit_cpus, args.events, args.fine_width, args.store, **tree_args)
+        if args.events:
+            return main_events(args.files, args.likelihood, args.fine_width, fit_eval, args.shard, args.shard_dir,
+                               **tree_args)
+        if args.scan:
+            return scan(args.scan, jobs=args.jobs, use_cache=not args.no_cache, store=args.store, output=args.output,
+                        fit_eval=fit_eval, shard=args.shard, shard_dir=args.shard_dir)
+        return main(args.files, use_cache=not args.no_cache, adaptive=args.adaptive, tol=args.tol, store=args.store,
+                    stream=args.stream or args.max_rss is not None, max_rss=args.max_rss, fit_eval=fit_eval,
+                    shard=args.shard, shard_dir=args.shard_dir)
 
 
 if __name__ == "__main__":
-    main(sys.argv[1:])
+    sys.exit(cli())
 
 
 # import ROOT, sys, re
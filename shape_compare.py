@@ -0,0 +1,200 @@
+import csv
+import time
+
+import numpy as np
+
+from hist_loader import read_arrays
+from hist_store import open_store
+from rebinning import DEFAULT_WIDTH, rebin
+from stage_timer import stage
+
+STATS_COLUMNS = ["rank", "file", "op_str", "histname", "histname1", "nbins", "chi2", "ndf", "chi2_ndf", "chi2_prob",
+                 "ks", "ks_prob", "max_pull", "outside_2sigma"]
+
+
+# -----------------
+# SR and CR of every (file, config entry) stacked: (nentries, nbins) arrays, zero-padded
+# -----------------
+def stack_entries(files, hist_configs, keys, store=None):
+    """Rebinned SR and CR arrays of every (file, entry), padded to a common number of bins.
+
+    Entries with the same input binning and rebinning are rebinned together in
+    one call. Returns (rows, sr_values, sr_sumw2, cr_values, cr_sumw2, mask,
+    edges): `rows` are (file, cfg) pairs, `mask` flags the real bins and
+    `edges` holds the bin edges of each row. Missing histograms are reported
+    and skipped.
+    """
+    groups = {}
+    for filename in files:
+        loaded = (open_store(store).read if store else read_arrays)(filename, keys)
+        for cfg in hist_configs:
+            if "hdir_cr_str" not in cfg:
+                continue
+            h_sr = loaded.get((cfg["hdir_str"], cfg["histname"]))
+            h_cr = loaded.get((cfg["hdir_cr_str"], cfg["histname1"]))
+            if h_sr is None or h_cr is None:
+                print(f"Histograms {cfg['histname']} and {cfg['histname1']} not found in {filename}, skipped")
+                continue
+            if len(h_sr.edges) != len(h_cr.edges) or not np.allclose(h_sr.edges, h_cr.edges):
+                print(f"{cfg['histname']} and {cfg['histname1']} in {filename} are binned differently, skipped")
+                continue
+            key = (tuple(h_sr.edges), cfg.get("rebin_width", DEFAULT_WIDTH), tuple(cfg.get("rebin_edges") or ()))
+            groups.setdefault(key, []).append(((filename, cfg), h_sr, h_cr))
+
+    rows, parts = [], []
+    with stage("rebin", entries=sum(len(m) for m in groups.values())):
+        for (edges, width, new_edges), members in groups.items():
+            values = np.stack([h.values for _, sr, cr in members for h in (sr, cr)])
+            sumw2 = np.stack([h.sumw2 for _, sr, cr in members for h in (sr, cr)])
+            values, sumw2, out_edges = rebin(values, sumw2, np.array(edges), width, list(new_edges) or None)
+            rows += [row for row, _, _ in members]
+            parts.append((values[0::2], sumw2[0::2], values[1::2], sumw2[1::2], out_edges))
+    if not rows:
+        raise RuntimeError("No SR/CR pairs to compare")
+
+    nbins = max(p[0].shape[1] for p in parts)
+    pad = lambda a: np.pad(a, ((0, 0), (0, nbins - a.shape[1])))
+    stacked = [np.concatenate([pad(p[i]) for p in parts]) for i in range(4)]
+    mask = np.concatenate([pad(np.ones_like(p[0], dtype=bool)) for p in parts])
+    edges = [p[4] for p in parts for _ in range(len(p[0]))]
+    return (rows, *stacked, mask, edges)
+
+
+# -----------------
+# Shape statistics, all entries at once
+# -----------------
+def shape_statistics(sr, sr_w2, cr, cr_w2, mask):
+    """Compatibility of the unit-area SR and CR shapes, one value per row.
+
+    chi2 over bins with an error (ndf = bins - 1 for the normalisation) and its
+    probability, the binned Kolmogorov-Smirnov distance with its asymptotic
+    probability for the effective entries, and the SR/CR ratio: the largest
+    |ratio - 1| in units of its error and the fraction of bins outside the
+    2 sigma band. Normalisation uncertainties are neglected.
+    """
+    from scipy.special import gammaincc, kolmogorov
+
+    n_sr = np.maximum(np.where(mask, sr, 0.).sum(axis=1), 1e-300)[:, None]
+    n_cr = np.maximum(np.where(mask, cr, 0.).sum(axis=1), 1e-300)[:, None]
+    p, q = sr / n_sr, cr / n_cr
+    var_p, var_q = sr_w2 / n_sr**2, cr_w2 / n_cr**2
+
+    var = var_p + var_q
+    used = mask & (var > 0)
+    chi2 = np.sum(np.where(used, (p - q)**2 / np.where(used, var, 1.), 0.), axis=1)
+    ndf = used.sum(axis=1) - 1
+    chi2_prob = np.where(ndf > 0, gammaincc(np.maximum(ndf, 1) / 2., chi2 / 2.), np.nan)
+
+    ks = np.max(np.abs(np.cumsum(np.where(mask, p - q, 0.), axis=1)), axis=1)
+    eff = lambda v, w2: np.where(mask, v, 0.).sum(axis=1)**2 / np.maximum(np.where(mask, w2, 0.).sum(axis=1), 1e-300)
+    n1, n2 = eff(sr, sr_w2), eff(cr, cr_w2)
+    ks_prob = kolmogorov(ks * np.sqrt(n1 * n2 / np.maximum(n1 + n2, 1e-300)))
+
+    ratio, ratio_err = ratio_band(p, var_p, q, var_q)
+    ok = used & (p > 0) & (q > 0)
+    pull = np.where(ok, np.abs(ratio - 1.) / np.where(ok, ratio_err, 1.), 0.)
+    outside = np.sum(ok & (pull > 2.), axis=1) / np.maximum(ok.sum(axis=1), 1)
+    return {"chi2": chi2, "ndf": ndf, "chi2_ndf": chi2 / np.maximum(ndf, 1), "chi2_prob": chi2_prob,
+            "ks": ks, "ks_prob": ks_prob, "max_pull": pull.max(axis=1), "outside_2sigma": outside}
+
+
+def ratio_band(p, var_p, q, var_q):
+    # SR/CR and its error; empty CR bins give ratio 0, error 0
+    safe_p = np.where(p > 0, p, 1.)
+    safe_q = np.where(q > 0, q, 1.)
+    ratio = np.where(q > 0, p / safe_q, 0.)
+    err = ratio * np.sqrt(np.where(p > 0, var_p / safe_p**2, 0.) + np.where(q > 0, var_q / safe_q**2, 0.))
+    return ratio, err
+
+
+def ranked_rows(rows, stats, edges):
+    # Least compatible first: chi2 probability, then chi2/ndf (the probabilities underflow to 0 for
+    # very different shapes); "index" is the row in the stack
+    order = np.lexsort((-stats["chi2_ndf"], np.nan_to_num(stats["chi2_prob"], nan=2.)))
+    table = []
+    for rank, i in enumerate(order, start=1):
+        filename, cfg = rows[i]
+        table.append({"rank": rank, "file": filename, "op_str": cfg["op_str"], "histname": cfg["histname"],
+                      "histname1": cfg["histname1"], "nbins": len(edges[i]) - 1, "index": int(i),
+                      **{k: stats[k][i].item() for k in STATS_COLUMNS[6:]}})
+    return table
+
+
+def write_stats(table, path):
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=STATS_COLUMNS, extrasaction="ignore")
+        writer.writeheader()
+        writer.writerows(table)
+
+
+# -----------------
+# Ratio panels: normalised SR and CR on top, SR/CR with the CR band below
+# -----------------
+def draw_ratio_panel(row, cfg, p, var_p, q, var_q, edges):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+    from mpl_plots import ROOT_COLORS, root_latex
+
+    fig, (top, bottom) = plt.subplots(2, 1, figsize=(8, 8), dpi=100, sharex=True,
+                                      gridspec_kw={"height_ratios": [3, 1], "hspace": 0.05})
+    centers = 0.5 * (edges[1:] + edges[:-1])
+    half = 0.5 * np.diff(edges)
+    for values, var, col, label in ((p, var_p, "kRed", "SR"), (q, var_q, "kBlue", "CR")):
+        top.errorbar(centers, values, xerr=half, yerr=np.sqrt(var), fmt="o", ms=4, color=ROOT_COLORS[col], label=label)
+    top.set_yscale("log")
+    top.set_ylabel("Normalized")
+    top.legend(title=f"{cfg['op_str']}: chi2/ndf = {row['chi2_ndf']:.2f}, KS = {row['ks']:.3f}", frameon=False)
+
+    ratio, ratio_err = ratio_band(p, var_p, q, var_q)
+    cr_band = np.where(q > 0, np.sqrt(var_q) / np.where(q > 0, q, 1.), 0.)
+    bottom.fill_between(edges, np.append(1 - cr_band, 1 - cr_band[-1]), np.append(1 + cr_band, 1 + cr_band[-1]),
+                        step="post", color=ROOT_COLORS["kBlue"], alpha=0.25, lw=0, label="CR stat.")
+    shown = q > 0
+    bottom.errorbar(centers[shown], ratio[shown], xerr=half[shown], yerr=ratio_err[shown], fmt="o", ms=4,
+                    color=ROOT_COLORS["kRed"])
+    bottom.axhline(1., color="k", lw=1)
+    bottom.set_ylim(0., 2.)
+    bottom.set_ylabel("SR / CR")
+    bottom.set_xlabel(root_latex(cfg["xaxis_title"]))
+    bottom.set_xlim(edges[0], edges[-1])
+    return fig
+
+
+# -----------------
+# Mode entry point
+# -----------------
+def compare_shapes(files, hist_configs, keys, store=None, output="shape_stats.csv", panels=0,
+                   panels_output="shape_ratios.pdf", top=20):
+    """Shape statistics of every (file, entry), a ranked table and optionally
+    the ratio panels of the `panels` least compatible entries as one PDF."""
+    t0 = time.perf_counter()
+    rows, sr, sr_w2, cr, cr_w2, mask, edges = stack_entries(files, hist_configs, keys, store)
+    with stage("fit", entries=len(rows), mode="shape-stats"):
+        stats = shape_statistics(sr, sr_w2, cr, cr_w2, mask)
+    table = ranked_rows(rows, stats, edges)
+    write_stats(table, output)
+    elapsed = time.perf_counter() - t0
+
+    print(f"{'rank':>4s} {'chi2/ndf':>9s} {'p(chi2)':>9s} {'KS':>6s} {'p(KS)':>9s} {'max pull':>8s}  entry")
+    for row in table[:top]:
+        print(f"{row['rank']:4d} {row['chi2_ndf']:9.2f} {row['chi2_prob']:9.2e} {row['ks']:6.3f} {row['ks_prob']:9.2e} "
+              f"{row['max_pull']:8.1f}  {row['op_str']} {row['histname']} ({row['file']})")
+    print(f"Compared {len(rows)} SR/CR pairs in {elapsed:.2f} s, saved {output}")
+
+    if panels > 0:
+        from plot_books import PlotBook
+        book = PlotBook()
+        import matplotlib.pyplot as plt
+        n_sr = np.maximum(np.where(mask, sr, 0.).sum(axis=1), 1e-300)[:, None]
+        n_cr = np.maximum(np.where(mask, cr, 0.).sum(axis=1), 1e-300)[:, None]
+        try:
+            for row in table[:panels]:
+                i, nbins = row["index"], row["nbins"]
+                fig = draw_ratio_panel(row, rows[i][1], sr[i, :nbins] / n_sr[i], sr_w2[i, :nbins] / n_sr[i]**2,
+                                       cr[i, :nbins] / n_cr[i], cr_w2[i, :nbins] / n_cr[i]**2, edges[i])
+                book.add(fig, panels_output, f"{row['rank']} {row['op_str']} {row['histname']}")
+                plt.close(fig)
+        finally:
+            book.close()
+    return table
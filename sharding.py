@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import os
+import subprocess
+import sys
+
+SHARD_DIR = "shards"   # where every shard leaves its manifest
+
+
+# -----------------
+# Splitting: shard i of N gets a fixed, disjoint part of the work
+# -----------------
+def parse_shard(text):
+    # argparse type for --shard i/N, 0 <= i < N (HTCondor $(Process), Slurm array ids from 0)
+    try:
+        i, n = (int(part) for part in text.split("/"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected i/N, got {text}")
+    if n < 1 or not 0 <= i < n:
+        raise argparse.ArgumentTypeError(f"shard {text} out of range, need 0 <= i < N")
+    return i, n
+
+
+def shard_items(items, shard, key=None, contiguous=False):
+    """The items of shard (i, N); the N shards are disjoint and cover every item.
+
+    Round robin in the given order, so shards are balanced and the split only
+    depends on the command line. Items with the same `key` (the pages of one
+    book) go to the same shard. `contiguous` gives block i of N instead, for
+    work that profits from neighbours (warm-started fits in mass order).
+    """
+    if shard is None:
+        return list(items)
+    i, n = shard
+    groups = {}
+    for item in items:
+        groups.setdefault(key(item) if key else len(groups), []).append(item)
+    groups = list(groups.values())
+    if contiguous:
+        picked = groups[i * len(groups) // n:(i + 1) * len(groups) // n]
+    else:
+        picked = groups[i::n]
+    return [item for group in picked for item in group]
+
+
+def shard_path(path, shard):
+    # wr_mass_scan.csv -> wr_mass_scan.shard-0-of-4.csv; unchanged without a shard
+    if shard is None:
+        return path
+    root, ext = os.path.splitext(path)
+    return f"{root}.shard-{shard[0]}-of-{shard[1]}{ext}"
+
+
+def shard_seed(seed, shard):
+    # Independent random streams per shard, the same seed without sharding
+    return seed if shard is None else [seed, shard[0]]
+
+
+def plan_id(labels):
+    # Identifies the full (unsharded) work list, so shards of different runs are never merged
+    return hashlib.sha256(json.dumps(list(labels)).encode()).hexdigest()[:16]
+
+
+def write_manifest(name, shard, all_labels, labels, failed, tables=None, extra=None, shard_dir=SHARD_DIR):
+    """Record what shard (i, N) of `name` was given and what failed.
+
+    `tables` maps a summary table as the unsharded run writes it to this
+    shard's part of it; merge() concatenates the parts. `extra` is stored as is.
+    """
+    i, n = shard
+    os.makedirs(shard_dir, exist_ok=True)
+    path = os.path.join(shard_dir, f"{name}.{plan_id(all_labels)}.shard-{i}-of-{n}.json")
+    manifest = {"name": name, "plan": plan_id(all_labels), "shard": i, "shards": n, "units": len(all_labels),
+                "assigned": list(labels), "failed": list(failed),
+                "tables": {os.path.abspath(k): os.path.abspath(v) for k, v in (tables or {}).items()},
+                "extra": extra}
+    tmp = path + f".{os.getpid()}.tmp"
+    with open(tmp, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp, path)
+    print(f"Shard {i}/{n} of {name}: {len(labels)} of {len(all_labels)} units, {len(failed)} failed, manifest {path}")
+    return path
+
+
+# -----------------
+# Merging: completeness check and the combined summary tables
+# -----------------
+def merge_tables(target, parts):
+    # Concatenate the CSV parts (same header) in shard order
+    header, rows = None, []
+    for part in parts:
+        with open(part, newline="") as f:
+            reader = csv.reader(f)
+            part_header = next(reader, None)
+            if part_header is None:
+                continue
+            if header is not None and part_header != header:
+                raise RuntimeError(f"{part} has different columns than the other parts of {target}")
+            header = part_header
+            rows += list(reader)
+    with open(target, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(header or [])
+        writer.writerows(rows)
+    return len(rows)
+
+
+def merge(shard_dir=SHARD_DIR):
+    """Check every sharded run found in `shard_dir` and merge its tables.
+
+    A run is complete when all N shard manifests are there and their units
+    add up to the full plan without overlap. Tables are only merged for
+    complete runs. Build state from sharded build.py runs goes into the state
+    file. Returns 0 if every run is complete without failures, else 1.
+    """
+    runs = {}
+    for path in sorted(glob.glob(os.path.join(shard_dir, "*.shard-*-of-*.json"))):
+        with open(path) as f:
+            manifest = json.load(f)
+        runs.setdefault((manifest["name"], manifest["plan"]), []).append(manifest)
+    if not runs:
+        print(f"No shard manifests in {shard_dir}")
+        return 1
+
+    status = 0
+    for (name, plan), manifests in sorted(runs.items()):
+        n, units = manifests[0]["shards"], manifests[0]["units"]
+        present = sorted(m["shard"] for m in manifests)
+        missing = sorted(set(range(n)) - set(present))
+        assigned = [label for m in manifests for label in m["assigned"]]
+        failed = [label for m in manifests for label in m["failed"]]
+        overlap = len(assigned) - len(set(assigned))
+        print(f"{name} (plan {plan}): {len(present)}/{n} shards, {len(set(assigned))}/{units} units, "
+              f"{len(failed)} failed")
+        if missing:
+            print(f"  missing shards: {', '.join(str(i) for i in missing)}")
+        if overlap or any(m["shards"] != n or m["units"] != units for m in manifests):
+            print("  shards disagree on the split (overlapping units or different N), rerun them with the same command")
+        for label in failed:
+            print(f"  FAILED {label}")
+        complete = not missing and not overlap and len(set(assigned)) == units
+        if not complete or failed:
+            status = 1
+        if not complete:
+            continue
+
+        manifests.sort(key=lambda m: m["shard"])
+        for target in manifests[0]["tables"]:
+            rows = merge_tables(target, [m["tables"][target] for m in manifests])
+            print(f"  merged {target} ({rows} rows)")
+        states = [m["extra"]["build_state"] for m in manifests if m.get("extra") and "build_state" in m["extra"]]
+        if states:
+            merge_build_state(states)
+    return status
+
+
+def merge_build_state(states):
+    # Targets built by the shards of a build.py run, recorded as if built in one go
+    from build import load_state, save_state
+
+    path = states[0]["state_file"]
+    state = load_state(path)
+    for part in states:
+        state["files"].update(part["files"])
+        state["targets"].update(part["targets"])
+    save_state(state, path)
+    print(f"  updated {path} ({sum(len(part['targets']) for part in states)} targets)")
+
+
+# -----------------
+# Local job array: N processes on this machine, then the merge
+# -----------------
+def run_local(n, command, shard_dir=SHARD_DIR):
+    procs = [subprocess.Popen(command + ["--shard", f"{i}/{n}", "--shard-dir", shard_dir]) for i in range(n)]
+    codes = [p.wait() for p in procs]
+    for i, code in enumerate(codes):
+        if code:
+            print(f"Shard {i}/{n} exited with {code}")
+    return merge(shard_dir)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge the outputs of --shard i/N runs and check they are complete, "
+                                                 "or run all N shards of a command locally")
+    parser.add_argument("--dir", default=SHARD_DIR, help=f"shard manifest directory (default {SHARD_DIR})")
+    parser.add_argument("--local", type=int, metavar="N",
+                        help="run the command N times with --shard 0/N ... N-1/N in parallel, then merge")
+    parser.add_argument("command", nargs=argparse.REMAINDER, help="with --local: the script and its arguments")
+    args = parser.parse_args()
+
+    if args.local:
+        command = args.command[1:] if args.command[:1] == ["--"] else args.command
+        if not command:
+            parser.error("--local needs a command, e.g. -- python3 batch_fit.py files...")
+        return run_local(args.local, command, args.dir)
+    return merge(args.dir)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,11 +1,18 @@
-import ROOT
-import sys, re, json
+import sys, re, json, argparse
+from hist_loader import (config_keys, read_histograms, cached_histograms, th1_to_arrays, arrays_to_th1, root_batch, new_canvas,
+                         release_root_objects)
+from rebinning import DEFAULT_WIDTH, rebin_hist
+from hist_index import check_configs, report_problems
+from stage_timer import stage, timed, tracing
+from parallel_render import add_shard_options, render_tasks
+from sharding import SHARD_DIR
 
-ROOT.gROOT.SetBatch(True)  
-ROOT.gStyle.SetOptStat(0)
+@timed("draw")
+def overlay_histograms(files, histname, hdir_str, op_str, xaxis_title,
+                       rebin_width=DEFAULT_WIDTH, rebin_edges=None, loaded=None):
+    ROOT = root_batch()
 
-def overlay_histograms(files, histname, hdir_str, op_str, xaxis_title):
-    c = ROOT.TCanvas("c_"+histname, "", 800, 600)
+    c = new_canvas("c_"+histname, "", 800, 600)
     ROOT.gPad.SetLogy()
     leg = ROOT.TLegend(0.55, 0.65, 0.85, 0.85)
     leg.SetTextSize(0.04)
@@ -19,20 +26,18 @@ def overlay_histograms(files, histname, hdir_str, op_str, xaxis_title):
         match = re.search(r"_WR(\d+)_", filename)
         mass_str = match.group(1) if match else filename
 
-        f = ROOT.TFile.Open(filename)
-        hdir = f.Get(hdir_str)
-        h_sr = hdir.Get(histname) if hdir else None
+        # Detached histograms preloaded by main(), or read just this one
+        if loaded is not None and filename in loaded:
+            file_hists = loaded[filename]
+        else:
+            file_hists = read_histograms(filename, [(hdir_str, histname)])
+        h_sr = file_hists.get((hdir_str, histname))
         if not h_sr:
             print(f"Histogram {histname} not found in {filename}")
             continue
 
-        h_sr.SetDirectory(0)   # detach from file
-        f.Close()              # safe to close now
-
-        # Rebin to ~100 GeV
-        bin_width = h_sr.GetBinWidth(1)
-        rebin_factor = max(1, int(100/bin_width))
-        h_sr.Rebin(rebin_factor)
+        # Rebin to ~100 GeV (or the config's width / edges)
+        h_sr = arrays_to_th1(f"{histname}_{i}", rebin_hist(th1_to_arrays(h_sr), rebin_width, rebin_edges))
 
         # Style
         h_sr.SetLineColor(i+2)
@@ -54,19 +59,41 @@ def overlay_histograms(files, histname, hdir_str, op_str, xaxis_title):
 
     leg.Draw()
     outname = f"overlay_{op_str}_{histname}.png"
-    c.SaveAs(outname)
+    with stage("saveas", file=outname):
+        c.SaveAs(outname)
     print(f"Saved {outname}")
 
-def main(files, config_file="hists.json"):
+def render_config(files, cfg, keys):
+    # One config entry over all files: a unit of --jobs and --shard; each file is read once per process
+    loaded = {filename: cached_histograms(filename, keys) for filename in files}
+    overlay_histograms(files, loaded=loaded, **cfg)
+    release_root_objects()   # this entry's canvas, before the next one is drawn
+
+def main(files, config_file="hists.json", jobs=1, shard=None, shard_dir=SHARD_DIR):
     with open(config_file, "r") as f:
         hist_configs = json.load(f)
-    for cfg in hist_configs:
-        overlay_histograms(files, **cfg)
+    if report_problems(check_configs(files, hist_configs)):
+        return [config_file]
+    keys = config_keys(hist_configs)
+    tasks = [(f"[{i}] {cfg['histname']}", (files, cfg, keys)) for i, cfg in enumerate(hist_configs)]
+    return render_tasks(render_config, tasks, jobs, shard=shard, shard_dir=shard_dir, name="signal-diffkinem")
 
-if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: python3 script.py <rootfiles...> <config.json>")
-        sys.exit(1)
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Overlay one distribution from several files per config entry")
+    parser.add_argument("inputs", nargs="+", help="<rootfiles...> <config.json>")
+    parser.add_argument("--jobs", type=int, default=1, help="number of worker processes (default 1)")
+    parser.add_argument("--trace", metavar="OUT.json",
+                        help="write a Chrome trace of the open/get/rebin/fit/draw/SaveAs stages and print the hot spots")
+    add_shard_options(parser)
+    args = parser.parse_args(argv)
+    if len(args.inputs) < 2:
+        print("Usage: python3 script.py [--jobs N] [--shard i/N] [--trace out.json] <rootfiles...> <config.json>")
+        return 1
+
+    *rootfiles, config_file = args.inputs
+    with tracing(args.trace):
+        failures = main(rootfiles, config_file, args.jobs, args.shard, args.shard_dir)
+    return 1 if failures else 0
 
-    *rootfiles, config_file = sys.argv[1:]
-    main(rootfiles, config_file)
+if __name__ == "__main__":
+    sys.exit(cli())
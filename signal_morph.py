@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+
+import argparse
+import json
+import math
+import time
+
+import numpy as np
+
+from batch_fit import MODELS, batch_fit, mass_point, write_table
+from hist_loader import read_arrays
+from hist_store import open_store
+from rebinning import DEFAULT_WIDTH, rebin, stack_hists
+from stage_timer import stage
+
+# -----------------
+# Settings: histogram as in rooFit_plot_Wrmass_BW.py, surfaces and template morphing
+# -----------------
+HDIR = "wr_ee_resolved_sr"
+HISTNAME = "mass_fourobject_wr_ee_resolved_sr"
+DEFAULT_MODEL = "signal_model.json"
+MODEL_VERSION = 1
+DEGREE = 1          # polynomial degree of the mean/width surfaces in (M_WR / TeV, M_N / M_WR)
+NEIGHBOURS = 3      # reference points blended into a morphed template
+CLOSURE_MIN_ENTRIES = 5.   # effective entries a bin needs to count in the closure chi2
+SHAPES = ("template", "gauss", "bw")
+
+CLOSURE_COLUMNS = ["label", "wr", "n", "gauss_mean", "gauss_mean_pred", "gauss_width", "gauss_width_pred",
+                   "bw_mean", "bw_mean_pred", "bw_width", "bw_width_pred", "shape_chi2_ndf", "shape_ks"]
+
+
+def grid_coords(wr, n):
+    # (M_WR in TeV, M_N / M_WR): the grid is roughly regular in these
+    wr = np.asarray(wr, dtype=float)
+    return np.stack([wr / 1000., np.asarray(n, dtype=float) / wr], axis=-1)
+
+
+def monomials(coords, degree):
+    # x^i r^j for i + j <= degree
+    x, r = coords[..., 0], coords[..., 1]
+    return np.stack([x**i * r**j for i in range(degree + 1) for j in range(degree + 1 - i)], axis=-1)
+
+
+# -----------------
+# Model building: fit every point once, then smooth surfaces through the results
+# -----------------
+def load_points(files, histdir=HDIR, histname=HISTNAME, store=None, rebin_width=DEFAULT_WIDTH):
+    """Rebinned m_lljj of every signal file, as a (npoints, nbins) stack with labels and (WR, N).
+
+    Files without WR/N in the name or without the histogram are skipped.
+    """
+    key = (histdir, histname)
+    labels, masses, hists = [], [], []
+    for filename in files:
+        wr, n = mass_point(filename)
+        if wr is None or n is None:
+            print(f"No WR/N mass point in the name of {filename}, skipped")
+            continue
+        h = (open_store(store).read if store else read_arrays)(filename, [key])[key]
+        if h is None:
+            print(f"Histogram {histdir}/{histname} not found in {filename}, skipped")
+            continue
+        labels.append(filename)
+        masses.append((wr, n))
+        hists.append(h)
+    if not hists:
+        raise RuntimeError("No signal points to build the model from")
+    values, sumw2, edges = rebin(*stack_hists(hists), rebin_width)
+    return labels, np.array(masses), values, sumw2, edges
+
+
+def fit_points(labels, masses, values, sumw2, edges):
+    """Reference points of the model: the batched Gaussian and Breit-Wigner fits and the
+    normalised cumulative shape of every histogram at the bin edges."""
+    with stage("fit", hists=len(labels)):
+        fits = {model: batch_fit(values, sumw2, edges, model) for model in MODELS}
+    total = np.maximum(values.sum(axis=1, keepdims=True), 1e-300)
+    cdf = np.concatenate([np.zeros((len(values), 1)), np.cumsum(values, axis=1) / total], axis=1)
+    points = []
+    for i, (label, (wr, n)) in enumerate(zip(labels, masses)):
+        point = {"label": label, "wr": int(wr), "n": int(n), "cdf": cdf[i].tolist(),
+                 "converged": all(bool(fits[m]["converged"][i]) for m in MODELS)}
+        for model in MODELS:
+            point[model] = {k: fits[model][k][i].item() for k in ("mean", "mean_err", "width", "width_err")}
+        points.append(point)
+    return points
+
+
+def fit_surfaces(points, degree=DEGREE):
+    """Error-weighted least-squares surfaces of mean / M_WR and width / M_WR.
+
+    Returns {model: {"mean": coefficients, "width": coefficients}} over the
+    monomials of grid_coords(). Points whose fits did not converge are left out.
+    """
+    used = [p for p in points if p["converged"]]
+    basis = monomials(grid_coords([p["wr"] for p in used], [p["n"] for p in used]), degree)
+    if len(used) < basis.shape[1]:
+        raise RuntimeError(f"Degree {degree} surfaces need {basis.shape[1]} converged points, got {len(used)}")
+    wr = np.array([p["wr"] for p in used], dtype=float)
+    surfaces = {}
+    for model in MODELS:
+        surfaces[model] = {}
+        for param in ("mean", "width"):
+            y = np.array([p[model][param] for p in used]) / wr
+            err = np.array([p[model][param + "_err"] for p in used]) / wr
+            w = 1. / np.maximum(err, 1e-6 * np.abs(y) + 1e-12)
+            coef = np.linalg.lstsq(basis * w[:, None], y * w, rcond=None)[0]
+            surfaces[model][param] = coef.tolist()
+    return surfaces
+
+
+def build_model(points, edges, degree=DEGREE, histdir=HDIR, histname=HISTNAME):
+    return {"version": MODEL_VERSION, "histdir": histdir, "histname": histname, "degree": degree,
+            "edges": np.asarray(edges, dtype=float).tolist(), "points": points,
+            "surfaces": fit_surfaces(points, degree)}
+
+
+def save_model(model, path):
+    with open(path, "w") as f:
+        json.dump(model, f, indent=1)
+
+
+def load_model(path):
+    with open(path) as f:
+        model = json.load(f)
+    if model.get("version") != MODEL_VERSION:
+        raise RuntimeError(f"{path} is a version {model.get('version')} model, expected {MODEL_VERSION}; rebuild it")
+    return model
+
+
+# -----------------
+# Predictions at any (WR, N)
+# -----------------
+def predict_params(model, wr, n):
+    # {model: (mean, width)} from the surfaces
+    basis = monomials(grid_coords(wr, n), model["degree"])
+    return {m: (wr * float(basis @ np.array(s["mean"])), wr * float(basis @ np.array(s["width"])))
+            for m, s in model["surfaces"].items()}
+
+
+def morph_template(model, wr, n, params, exclude=None):
+    """Unit-area binned m_lljj at (wr, n) from the NEIGHBOURS closest reference points.
+
+    Each reference cumulative shape is moved to the predicted Gaussian mean and
+    width (the shape in (m - mean) / width is kept) and the results are averaged
+    with inverse squared distance weights in grid_coords(). `exclude` leaves a
+    reference point out, for the closure test.
+    """
+    edges = np.array(model["edges"])
+    refs = [p for p in model["points"] if p["converged"] and p["label"] != exclude]
+    coords = grid_coords([p["wr"] for p in refs], [p["n"] for p in refs])
+    spread = np.where(coords.std(axis=0) > 0, coords.std(axis=0), 1.)
+    dist = np.hypot(*((coords - grid_coords(wr, n)) / spread).T)
+    nearest = np.argsort(dist)[:NEIGHBOURS]
+    weights = 1. / np.maximum(dist[nearest], 1e-9)**2
+    weights /= weights.sum()
+
+    mean, width = params["gauss"]
+    cdf = np.zeros(len(edges))
+    for k, weight in zip(nearest, weights):
+        ref = refs[k]
+        shifted = ref["gauss"]["mean"] + ref["gauss"]["width"] * (edges - mean) / width
+        cdf += weight * np.interp(shifted, edges, ref["cdf"])
+    values = np.diff(cdf)
+    return values / max(values.sum(), 1e-300)
+
+
+def parametric_shape(edges, model, mean, width):
+    # Unit-area binned Gaussian / Breit-Wigner
+    edges = np.asarray(edges, dtype=float)
+    if model == "gauss":
+        cdf = 0.5 * (1. + np.array([math.erf(z) for z in (edges - mean) / (math.sqrt(2.) * width)]))
+    else:
+        cdf = 0.5 + np.arctan((edges - mean) / (0.5 * width)) / math.pi
+    values = np.diff(cdf)
+    return values / max(values.sum(), 1e-300)
+
+
+def predict(model, wr, n, shape="template", exclude=None):
+    # Parameters and unit-area shape at one mass point
+    params = predict_params(model, wr, n)
+    if shape == "template":
+        values = morph_template(model, wr, n, params, exclude)
+    else:
+        values = parametric_shape(model["edges"], shape, *params[shape])
+    return params, values
+
+
+def outside_grid(model, wr, n):
+    coords = grid_coords([p["wr"] for p in model["points"]], [p["n"] for p in model["points"]])
+    target = grid_coords(wr, n)
+    return bool(np.any(target < coords.min(axis=0) - 1e-9) or np.any(target > coords.max(axis=0) + 1e-9))
+
+
+def write_shapes(model, targets, shape, path):
+    # One unit-area TH1D per target point, named like the input histogram with a _WR<wr>_N<n> suffix
+    import uproot
+
+    edges = np.array(model["edges"])
+    with uproot.recreate(path) as f:
+        for wr, n in targets:
+            params, values = predict(model, wr, n, shape)
+            f[f"{model['histname']}_WR{wr}_N{n}"] = (values, edges)
+            extrapolated = " (outside the grid, extrapolated)" if outside_grid(model, wr, n) else ""
+            print(f"WR {wr} N {n}{extrapolated}: " + ", ".join(
+                f"{m} mean = {mean:.1f}, width = {width:.1f}" for m, (mean, width) in params.items()))
+    print(f"Saved {len(targets)} {shape} shapes to {path}")
+
+
+# -----------------
+# Closure test: every reference point predicted from the others
+# -----------------
+def closure(model, values, sumw2, shape="template"):
+    """Leave-one-out predictions of every point against its own fit and histogram.
+
+    The surfaces are refitted without the point and its template is left out of
+    the morphing. The shape is compared as unit-area histograms: chi2/ndf with
+    the point's own errors and the largest difference of the cumulative shapes.
+    The chi2 uses bins with at least CLOSURE_MIN_ENTRIES effective entries, and
+    no bin variance below that of one entry of average weight: weights that
+    cancel leave bins with next to no variance that would dominate the sum.
+    """
+    rows = []
+    total = np.maximum(values.sum(axis=1), 1e-300)
+    for i, point in enumerate(model["points"]):
+        others = [p for p in model["points"] if p is not point]
+        held_out = dict(model, surfaces=fit_surfaces(others, model["degree"]))
+        params, pred = predict(held_out, point["wr"], point["n"], shape, exclude=point["label"])
+
+        actual = values[i] / total[i]
+        filled = (values[i] > 0) & (sumw2[i] > 0)
+        n_eff = np.where(filled, values[i]**2 / np.where(filled, sumw2[i], 1.), 0.)
+        used = n_eff >= CLOSURE_MIN_ENTRIES
+        floor = (sumw2[i].sum() / total[i])**2 / total[i]**2   # one entry of average weight, unit area
+        var = np.maximum(sumw2[i] / total[i]**2, floor)
+        chi2_ndf = np.sum((actual - pred)[used]**2 / var[used]) / max(used.sum() - 1, 1)
+        ks = np.max(np.abs(np.cumsum(actual) - np.cumsum(pred)))
+        row = {"label": point["label"], "wr": point["wr"], "n": point["n"],
+               "shape_chi2_ndf": chi2_ndf, "shape_ks": ks}
+        for m in MODELS:
+            row[f"{m}_mean"], row[f"{m}_width"] = point[m]["mean"], point[m]["width"]
+            row[f"{m}_mean_pred"], row[f"{m}_width_pred"] = params[m]
+        rows.append(row)
+    return rows
+
+
+def print_closure(rows):
+    for row in rows:
+        print(f"WR {row['wr']:5d} N {row['n']:5d}: "
+              + ", ".join(f"{m} mean {100 * (row[m + '_mean_pred'] / row[m + '_mean'] - 1):+.1f}%"
+                          f" width {100 * (row[m + '_width_pred'] / row[m + '_width'] - 1):+.1f}%" for m in MODELS)
+              + f", shape chi2/ndf = {row['shape_chi2_ndf']:.2f}, KS = {row['shape_ks']:.3f}")
+    for m in MODELS:
+        for param in ("mean", "width"):
+            rel = np.array([r[f"{m}_{param}_pred"] / r[f"{m}_{param}"] - 1 for r in rows])
+            print(f"{m:5s} {param:5s}: rms deviation {100 * np.sqrt(np.mean(rel**2)):.1f}%, "
+                  f"worst {100 * rel[np.argmax(np.abs(rel))]:+.1f}%")
+
+
+# -----------------
+# Main
+# -----------------
+def main():
+    parser = argparse.ArgumentParser(description="Parametric m_lljj signal shapes across the (WR, N) grid: build the model "
+                                                 "from the signal files, interpolate shapes, check closure")
+    parser.add_argument("files", nargs="*", help="WRAnalyzer_signal_WR*_N*.root files to build the model from")
+    parser.add_argument("--histdir", default=HDIR)
+    parser.add_argument("--histname", default=HISTNAME)
+    parser.add_argument("--rebin-width", type=float, default=DEFAULT_WIDTH)
+    parser.add_argument("--degree", type=int, default=DEGREE, help=f"degree of the mean/width surfaces (default {DEGREE})")
+    parser.add_argument("--model", default=DEFAULT_MODEL, help=f"model file written from the inputs, or read without "
+                                                               f"inputs (default {DEFAULT_MODEL})")
+    parser.add_argument("--store", help="read histograms from this memory-mapped store (hist_store.py) instead of the ROOT files")
+    parser.add_argument("--closure", action="store_true", help="predict every input from the others and compare")
+    parser.add_argument("--closure-output", default="signal_closure.csv", help="--closure table (default signal_closure.csv)")
+    parser.add_argument("--predict", nargs=2, type=int, action="append", metavar=("WR", "N"), default=[],
+                        help="write the shape at this mass point (repeatable)")
+    parser.add_argument("--shape", choices=SHAPES, default="template",
+                        help="morphed templates (default) or the parametric Gaussian / Breit-Wigner")
+    parser.add_argument("--output", default="signal_shapes.root", help="--predict shapes (default signal_shapes.root)")
+    args = parser.parse_args()
+    if args.closure and not args.files:
+        parser.error("--closure needs the signal files")
+    if not args.files and not args.predict:
+        parser.error("give signal files to build a model, or --predict WR N with an existing --model")
+
+    if args.files:
+        t0 = time.perf_counter()
+        labels, masses, values, sumw2, edges = load_points(args.files, args.histdir, args.histname, args.store,
+                                                           args.rebin_width)
+        model = build_model(fit_points(labels, masses, values, sumw2, edges), edges, args.degree,
+                            args.histdir, args.histname)
+        save_model(model, args.model)
+        print(f"Built the model from {len(labels)} points in {time.perf_counter() - t0:.2f} s, saved {args.model}")
+        if args.closure:
+            rows = closure(model, values, sumw2, args.shape)
+            print_closure(rows)
+            write_table(rows, args.closure_output, CLOSURE_COLUMNS)
+            print(f"Saved {args.closure_output}")
+    else:
+        model = load_model(args.model)
+
+    if args.predict:
+        write_shapes(model, [tuple(p) for p in args.predict], args.shape, args.output)
+
+
+if __name__ == "__main__":
+    main()
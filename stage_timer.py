@@ -0,0 +1,186 @@
+import functools
+import json
+import os
+import resource
+import shutil
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# Wall time per named stage ("open", "get", "rebin", "fit", "draw", "saveas"),
+# summed over the process. Stages nest; time spent in an inner stage is only
+# counted there, so the totals add up to at most the wall time. Stages in
+# other threads (prefetching) nest separately and add to the same totals.
+_totals = defaultdict(float)
+_counts = defaultdict(int)
+_local = threading.local()   # .stack: [name, start, time spent in inner stages] per thread
+_lock = threading.Lock()
+
+# Opt-in Chrome trace: every stage becomes a trace event with the resident
+# memory at its end. Each process appends its events to <trace>.parts/<pid>.jsonl
+# (spawned pool workers find the directory in the environment) and
+# finish_trace() merges them into one file.
+TRACE_ENV = "WR_TRACE_DIR"
+_trace_dir = os.environ.get(TRACE_ENV)
+_events = []
+
+
+def rss_mb():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.   # peak, where statm is missing
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+@contextmanager
+def stage(name, **args):
+    stack = _stack()
+    frame = [name, time.perf_counter(), 0.0]
+    stack.append(frame)
+    try:
+        yield
+    finally:
+        stack.pop()
+        end = time.perf_counter()
+        elapsed = end - frame[1]
+        with _lock:
+            _totals[name] += elapsed - frame[2]
+            _counts[name] += 1
+        if stack:
+            stack[-1][2] += elapsed
+        if _trace_dir is not None:
+            _record(name, frame[1], end, args, flush=not stack)
+
+
+def _record(name, start, end, args, flush):
+    pid, rss = os.getpid(), round(rss_mb(), 1)
+    with _lock:
+        _events.append({"name": name, "cat": "stage", "ph": "X", "pid": pid, "tid": threading.get_ident(),
+                        "ts": start * 1e6, "dur": (end - start) * 1e6, "args": {**args, "rss_mb": rss}})
+        _events.append({"name": "memory", "ph": "C", "pid": pid, "ts": end * 1e6, "args": {"rss_mb": rss}})
+    if flush:
+        _flush()
+
+
+def _flush():
+    with _lock:
+        if not _events or _trace_dir is None:
+            return
+        try:
+            with open(os.path.join(_trace_dir, f"{os.getpid()}.jsonl"), "a") as f:
+                for event in _events:
+                    f.write(json.dumps(event) + "\n")
+        except OSError:
+            pass
+        _events.clear()
+
+
+def timed(name):
+    # Decorator: the whole call is one `name` stage
+    def wrap(func):
+        @functools.wraps(func)
+        def inner(*args, **kwargs):
+            with stage(name, function=func.__qualname__):
+                return func(*args, **kwargs)
+        return inner
+    return wrap
+
+
+def stage_totals():
+    return {name: {"seconds": _totals[name], "calls": _counts[name]} for name in _totals}
+
+
+def reset_stages():
+    with _lock:
+        _totals.clear()
+        _counts.clear()
+
+
+# -----------------
+# Trace files
+# -----------------
+def start_trace(path):
+    global _trace_dir
+    _trace_dir = path + ".parts"
+    shutil.rmtree(_trace_dir, ignore_errors=True)
+    os.makedirs(_trace_dir)
+    os.environ[TRACE_ENV] = _trace_dir   # inherited by worker processes started from here on
+
+
+def finish_trace(path, top=15):
+    """Merge all processes' events into the Chrome trace `path` and print the hot spots."""
+    global _trace_dir
+    _flush()
+    events = []
+    for part in sorted(os.listdir(_trace_dir)):
+        with open(os.path.join(_trace_dir, part)) as f:
+            events += [json.loads(line) for line in f if line.strip()]
+    shutil.rmtree(_trace_dir, ignore_errors=True)
+    os.environ.pop(TRACE_ENV, None)
+    _trace_dir = None
+
+    pids = sorted({e["pid"] for e in events})
+    for i, pid in enumerate(pids):
+        events.append({"name": "process_name", "ph": "M", "pid": pid,
+                       "args": {"name": "main" if pid == os.getpid() else f"worker {i}"}})
+    with open(path, "w") as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+    print(f"Trace written to {path} ({len(events)} events, {len(pids)} processes)")
+    print_summary(events, top)
+
+
+def print_summary(events, top=15):
+    # Self time per stage and the `top` heaviest (stage, details) combinations
+    spans = sorted((e for e in events if e["ph"] == "X"), key=lambda e: (e["pid"], e["tid"], e["ts"], -e["dur"]))
+    self_time = {}
+    open_spans = {}
+    for e in spans:
+        # children start inside their parent and end before it: subtract them from the innermost open span
+        stack = open_spans.setdefault((e["pid"], e["tid"]), [])
+        while stack and stack[-1]["ts"] + stack[-1]["dur"] <= e["ts"]:
+            stack.pop()
+        if stack:
+            self_time[id(stack[-1])] -= e["dur"]
+        self_time[id(e)] = e["dur"]
+        stack.append(e)
+
+    per_stage = defaultdict(lambda: [0., 0])
+    hot = defaultdict(float)
+    for e in spans:
+        t = self_time[id(e)] / 1e6
+        per_stage[e["name"]][0] += t
+        per_stage[e["name"]][1] += 1
+        details = ", ".join(f"{k}={v}" for k, v in sorted(e["args"].items()) if k != "rss_mb")
+        hot[(e["name"], details)] += t
+    total = sum(t for t, _ in per_stage.values()) or 1.
+
+    print(f"{'stage':8s} {'self [s]':>9s} {'calls':>6s} {'share':>6s}")
+    for name, (t, calls) in sorted(per_stage.items(), key=lambda kv: -kv[1][0]):
+        print(f"{name:8s} {t:9.3f} {calls:6d} {100 * t / total:5.1f}%")
+    print(f"Top {top} hot spots:")
+    for (name, details), t in sorted(hot.items(), key=lambda kv: -kv[1])[:top]:
+        print(f"  {t:8.3f} s  {name:7s} {details}")
+    rss = [e["args"]["rss_mb"] for e in events if e["ph"] == "C"]
+    if rss:
+        print(f"Peak resident memory seen: {max(rss):.0f} MB")
+
+
+@contextmanager
+def tracing(path):
+    # `with tracing(args.trace):` around a script's work; a no-op without --trace
+    if not path:
+        yield
+        return
+    start_trace(path)
+    try:
+        yield
+    finally:
+        finish_trace(path)
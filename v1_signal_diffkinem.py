@@ -1,109 +1,202 @@
-import ROOT
-ROOT.gROOT.SetBatch(True)
-import sys, json, re
+import sys, re, argparse
+from hist_loader import (config_keys, read_histograms, read_arrays, cached_histograms, root_batch, as_arrays,
+                         arrays_to_th1, new_canvas)
+from hist_store import open_store
+from rebinning import DEFAULT_WIDTH, rebin_hist
+from parallel_render import add_render_options, render_options, render_tasks
+from stage_timer import stage, timed, tracing
+from hist_index import check_configs, report_problems
+from config_plan import load_configs, build_plan, plan_keys, explain
+from plot_books import PlotBook, book_path
+from output_fingerprint import plot_fingerprint, is_current, record
+from sharding import SHARD_DIR
+import hist_loader, rebinning
+
+# The drawing code behind each plot: this script and the helpers that rebin and convert for it
+DRAW_SOURCES = [__file__, hist_loader.__file__, rebinning.__file__]
 
 def sanitize_filename(s):
     return re.sub(r"[^a-zA-Z0-9_\-]", "_", s)
 
 
-def overlay_histograms(files, histname, hdir_str, op_str, xaxis_title, index=None):
-    hists = []
+@timed("draw")
+def overlay_histograms(files, histname, hdir_str, op_str, xaxis_title, index=None,
+                       rebin_width=DEFAULT_WIDTH, rebin_edges=None, loaded=None, book=None, force=False):
+    ROOT = root_batch()
     colors = [ROOT.kBlue, ROOT.kRed, ROOT.kGreen+2, ROOT.kMagenta]
 
-    c = ROOT.TCanvas("c", "Overlay", 800, 600)
-    legend = ROOT.TLegend(0.65, 0.7, 0.9, 0.88)
-    legend.SetBorderSize(0)
-    legend.SetFillStyle(0)
-
+    # Rebinned arrays and legend text of every file that has the histogram
+    curves = []
     for i, f in enumerate(files):
         match = re.search(r"_WR(\d+)_", f)
         mass_str = match.group(1) if match else f
         match = re.search(r"_N(\d+)\.root", f)
         Nmass_str = match.group(1) if match else f
         print(Nmass_str)
-        tf = ROOT.TFile.Open(f)
-        if not tf or tf.IsZombie():
-            print(f"Could not open {f}")
+        # Detached histograms preloaded by main(), or read just this one
+        if loaded is not None and f in loaded:
+            file_hists = loaded[f]
+        else:
+            try:
+                file_hists = read_histograms(f, [(hdir_str, histname)])
+            except RuntimeError as err:
+                print(err)
+                continue
+
+        h_orig = file_hists.get((hdir_str, histname))
+        if not h_orig:
+            print(f"Histogram {hdir_str}/{histname} not found in {f}")
             continue
 
-        hdir = tf.Get(hdir_str)
-        if not hdir:
-            print(f"Directory {hdir_str} not found in {f}")
-            tf.ls()  # debug: list directory contents
-            tf.Close()
-            continue
+        # Rebin to ~100 GeV (or the config's width / edges), independent of the loaded one
+        curves.append((i, rebin_hist(as_arrays(h_orig), rebin_width, rebin_edges), f"(W,N)=({mass_str},{Nmass_str})"))
 
-        h_orig = hdir.Get(histname)
-        # Rebin to ~100 GeV                                                                                                                   
-        bin_width = h_orig.GetBinWidth(1)
-        rebin_factor = max(1, int(100/bin_width))
-        h_orig.Rebin(rebin_factor)
+    if not curves:
+        print("No histograms drawn.")
+        return
 
-        if not h_orig:
-            print(f"Histogram {histname} not found in {f}")
-            tf.Close()
-            continue
+    # Everything on the canvas besides the histograms; with the rebinned
+    # contents it makes the fingerprint of the output
+    style = {"canvas": [800, 600], "logy": True, "normalized": True, "line_width": 2,
+             "colors": [int(colors[i % len(colors)]) for i, _, _ in curves],
+             "xaxis_title": xaxis_title, "yaxis_title": "Normalized", "axis_text_size": 0.04,
+             "legend": [0.65, 0.7, 0.9, 0.88], "legend_text": [text for _, _, text in curves],
+             "labels": [[0.11, 0.92, "CMS Work in Progress"], [0.6, 0.92, "#sqrt{s} = 13 TeV, Lumi = 54 fb^{-1}"]]}
+    outname = f"plot_{index}" if index is not None else f"overlay_{histname}_diffWR"
+    fp = plot_fingerprint([arrays for _, arrays, _ in curves], style, DRAW_SOURCES)
+    if book is None and not force and is_current([outname + ".png", outname + ".pdf"], fp):
+        print(f"Unchanged {outname}, not redrawn")
+        return
+
+    c = new_canvas("c", "Overlay", *style["canvas"])
+    legend = ROOT.TLegend(*style["legend"])
+    legend.SetBorderSize(0)
+    legend.SetFillStyle(0)
 
-        # fully clone histogram so it's independent of file
-        h = h_orig.Clone(f"h_{i}")
-        h.SetDirectory(0)
-        tf.Close()
+    hists = []
+    for (i, arrays, text), col in zip(curves, style["colors"]):
+        h = arrays_to_th1(f"h_{i}", arrays)
 
         if h.Integral() > 0:
             h.Scale(1.0 / h.Integral())
 
-        h.SetLineColor(colors[i % len(colors)])
-        h.SetLineWidth(2)
+        h.SetLineColor(col)
+        h.SetLineWidth(style["line_width"])
         h.GetYaxis().SetTitleOffset(1.2)
         hists.append(h)
 
         draw_opt = "HIST" if len(hists) == 1 else "HIST SAME"
         h.Draw(draw_opt)
-        
-        legend.AddEntry(h, f"(W,N)=({mass_str},{Nmass_str})", "l")
 
-    if not hists:
-        print("No histograms drawn.")
-        return
+        legend.AddEntry(h, text, "l")
 
     # Axis title
+    size = style["axis_text_size"]
     hists[0].GetXaxis().SetTitle(xaxis_title)
-    hists[0].GetYaxis().SetTitle("Normalized")
-    hists[0].GetYaxis().SetTitleSize(0.04)
-    hists[0].GetXaxis().SetTitleSize(0.04)
-    hists[0].GetYaxis().SetLabelSize(0.04)
-    hists[0].GetXaxis().SetLabelSize(0.04)
-
-    ROOT.gPad.SetLogy()
+    hists[0].GetYaxis().SetTitle(style["yaxis_title"])
+    hists[0].GetYaxis().SetTitleSize(size)
+    hists[0].GetXaxis().SetTitleSize(size)
+    hists[0].GetYaxis().SetLabelSize(size)
+    hists[0].GetXaxis().SetLabelSize(size)
+
+    if style["logy"]:
+        ROOT.gPad.SetLogy()
     ROOT.gStyle.SetOptStat(0)
     legend.Draw()
 
     label = ROOT.TLatex()
     label.SetNDC()
     label.SetTextFont(42)
-    label.SetTextSize(0.04)
-    label.DrawLatex(0.11, 0.92, "CMS Work in Progress")
-    label.DrawLatex(0.6, 0.92, "#sqrt{s} = 13 TeV, Lumi = 54 fb^{-1}")
+    label.SetTextSize(size)
+    for x, y, text in style["labels"]:
+        label.DrawLatex(x, y, text)
 
     c.Update()
-    outname = f"plot_{index}" if index is not None else f"overlay_{histname}_diffWR"
-    c.SaveAs(outname + ".png")
-    c.SaveAs(outname + ".pdf")
+    if book is not None:
+        book.add(c, book_path("overlay", op_str, hdir_str), outname)
+        return c, hists
+    with stage("saveas", file=outname):
+        c.SaveAs(outname + ".png")
+        c.SaveAs(outname + ".pdf")
+    record([outname + ".png", outname + ".pdf"], fp)
 
     return c, hists
 
-def main(files, config_file="hists.json"):
-    with open(config_file, "r") as f:
-        hist_configs = json.load(f)
-
-    for cfg in hist_configs:
-        overlay_histograms(files, **cfg)
+def load_config(files, cfg, keys, backend="root", store=None, book=None, force=False):
+    # Prefetch loader, runs in a thread: the config's histograms through uproot (or the store), never PyROOT
+    loaded = {}
+    for f in files:
+        try:
+            loaded[f] = open_store(store).read(f, keys) if store else read_arrays(f, keys)
+        except RuntimeError as err:
+            print(err)
+    return loaded
+
+
+def render_config(files, cfg, keys, backend="root", store=None, book=None, force=False, loaded=None):
+    # One config entry; each process reads every input file at most once (unless prefetched)
+    if loaded is None:
+        loaded = {}
+        for f in files:
+            try:
+                loaded[f] = cached_histograms(f, keys, backend, store)
+            except RuntimeError as err:
+                print(err)
+    files = [f for f in files if f in loaded]
+    if backend == "uproot":
+        import mpl_plots
+        mpl_plots.signal_overlay(files, loaded=loaded, book=book, force=force, **cfg)
+    else:
+        overlay_histograms(files, loaded=loaded, book=book, force=force, **cfg)
+
+
+def _task_book(task):
+    cfg = task[1][1]
+    return book_path("overlay", cfg["op_str"], cfg["hdir_str"])
+
+
+def main(files, config_file="hists.json", jobs=1, backend="root", store=None, book=False, thumbnails=False,
+         force=False, stream=False, max_rss=None, prefetch=0, prefetch_threads=2, channels=None, regions=None,
+         explain_only=False, shard=None, shard_dir=SHARD_DIR):
+    try:
+        hist_configs = load_configs(config_file, channels, regions)
+    except RuntimeError as err:
+        print(err)
+        return [config_file]
+    plan = build_plan(files, hist_configs)
+    if explain_only:
+        explain(plan, config_file)
+        return []
+
+    # Every file and histogram checked against the indexes before any canvas is opened
+    if report_problems(check_configs(files, hist_configs, store)):
+        return [config_file]
+
+    keys = plan_keys(plan)   # every file read once per process, directory by directory
+    plot_book = PlotBook(thumbnails) if book else None
+    # Streaming and prefetching read only each unit's own histograms and keep nothing between units
+    tasks = [(f"[{i}] {cfg['histname']}", (files, cfg, config_keys([cfg]) if stream or prefetch else keys,
+                                           backend, store, plot_book, force))
+             for i, cfg in enumerate(hist_configs)]
+    return render_tasks(render_config, tasks, jobs, plot_book, _task_book, stream, max_rss, prefetch,
+                        prefetch_threads, load_config, shard, shard_dir, name="signal-overlay")
+
+
+def cli(argv=None):
+    parser = argparse.ArgumentParser(description="Overlay one distribution from several signal files per config entry")
+    parser.add_argument("inputs", nargs="+", help="<rootfiles...> <config.json or config template>")
+    add_render_options(parser, prefetch=True)
+    args = parser.parse_args(argv)
+
+    if len(args.inputs) < 2:
+        print("Usage: python3 script.py [--jobs N] [--backend root|uproot] <rootfiles...> <config.json>")
+        return 1
+
+    *rootfiles, config_file = args.inputs
+    with tracing(args.trace):
+        failures = main(rootfiles, config_file, **render_options(parser, args))
+    return 1 if failures else 0
 
 
 if __name__ == "__main__":
-    if len(sys.argv) < 3:
-        print("Usage: python3 script.py <rootfiles...> <config.json>")
-        sys.exit(1)
-
-    *rootfiles, config_file = sys.argv[1:]
-    main(rootfiles, config_file)
+    sys.exit(cli())
@@ -4,15 +4,59 @@ import uproot
 import numpy as np
 import matplotlib.pyplot as plt
 import argparse
+import sys
 import re
 from scipy.optimize import curve_fit
 
+from rebinning import rebin
+from batch_fit import (TOY_CHUNK, TOY_COLUMNS, peak_fit, poisson_toys, toy_summary, toy_rows, print_toy_table,
+                       write_table)
+from fit_cache import FitCache
+from hist_index import check_configs, report_problems
+from hist_store import open_store
+from stage_timer import stage, tracing
+
 # -----------------
 # Gaussian function
 # -----------------
 def gauss(x, A, mu, sigma):
     return A * np.exp(-0.5 * ((x - mu) / sigma) ** 2)
 
+# -----------------
+# Two-step fit: rough fit, then refit within -/+ window*sigma
+# (settings and version are part of the fit-cache key)
+# -----------------
+FIT_SETTINGS = {"window": 2.0, "sigma0": 200.}
+FITTER_VERSION = 1
+
+def fit_peak(centers, values):
+    p0 = [values.max(), centers[np.argmax(values)], FIT_SETTINGS["sigma0"]]  # initial guess
+    popt, pcov = curve_fit(gauss, centers, values, p0=p0)
+    mu, sigma = popt[1], abs(popt[2])
+
+    # Refit within -/+ 2 sigma
+    window = FIT_SETTINGS["window"]
+    mask = (centers > mu - window*sigma) & (centers < mu + window*sigma)
+    return curve_fit(gauss, centers[mask], values[mask], p0=popt)
+
+def cached_fit_peak(centers, values, errors, edges, cache):
+    # fit_peak(), or its stored result for identical input; failures are cached too
+    if cache is None:
+        return fit_peak(centers, values)
+    key = FitCache.key(values, errors, edges, "curvefit_gauss", FIT_SETTINGS, FITTER_VERSION)
+    cached = cache.get(key)
+    if cached is not None:
+        if cached.get("failed"):
+            raise RuntimeError("fit failed (cached)")
+        return np.array(cached["popt"]), np.array(cached["pcov"])
+    try:
+        popt, pcov = fit_peak(centers, values)
+    except RuntimeError:
+        cache.put(key, {"failed": True})
+        raise
+    cache.put(key, {"popt": popt.tolist(), "pcov": pcov.tolist()})
+    return popt, pcov
+
 # -----------------
 # Extract WR mass from filename
 # -----------------
@@ -20,6 +64,51 @@ def extract_mass_from_filename(filename):
     match = re.search(r"_WR(\d+)", filename)
     return match.group(1) if match else "unknown"
 
+# -----------------
+# Parameter errors from the fit covariance: mu, sigma and sigma/mu (uncorrelated propagation)
+# -----------------
+def fit_errors(popt, pcov):
+    mu, sigma = popt[1], abs(popt[2])
+    mu_err, sigma_err = np.sqrt(np.abs(np.diag(pcov)))[1:3]
+    resolution_err = (sigma / mu) * np.hypot(sigma_err / sigma, mu_err / mu) if mu != 0 else 0.0
+    return mu_err, sigma_err, resolution_err
+
+# -----------------
+# Poisson toys of every rebinned histogram, each normalised and refitted like the histogram
+# itself (batch_fit.peak_fit: the fit_peak() estimator for a whole stack of toys at once),
+# so the spread is that of the reported mu and sigma
+# -----------------
+def toy_errors(toy_inputs, ntoys, seed, output):
+    rng = np.random.default_rng(seed)
+    rows = []
+    for filename, values, sumw2, edges in toy_inputs:
+        centers = 0.5 * (edges[1:] + edges[:-1])
+        try:
+            popt, pcov = fit_peak(centers, values / values.sum())
+        except RuntimeError:
+            print(f"Fit failed for {filename}, no toys")
+            continue
+        mu_err, sigma_err, _ = fit_errors(popt, pcov)
+        n_eff, scale = poisson_toys(values, sumw2)
+        fitted = np.full((ntoys, 2), np.nan)   # failed toy fits are left out
+        with stage("fit", file=filename, toys=ntoys):
+            for lo in range(0, ntoys, TOY_CHUNK):
+                toys = scale * rng.poisson(n_eff, size=(min(TOY_CHUNK, ntoys - lo), len(n_eff)))
+                total = toys.sum(axis=1)
+                res = peak_fit(toys / np.where(total > 0, total, 1.0)[:, None], centers,
+                               FIT_SETTINGS["window"], FIT_SETTINGS["sigma0"])
+                ok = res["converged"] & (total > 0)
+                fitted[lo:lo + len(toys)] = np.where(ok[:, None], np.abs(res["popt"][:, 1:3]), np.nan)
+        failed = np.isnan(fitted[:, 0]).sum()
+        if failed:
+            print(f"{filename}: {failed} of {ntoys} toy fits failed, left out of bias and spread")
+        summary = toy_summary(np.array([popt[1]]), np.array([mu_err]), np.array([abs(popt[2])]),
+                              np.array([sigma_err]), fitted[None])
+        rows += toy_rows([filename], "gauss", summary)
+    print_toy_table(rows, ntoys)
+    write_table(rows, output, TOY_COLUMNS)
+    print(f"Saved {output}")
+
 # -----------------
 # Main
 # -----------------
@@ -29,65 +118,83 @@ def main():
     parser.add_argument("--histdir", default="wr_ee_resolved_sr")
     parser.add_argument("--histname", default="mass_fourobject_wr_ee_resolved_sr")
     parser.add_argument("--output", default="overlay.pdf")
+    parser.add_argument("--no-cache", action="store_true", help="always refit, ignore and do not update the fit cache")
+    parser.add_argument("--toys", type=int, default=0, metavar="N",
+                        help="also fit N Poisson toys of every histogram (batched, like the histogram fit) and report bias "
+                             "and spread; failed toy fits are counted and left out")
+    parser.add_argument("--toy-output", default="wr_mass_toys.csv", help="--toys result table (default wr_mass_toys.csv)")
+    parser.add_argument("--seed", type=int, default=1, help="--toys random seed (default 1)")
+    parser.add_argument("--store", help="read histograms from this memory-mapped store (hist_store.py) instead of the ROOT files")
+    parser.add_argument("--trace", metavar="OUT.json",
+                        help="write a Chrome trace of the open/get/rebin/fit/draw/SaveAs stages and print the hot spots")
     args = parser.parse_args()
+    if report_problems(check_configs(args.files, [{"hdir_str": args.histdir, "histname": args.histname}], args.store)):
+        sys.exit(1)
+    cache = None if args.no_cache else FitCache()
+    with tracing(args.trace):
+        plt.figure(figsize=(8,6))
+        colors = ["r", "b", "g", "m", "orange", "c"]
+        toy_inputs = []
 
-    plt.figure(figsize=(8,6))
-    colors = ["r", "b", "g", "m", "orange", "c"]
+        for i, filename in enumerate(args.files):
+            # --- Read histogram (zero-copy from the store if given)
+            if args.store:
+                key = (args.histdir, args.histname)
+                values, sumw2, edges = open_store(args.store).read(filename, [key])[key]
+            else:
+                with stage("open", file=filename):
+                    f = uproot.open(filename)
+                with f, stage("get", file=filename):
+                    h = f[f"{args.histdir}/{args.histname}"]
+                    values = h.values()
+                    sumw2 = h.variances()
+                    edges = h.axes[0].edges()
 
-    for i, filename in enumerate(args.files):
-        # --- Read histogram
-        with uproot.open(filename) as f:
-            h = f[f"{args.histdir}/{args.histname}"]
-            values = h.values()
-            edges = h.axes[0].edges()
+            # --- Rebin to 100 GeV (a remainder that does not fill a group is kept as a narrower last bin)
+            values, sumw2, edges = rebin(values, sumw2, edges, 100.0)
             centers = 0.5 * (edges[1:] + edges[:-1])
+            toy_inputs.append((filename, values, sumw2, edges))
 
-        # --- Rebin to 100 GeV
-        bin_width = edges[1] - edges[0]
-        rebin_factor = max(1, int(round(100.0 / bin_width)))
-        values = values[: len(values) - len(values) % rebin_factor]  # trim if not divisible
-        values = values.reshape(-1, rebin_factor).sum(axis=1)
-        edges = edges[::rebin_factor]
-        centers = 0.5 * (edges[1:] + edges[:-1])
+            # --- Normalize
+            errors = np.sqrt(sumw2)
+            if values.sum() > 0:
+                errors = errors / values.sum()
+                values = values / values.sum()
 
-        # --- Normalize
-        if values.sum() > 0:
-            values = values / values.sum()
+            # --- Gaussian fit, rough then within -/+ 2 sigma (reused from the fit cache if unchanged)
+            try:
+                with stage("fit", file=filename):
+                    popt, pcov = cached_fit_peak(centers, values, errors, edges, cache)
+                mu, sigma = popt[1], abs(popt[2])
+                resolution = sigma / mu if mu != 0 else 0.0
 
-        # --- First rough Gaussian fit
-        try:
-            p0 = [values.max(), centers[np.argmax(values)], 200.]  # initial guess
-            popt, pcov = curve_fit(gauss, centers, values, p0=p0)
-            mu, sigma = popt[1], abs(popt[2])
+                # --- Plot histogram
+                plt.step(centers, values, where="mid", color=colors[i % len(colors)], lw=2,
+                         label=f"WR {extract_mass_from_filename(filename)} GeV (Ï/Î¼={resolution:.3f})")
 
-            # Refit within Â±2Ï
-            mask = (centers > mu - 2*sigma) & (centers < mu + 2*sigma)
-            popt, pcov = curve_fit(gauss, centers[mask], values[mask], p0=popt)
-            mu, sigma = popt[1], abs(popt[2])
-            resolution = sigma / mu if mu != 0 else 0.0
+                # --- Plot fit
+                xfit = np.linspace(mu - 4*sigma, mu + 4*sigma, 200)
+                plt.plot(xfit, gauss(xfit, *popt), "--", color=colors[i % len(colors)])
+                mu_err, sigma_err, resolution_err = fit_errors(popt, pcov)
+                print(f"{filename}: mu={mu:.2f} +- {mu_err:.2f}, sigma={sigma:.2f} +- {sigma_err:.2f}, "
+                      f"Ï/Î¼={resolution:.4f} +- {resolution_err:.4f}")
 
-            # --- Plot histogram
-            plt.step(centers, values, where="mid", color=colors[i % len(colors)], lw=2,
-                     label=f"WR {extract_mass_from_filename(filename)} GeV (Ï/Î¼={resolution:.3f})")
+            except RuntimeError:
+                print(f"Fit failed for {filename}")
+                plt.step(centers, values, where="mid", color=colors[i % len(colors)], lw=2,
+                         label=f"WR {extract_mass_from_filename(filename)} GeV (fit failed)")
 
-            # --- Plot fit
-            xfit = np.linspace(mu - 4*sigma, mu + 4*sigma, 200)
-            plt.plot(xfit, gauss(xfit, *popt), "--", color=colors[i % len(colors)])
-            print(f"{filename}: mu={mu:.2f}, sigma={sigma:.2f}, Ï/Î¼={resolution:.4f}")
-
-        except RuntimeError:
-            print(f"Fit failed for {filename}")
-            plt.step(centers, values, where="mid", color=colors[i % len(colors)], lw=2,
-                     label=f"WR {extract_mass_from_filename(filename)} GeV (fit failed)")
-
-    # --- CMS-style cosmetics
-    plt.xlabel("Mass [GeV]", fontsize=14)
-    plt.ylabel("Event yield / bin", fontsize=14)
-    plt.legend(fontsize=12, frameon=False)
-    plt.grid(True, alpha=0.3)
-    plt.tight_layout()
-    plt.savefig(args.output)
-    print(f"Saved {args.output}")
+        # --- CMS-style cosmetics
+        plt.xlabel("Mass [GeV]", fontsize=14)
+        plt.ylabel("Event yield / bin", fontsize=14)
+        plt.legend(fontsize=12, frameon=False)
+        plt.grid(True, alpha=0.3)
+        plt.tight_layout()
+        with stage("saveas", file=args.output):
+            plt.savefig(args.output)
+        print(f"Saved {args.output}")
+        if args.toys > 0:
+            toy_errors(toy_inputs, args.toys, args.seed, args.toy_output)
 
 if __name__ == "__main__":
     main()